@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 
+from pyarrow import dataset, feather
+
+import hashlib
+import json
+import numpy as np
 import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 
-# 題材のデータセットをメモリに読み込む関数。クエリ単位でサンプリングする機能もある
-def read_jp_data(sample_rate=1.0, split=None, read_product_detail=False):
-
-    # 製品（products）とその他の情報（examples）の各ファイルのパスを組み立てる
-    examples_path, products_path = (
+# 製品（products）とその他の情報（examples）の各ファイルのパスを組み立てる関数
+def get_jp_data_paths():
+    return tuple(
         os.path.join(
             os.path.dirname(__file__),
             "esci-data",
@@ -18,31 +23,112 @@ def read_jp_data(sample_rate=1.0, split=None, read_product_detail=False):
         for suffix in ("examples", "products")
     )
 
+
+# 読み込んだデータセットのスナップショットの保存先。このまま実行した場合は、
+# 本書のサンプルコードのディレクトリ code 以下、tmp/jp-data-snapshot に保存する
+JP_DATA_SNAPSHOT_DIR = os.path.join(
+    os.path.dirname(__file__), "tmp", "jp-data-snapshot"
+)
+
+
+# スナップショットの形式を変えた場合に、古いものを使わないようにするための版
+JP_DATA_SNAPSHOT_VERSION = 1
+
+
+# 読み込みの引数と元のファイルの状態から、スナップショットのファイルのパスを決める関数
+# ファイル名は、引数のハッシュ値と元のファイルの状態のハッシュ値をつなげたものとする
+def get_jp_data_snapshot_path(sample_rate, split, read_product_detail):
+    # 元のファイルが更新されれば別のスナップショットになるよう、
+    # 更新時刻とサイズもキーに含める。内容のハッシュ値は計算に時間がかかるので使わない
+    source_stats = [
+        (os.stat(path).st_mtime_ns, os.stat(path).st_size)
+        for path in get_jp_data_paths()
+    ]
+    fingerprints = [
+        hashlib.sha256(json.dumps(key).encode()).hexdigest()[:16]
+        for key in [
+            [JP_DATA_SNAPSHOT_VERSION, sample_rate, split, read_product_detail],
+            source_stats,
+        ]
+    ]
+    return os.path.join(JP_DATA_SNAPSHOT_DIR, f"{'-'.join(fingerprints)}.arrow")
+
+
+# 同じ引数で読み込んだ、古いスナップショット（元のファイルが更新される前のもの）を
+# 削除する関数。元のファイルが更新されるたびに、スナップショットがたまらないようにする
+def remove_stale_jp_data_snapshots(snapshot_path):
+    args_fingerprint = os.path.basename(snapshot_path).split("-")[0]
+    for name in os.listdir(JP_DATA_SNAPSHOT_DIR):
+        path = os.path.join(JP_DATA_SNAPSHOT_DIR, name)
+        if (
+            name.startswith(f"{args_fingerprint}-")
+            and name.endswith(".arrow")
+            and path != snapshot_path
+        ):
+            os.remove(path)
+
+
+# 題材のデータセットをメモリに読み込む関数。クエリ単位でサンプリングする機能もある
+# 一度読み込んだ結果はスナップショットとして保存し、次回からはそれをメモリマップして返す
+def read_jp_data(
+    sample_rate=1.0, split=None, read_product_detail=False, use_cache=True
+):
+    # スナップショットを使わない指定なら、単に元のファイルから読み込む
+    if not use_cache:
+        return read_jp_data_without_cache(sample_rate, split, read_product_detail)
+
+    snapshot_path = get_jp_data_snapshot_path(sample_rate, split, read_product_detail)
+
+    # スナップショットがなければ、元のファイルから読み込んで保存する
+    if not os.path.isfile(snapshot_path):
+        jp_data = read_jp_data_without_cache(sample_rate, split, read_product_detail)
+        os.makedirs(JP_DATA_SNAPSHOT_DIR, exist_ok=True)
+
+        # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+        # メモリマップしてそのまま使えるよう、Arrow IPC（Feather）形式で圧縮せずに書く
+        temporary_path = f"{snapshot_path}.{os.getpid()}.tmp"
+        feather.write_feather(jp_data, temporary_path, compression="uncompressed")
+        os.replace(temporary_path, snapshot_path)
+
+        # 同じ引数の古いスナップショットは、もう使わないので削除する
+        remove_stale_jp_data_snapshots(snapshot_path)
+
+    # スナップショットをメモリマップして読み込む。数値の列はコピーせずにそのまま参照する
+    return feather.read_table(snapshot_path, memory_map=True).to_pandas(
+        split_blocks=True
+    )
+
+
+# 題材のデータセットのうち、本書で扱う行を選ぶ条件（Arrowの式）を組み立てる関数
+# 読み込み時にこの条件を渡すことで、条件に合わない行はそもそもメモリに読み込まない
+def get_jp_example_filter(sample_rate=1.0, split=None):
     # 本書で扱うサブセットに絞り込む
-    example_filters = [("small_version", "==", 1), ("product_locale", "==", "jp")]
+    expression = (pc.field("small_version") == 1) & (pc.field("product_locale") == "jp")
 
     # 訓練データまたはテストデータの指定があれば、さらに絞り込む
     if split is not None:
-        example_filters.append(("split", "==", split))
+        expression &= pc.field("split") == split
 
     # 必要に応じてクエリ単位でサンプリングする
     if sample_rate < 1.0:
-        # サンプリングが必要。まずクエリID列だけを読み込む
-        query_ids = pd.read_parquet(
-            examples_path,
-            columns=["query_id"],
-            filters=example_filters,
-            engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
-        )["query_id"]
-        query_ids = set(query_ids)
-
         # たとえば1パーセントであれば、100で割った余りが0であるクエリIDだけを取り出す
+        # 古いバージョンのpyarrowには剰余の関数がないため、整数の除算と乗算で余りを計算する
         denominator = int(1.0 / sample_rate)
-        query_ids = filter(lambda query_id: query_id % denominator == 0, query_ids)
+        query_id = pc.field("query_id")
+        remainder = pc.subtract(
+            query_id, pc.multiply(pc.divide(query_id, denominator), denominator)
+        )
+        expression &= remainder == 0
+
+    return expression
 
-        # のちに実際に使うデータセットを読み込むときに、クエリIDで絞り込む
-        example_filters.append(("query_id", "in", query_ids))
 
+# その他の情報のテーブルの読み込む列
+EXAMPLE_COLUMNS_TO_READ = ["query", "query_id", "product_id", "esci_label", "split"]
+
+
+# 製品のテーブルを読み込む関数
+def read_jp_products(read_product_detail=False):
     # 製品のテーブルの読み込む列も絞り込む。サイズが大きいが本書の大部分では使わないため
     product_columns_to_read = ["product_id", "product_title"]
     if read_product_detail:
@@ -53,24 +139,182 @@ def read_jp_data(sample_rate=1.0, split=None, read_product_detail=False):
             "product_bullet_point",
         ]
 
+    return pd.read_parquet(
+        get_jp_data_paths()[1],
+        columns=product_columns_to_read,
+        filters=[("product_locale", "==", "jp")],
+        engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
+    )
+
+
+# 題材のデータセットを元のファイルから読み込む関数
+def read_jp_data_without_cache(sample_rate=1.0, split=None, read_product_detail=False):
     # 製品のテーブルとその他の情報のテーブルを読み込み、製品ID列をキーとして結合して返す
     return pd.merge(
         pd.read_parquet(
-            examples_path,
-            columns=["query", "query_id", "product_id", "esci_label", "split"],
-            filters=example_filters,
-            engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
-        ),
-        pd.read_parquet(
-            products_path,
-            columns=product_columns_to_read,
-            filters=[("product_locale", "==", "jp")],
+            get_jp_data_paths()[0],
+            columns=EXAMPLE_COLUMNS_TO_READ,
+            filters=get_jp_example_filter(sample_rate, split),
             engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
         ),
+        read_jp_products(read_product_detail),
         on="product_id",
     )
 
 
+# 題材のデータセットを少しずつ読み込み、結合したものを順に返す関数（ジェネレータ）
+# データセット全体をメモリに載せずに、ベクトル化などを進めたい場合に使う
+def iter_jp_data(
+    sample_rate=1.0,
+    split=None,
+    read_product_detail=False,
+    batch_rows=65536,
+    skip_batches=0,
+):
+    # 結合相手の製品のテーブルは、あらかじめ読み込んでおく。列を絞れば十分小さいため
+    jp_products = read_jp_products(read_product_detail)
+
+    # その他の情報のテーブルは、絞り込みの条件を渡しつつ、高々batch_rows行ずつ読み込む
+    example_dataset = dataset.dataset(get_jp_data_paths()[0], format="parquet")
+    for example_batch in example_dataset.to_batches(
+        columns=EXAMPLE_COLUMNS_TO_READ,
+        filter=get_jp_example_filter(sample_rate, split),
+        batch_size=batch_rows,
+    ):
+        # 条件に合う行がひとつもない塊は飛ばす
+        if example_batch.num_rows == 0:
+            continue
+
+        # 先頭の skip_batches 個の塊は、製品のテーブルと結合せずに飛ばす（中断からの再開）
+        if skip_batches > 0:
+            skip_batches -= 1
+            continue
+
+        # 製品ID列をキーとして結合して返す。行の順序はread_jp_dataと同じになる
+        yield pd.merge(example_batch.to_pandas(), jp_products, on="product_id")
+
+
+# 製品カタログの保存先。このまま実行した場合は、
+# 本書のサンプルコードのディレクトリ code 以下、tmp/product-catalog.arrow に保存する
+PRODUCT_CATALOG_PATH = os.path.join(
+    os.path.dirname(__file__), "tmp", "product-catalog.arrow"
+)
+
+
+# 製品カタログに含める列。データに含まれる列だけを保存する
+PRODUCT_CATALOG_COLUMNS = [
+    "product_id",
+    "product_title",
+    "product_brand",
+    "product_description",
+]
+
+
+# 製品の情報から、製品カタログの内容を表すハッシュ値（フィンガープリント）を計算する関数
+# 保存済みの製品カタログが古くなっていないか確かめるのに使う
+def get_product_catalog_fingerprint(products):
+    hasher = hashlib.sha256()
+    for column in PRODUCT_CATALOG_COLUMNS:
+        if column in products:
+            hasher.update(column.encode())
+            hasher.update(
+                pd.util.hash_pandas_object(products[column], index=False).to_numpy()
+            )
+    return hasher.hexdigest()
+
+
+# データセットの製品の情報を、製品カタログとして保存する関数
+def write_product_catalog(data, path=PRODUCT_CATALOG_PATH):
+    # 製品ID単位で重複排除する。この行の順序が、そのまま0はじまりの行IDになる
+    # split_into_query_and_documentで分割したドキュメントの順序とも一致する
+    products = data.drop_duplicates("product_id")
+
+    # 同じ値が繰り返し出現しうるので、各列を辞書符号化（dictionary encode）する
+    # ただし、製品IDは行ごとに一意なので、辞書符号化しても小さくならずそのまま保存する
+    table = pa.table(
+        {
+            column: (
+                pa.array(products[column], from_pandas=True)
+                if column == "product_id"
+                else pa.array(products[column], from_pandas=True).dictionary_encode()
+            )
+            for column in PRODUCT_CATALOG_COLUMNS
+            if column in products
+        }
+    )
+
+    # 古くなっていないか確かめられるよう、内容のハッシュ値をメタデータに書いておく
+    table = table.replace_schema_metadata(
+        {b"fingerprint": get_product_catalog_fingerprint(products).encode()}
+    )
+
+    # メモリマップしてそのまま使えるよう、Arrow IPC（Feather）形式で圧縮せずに書く
+    # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    feather.write_feather(table, temporary_path, compression="uncompressed")
+    os.replace(temporary_path, path)
+
+
+# 製品カタログを扱うクラス。行IDの行列を、製品の情報の行列に一括で変換（hydrate）する
+# メモリマップしたArrowのテーブルをそのまま保持し、値は変換するときに必要な分だけ取り出す
+class ProductCatalog:
+
+    # インスタンスを作成する特殊メソッド
+    def __init__(self, table):
+        self.table = table
+
+        # 製品数（行IDの上限）を保存しておく
+        self.size = table.num_rows
+
+    # 製品IDの列を、int32の行IDの配列に変換するメソッド。未知の製品IDは-1とする
+    def get_row_ids(self, product_ids):
+        row_ids = pc.index_in(
+            pa.array(product_ids, type=pa.string()),
+            value_set=self.table.column("product_id").combine_chunks(),
+        )
+        return row_ids.fill_null(-1).to_numpy().astype(np.int32)
+
+    # 行IDの行列（Faissの検索結果のindex_matrixなど）を、同じ形の製品の情報の行列に
+    # 変換するメソッド。Pythonのループは使わず、Arrowの配列から一括で取り出す
+    # Faissがプレースホルダとして返す-1は、欠損値（None）に変換する
+    def hydrate(self, index_matrix, column="product_id"):
+        index_matrix = np.asarray(index_matrix)
+        row_ids = index_matrix.ravel()
+        values = self.table.column(column).take(pa.array(row_ids, mask=row_ids < 0))
+
+        # 辞書符号化した列は、取り出した分だけ元の値に戻す
+        if pa.types.is_dictionary(values.type):
+            values = values.cast(values.type.value_type)
+
+        return values.to_numpy().reshape(index_matrix.shape)
+
+
+# 製品カタログを読み込む関数。メモリマップするので、ファイル全体はメモリに読み込まない
+def read_product_catalog(path=PRODUCT_CATALOG_PATH):
+    # ファイルが存在すれば読み込む
+    if os.path.isfile(path):
+        return ProductCatalog(feather.read_table(path, memory_map=True))
+
+    # 存在しなければ例外をあげる
+    raise ValueError("事前に保存した製品カタログがありません")
+
+
+# データセットの製品カタログを読み込む関数。保存した製品カタログがない場合や、
+# 古くなっている（内容のハッシュ値が異なる）場合だけ、保存し直してから読み込む
+def get_product_catalog(data, path=PRODUCT_CATALOG_PATH):
+    if os.path.isfile(path):
+        metadata = pa.ipc.open_file(pa.memory_map(path)).schema.metadata or {}
+        fingerprint = get_product_catalog_fingerprint(
+            data.drop_duplicates("product_id")
+        )
+        if metadata.get(b"fingerprint") == fingerprint.encode():
+            return read_product_catalog(path)
+
+    write_product_catalog(data, path)
+    return read_product_catalog(path)
+
+
 # このコードを直に実行した場合のみ、以下のコードを実行する
 # つまり、このコードをほかのコードにimportした場合は、以下のコードを実行しない
 if __name__ == "__main__":
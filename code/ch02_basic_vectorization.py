@@ -1,9 +1,24 @@
 #!/usr/bin/env python
 
+from collections import OrderedDict
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty
 from sentence_transformers import SentenceTransformer
+from sentence_transformers.util import batch_to_device
+from tqdm import tqdm
 
+import atexit
+import hashlib
+import json
+import numpy as np
 import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import threading
+import time
+import torch
+import unicodedata
 
 
 # 基本的なベクトル化モデルとして、Sentence TransformersのMiniLM-L6を読み込む関数
@@ -15,16 +30,606 @@ def get_basic_vectorization_model():
 DEFAULT_ARGS = {"show_progress_bar": True}
 
 
+# ベクトル化したテキストのキャッシュの保存先。このまま実行した場合は、
+# 本書のサンプルコードのディレクトリ code 以下、tmp/embedding-cache に保存する
+EMBEDDING_CACHE_DIR = os.path.join(os.path.dirname(__file__), "tmp", "embedding-cache")
+
+
+# ベクトル化の結果には影響しない引数。キャッシュのキーには含めない
+ARGS_NOT_AFFECTING_VECTORS = {"batch_size", "show_progress_bar"}
+
+
+# PyTorchの重みを持たないバックエンド（ONNXなど）のモデルの、重みのファイルのパスを
+# 返す関数。各モジュールの auto_model（ONNX Runtimeのモデル）が、読み込んだファイルの
+# パスを持つ。属性の名前は Optimum の版によって異なるので、順に探す
+def get_model_file_paths(model):
+    paths = []
+    for module in model.children():
+        auto_model = getattr(module, "auto_model", None)
+        for owner, name in [
+            (auto_model, "model_path"),
+            (auto_model, "path"),
+            (getattr(auto_model, "session", None), "_model_path"),
+            (getattr(auto_model, "model", None), "_model_path"),
+        ]:
+            path = getattr(owner, name, None)
+            if isinstance(path, (str, os.PathLike)) and os.path.isfile(path):
+                paths.append(os.fspath(path))
+                break
+    return paths
+
+
+# モデルの構成と重みから、モデルを識別するハッシュ値（フィンガープリント）を計算する関数
+# ファインチューニングなどで重みが変われば、別のフィンガープリントになる
+def get_model_fingerprint(model):
+    hasher = hashlib.sha256()
+
+    # モデルの構成。最大シーケンス長やプーリングの方法なども含まれる
+    hasher.update(repr(model).encode())
+
+    # 重みそのもの。BF16などNumPyにない型もあるので、バイト列とみなしてハッシュする
+    for name, tensor in model.state_dict().items():
+        hasher.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        hasher.update(
+            tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy()
+        )
+
+    # ONNXなどのモデルは state_dict が空なので、重みのファイルの名前と内容をハッシュする
+    # 量子化したモデルなど、同じディレクトリの別のファイルも区別できる
+    for path in get_model_file_paths(model):
+        hasher.update(os.path.basename(path).encode())
+        with open(path, "rb") as model_file:
+            for block in iter(lambda: model_file.read(1024 * 1024), b""):
+                hasher.update(block)
+
+    return hasher.hexdigest()
+
+
+# ベクトルの行列の型、形、内容から、ハッシュ値（フィンガープリント）を計算する関数
+# メモリマップした大きな行列も扱えるよう、行のブロックごとにハッシュする
+def get_vectors_fingerprint(*matrices, block_size=65536):
+    hasher = hashlib.blake2b(digest_size=16)
+    for matrix in matrices:
+        hasher.update(f"{matrix.dtype.str}:{matrix.shape}".encode())
+        for start in range(0, len(matrix), block_size):
+            hasher.update(np.ascontiguousarray(matrix[start : start + block_size]))
+    return hasher.hexdigest()
+
+
+# ベクトル化したテキストを、テキストのハッシュ値をキーとしてファイルに保存しておくクラス
+# ベクトルは追記のみの行列としてファイルに書き、メモリマップして読む
+class EmbeddingCache:
+
+    # インスタンスを作成する特殊メソッド
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.keys_path = os.path.join(directory, "keys.bin")
+        self.vectors_path = os.path.join(directory, "vectors.bin")
+        self.meta_path = os.path.join(directory, "meta.json")
+
+        # 複数のスレッドから使われてもよいよう、読み書きはロックを獲得してから行う
+        self.lock = threading.Lock()
+
+        # ベクトルの次元数と型。最初にベクトルを追記する際に決まる
+        self.dimension, self.dtype = None, None
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path) as meta_file:
+                meta = json.load(meta_file)
+            self.dimension, self.dtype = meta["dimension"], np.dtype(meta["dtype"])
+
+        # テキストのハッシュ値（16バイト）は、行列の行の順にファイルに並んでいる
+        keys = np.array([], dtype="S16")
+        if os.path.isfile(self.keys_path):
+            keys = np.fromfile(self.keys_path, dtype="S16")
+
+        # 書き込みの途中で中断された場合に備え、ハッシュ値とベクトルの両方がそろった行だけ使う
+        row_count = len(keys)
+        if self.dimension is not None and os.path.isfile(self.vectors_path):
+            row_bytes = self.dimension * self.dtype.itemsize
+            row_count = min(row_count, os.path.getsize(self.vectors_path) // row_bytes)
+            for path, size in [
+                (self.keys_path, row_count * 16),
+                (self.vectors_path, row_count * row_bytes),
+            ]:
+                os.truncate(path, size)
+        else:
+            row_count = 0
+
+        # ハッシュ値から行番号への連想配列
+        self.key_to_row = dict(zip(keys[:row_count].tolist(), range(row_count)))
+        self.map_vectors()
+
+    # ベクトルのファイルを、現在の行数の行列としてメモリマップするメソッド
+    def map_vectors(self):
+        self.vectors = None
+        if self.key_to_row:
+            self.vectors = np.memmap(
+                self.vectors_path,
+                dtype=self.dtype,
+                mode="r",
+                shape=(len(self.key_to_row), self.dimension),
+            )
+
+    # テキストのハッシュ値を計算する関数
+    @staticmethod
+    def hash(text):
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    # テキストのリストから、行番号の配列を返すメソッド。キャッシュにないテキストは-1とする
+    def lookup(self, texts):
+        with self.lock:
+            return np.array(
+                [self.key_to_row.get(self.hash(text), -1) for text in texts],
+                dtype=np.int64,
+            )
+
+    # 行番号の配列から、ベクトルの行列を返すメソッド（メモリ上にコピーする）
+    def get(self, rows):
+        with self.lock:
+            return self.vectors[rows]
+
+    # テキストのリストとそのベクトルの行列を、キャッシュに追記するメソッド
+    def append(self, texts, vectors):
+        vectors = np.asarray(vectors)
+        with self.lock:
+            # 最初の追記なら、ベクトルの次元数と型を保存する
+            if self.dimension is None:
+                self.dimension, self.dtype = vectors.shape[1], vectors.dtype
+                with open(self.meta_path, "w") as meta_file:
+                    json.dump(
+                        {"dimension": self.dimension, "dtype": self.dtype.str},
+                        meta_file,
+                    )
+
+            # 既にあるテキストや、重複するテキストは追記しない
+            rows_to_append, keys_to_append = [], []
+            for row, text in enumerate(texts):
+                key = self.hash(text)
+                if key not in self.key_to_row:
+                    self.key_to_row[key] = -1
+                    rows_to_append.append(row)
+                    keys_to_append.append(key)
+
+            # ベクトルを先に書く。途中で中断されても、ハッシュ値のない行は読み込み時に捨てる
+            with open(self.vectors_path, "ab") as vectors_file:
+                vectors_file.write(
+                    np.ascontiguousarray(vectors[rows_to_append], dtype=self.dtype)
+                )
+            with open(self.keys_path, "ab") as keys_file:
+                keys_file.write(np.array(keys_to_append, dtype="S16").tobytes())
+
+            # 追記した行の行番号を確定し、メモリマップし直す
+            row_count = len(self.key_to_row) - len(keys_to_append)
+            for offset, key in enumerate(keys_to_append):
+                self.key_to_row[key] = row_count + offset
+            self.map_vectors()
+
+
+# 与えられたモデルと引数に対応する、ベクトル化したテキストのキャッシュを開く関数
+# モデルのフィンガープリント、モデルの型、最大シーケンス長、ベクトル化の結果に影響する
+# 引数が、すべて同じ場合だけ同じキャッシュを使う
+def open_embedding_cache(model, args=DEFAULT_ARGS):
+    key = json.dumps(
+        [
+            get_model_fingerprint(model),
+            # PyTorchのパラメータを持たないモデル（ONNXなど）では None になる
+            str(model.dtype),
+            model.max_seq_length,
+            sorted(
+                (name, repr(value))
+                for name, value in args.items()
+                if name not in ARGS_NOT_AFFECTING_VECTORS
+            ),
+        ]
+    )
+    cache_name = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return EmbeddingCache(os.path.join(EMBEDDING_CACHE_DIR, cache_name))
+
+
+# 検索時のクエリのベクトルを、メモリ上に保持しておくクラス
+# 同じクエリは繰り返し検索されるので、ヒットすればモデルを推論せずにベクトルを返す
+# 合計のバイト数が上限を超えたら、最も長く使われていないクエリから捨てる（LRU）
+class QueryVectorCache:
+
+    # インスタンスを作成する特殊メソッド。有効期限（秒）を与えなければ、期限切れはない
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=None):
+        self.max_bytes, self.ttl = max_bytes, ttl
+
+        # 正規化したクエリから、ベクトルと有効期限の組への連想配列。末尾ほど最近使われた
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        # 非同期処理やスレッドプールから使われてもよいよう、ロックを獲得してから読み書きする
+        self.lock = threading.Lock()
+
+        # 統計情報。ヒット数、ミス数、容量の上限による追い出し数、期限切れ数
+        self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+
+    # クエリを正規化する関数。全角・半角などの表記ゆれ（NFKC）と、空白の違いをそろえる
+    @staticmethod
+    def normalize(text):
+        return " ".join(unicodedata.normalize("NFKC", text).split())
+
+    # 正規化したクエリとベクトルの組が占めるバイト数を返す関数（概算）
+    @staticmethod
+    def get_entry_bytes(key, vector):
+        return len(key.encode()) + vector.nbytes
+
+    # 正規化したクエリのベクトルを返すメソッド。なければNoneを返す
+    def get(self, key):
+        with self.lock:
+            vector, expires_at = self.entries.get(key, (None, None))
+            if expires_at is not None and expires_at < time.monotonic():
+                self.remove(key)
+                self.expirations += 1
+                vector = None
+            if vector is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    # 正規化したクエリとそのベクトルを保存するメソッド
+    def put(self, key, vector):
+        # 呼び出し元で書き換えられないよう、読み取り専用のコピーを保存する
+        vector = np.array(vector)
+        vector.flags.writeable = False
+        entry_bytes = self.get_entry_bytes(key, vector)
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            if entry_bytes > self.max_bytes:
+                return
+            self.entries[key] = (vector, expires_at)
+            self.total_bytes += entry_bytes
+
+            # 上限を超えた分だけ、最も長く使われていないクエリから捨てる
+            while self.total_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    # 正規化したクエリを捨てるメソッド。ロックを獲得してから呼び出す
+    def remove(self, key):
+        vector, _ = self.entries.pop(key)
+        self.total_bytes -= self.get_entry_bytes(key, vector)
+
+    # vectorize_with が返すような、テキストのリストをベクトル化する関数の前にキャッシュを置き、
+    # キャッシュにないクエリだけをベクトル化する関数を返すメソッド
+    # キャッシュのヒットに関わらず同じベクトルになるよう、正規化したクエリをベクトル化する
+    def wrap(self, vectorize):
+        def vectorize_with_cache(texts):
+            keys = [self.normalize(text) for text in texts]
+            key_to_vector = {key: self.get(key) for key in set(keys)}
+
+            # キャッシュにないクエリだけをベクトル化し、保存する
+            missing_keys = sorted(
+                key for key, vector in key_to_vector.items() if vector is None
+            )
+            if missing_keys:
+                for key, vector in zip(missing_keys, vectorize(missing_keys)):
+                    self.put(key, vector)
+                    key_to_vector[key] = vector
+
+            return [key_to_vector[key] for key in keys]
+
+        return vectorize_with_cache
+
+    # 統計情報を返すメソッド
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# テキストのリストを、モデル（の最初のモジュール）と同じ前処理でトークン化する関数
+# パディングはせず、最大シーケンス長で打ち切る。バッチを組んでから pad_features で揃える
+def tokenize_texts(model, texts):
+    texts = [str(text).strip() for text in texts]
+    if not texts:
+        return {"input_ids": [], "attention_mask": []}
+    if getattr(model[0], "do_lower_case", False):
+        texts = [text.lower() for text in texts]
+    return model.tokenizer(texts, truncation=True, max_length=model.max_seq_length)
+
+
+# トークン化したテキストのそれぞれのトークン数を返す関数
+def count_tokens(features):
+    return np.array([len(input_ids) for input_ids in features["input_ids"]])
+
+
+# トークン化したテキストのうち、バッチ（インデックスの配列）の分を取り出し、
+# バッチ中の最長のテキストに合わせてパディングしたテンソルにする関数
+def pad_features(model, features, batch):
+    return model.tokenizer.pad(
+        {name: [values[index] for index in batch] for name, values in features.items()},
+        return_tensors="pt",
+    )
+
+
+# パディングしたテンソルからモデルを推論し、ベクトルの行列を返す関数
+# model.encode と異なりトークン化しないので、その分の引数は扱えない（FEATURE_ARGSを参照）
+def encode_features(model, features, args=DEFAULT_ARGS):
+    with torch.inference_mode():
+        vectors = model(batch_to_device(dict(features), model.device))[
+            "sentence_embedding"
+        ]
+        if args.get("normalize_embeddings", False):
+            vectors = torch.nn.functional.normalize(vectors, p=2, dim=1)
+    return vectors.float().cpu().numpy()
+
+
+# トークン化したテンソルから推論する場合（encode_features）に扱える引数
+FEATURE_ARGS = {"show_progress_bar", "batch_size", "normalize_embeddings"}
+
+
+# トークン化したテンソルから推論する場合に、キャッシュのキーに加える引数
+# model.encode と同じベクトルになるはずだが、経路が異なるので別のキャッシュとする
+FEATURE_CACHE_ARGS = {"encoder": "encode_features"}
+
+
+# トークン数の近いテキストどうしを、パディングを含むトークン数の上限以下のバッチにまとめる関数
+# バッチ（テキストのインデックスの配列）のリストを返す
+def make_token_budget_batches(token_counts, max_tokens_per_batch):
+    # トークン数の昇順に並べる。各バッチの最後のテキストがそのバッチで最長になる
+    order = np.argsort(token_counts, kind="stable")
+
+    batches, start = [], 0
+    while start < len(order):
+        # バッチ中の最長のテキストに合わせてパディングされるので、テキスト数と最長の
+        # トークン数の積が上限を超えない範囲でバッチを伸ばす。ただし最低1件は含める
+        end = start + 1
+        while (
+            end < len(order)
+            and (end - start + 1) * token_counts[order[end]] <= max_tokens_per_batch
+        ):
+            end += 1
+        batches.append(order[start:end])
+        start = end
+
+    return batches
+
+
+# テキストのリストをベクトル化し、行列として返す関数
+# max_tokens_per_batchを指定すると、行数ではなくトークン数の上限でバッチを組む
+# このとき、バッチを組むためにトークン化した結果をそのまま推論に使う
+def encode_texts(model, texts, args=DEFAULT_ARGS, max_tokens_per_batch=None):
+    # 指定がなければ、単にモデルを推論する。このとき引数も与える
+    if max_tokens_per_batch is None:
+        return model.encode(texts, **args)
+
+    # 出力の行列。テキストがなくても、次元数の合った空の行列を返す
+    vectors = np.empty(
+        (len(texts), model.get_sentence_embedding_dimension()), dtype=np.float32
+    )
+    if len(texts) == 0:
+        return vectors
+
+    # 全テキストを一度だけトークン化し、トークン数の近いテキストどうしでバッチを組んで
+    # パディングを減らす
+    features = tokenize_texts(model, texts)
+    batches = make_token_budget_batches(count_tokens(features), max_tokens_per_batch)
+
+    # バッチごとにモデルを推論し、もとのテキストの順序の行列に書き込む
+    # トークン化したテンソルからの推論で扱えない引数があれば、model.encode に任せる
+    model.eval()
+    for batch in tqdm(batches, disable=not args.get("show_progress_bar", False)):
+        if set(args) <= FEATURE_ARGS:
+            vectors[batch] = encode_features(
+                model, pad_features(model, features, batch), args
+            )
+        else:
+            vectors[batch] = model.encode(
+                [texts[index] for index in batch],
+                **{**args, "batch_size": len(batch), "show_progress_bar": False},
+            )
+
+    return vectors
+
+
+# ベクトル化のワーカープロセスで実行する関数。割り当てられたテキストをベクトル化して、
+# 共有メモリ上の出力行列の該当する行に書き込む。モデルの重みはコピーせず、
+# PyTorchのmultiprocessingによって全プロセスで共有する（推論では書き換えないため）
+def run_encoding_worker(
+    worker_id, model, args, max_tokens_per_batch, threads, task_queue, result_queue
+):
+    # プロセス内の並列度（PyTorchのスレッド数）を設定する
+    torch.set_num_threads(threads)
+
+    # 終了の合図（None）を受け取るまで、タスクを処理し続ける
+    while (task := task_queue.get()) is not None:
+        shared_memory_name, shape, indices, texts = task
+        try:
+            started_at = time.perf_counter()
+            if texts:
+                vectors = encode_texts(
+                    model,
+                    texts,
+                    {**args, "show_progress_bar": False},
+                    max_tokens_per_batch,
+                )
+
+                # 例外があがっても、共有メモリのハンドルは必ず閉じる
+                shared_memory = SharedMemory(name=shared_memory_name)
+                try:
+                    output = np.ndarray(
+                        shape, dtype=np.float32, buffer=shared_memory.buf
+                    )
+                    output[indices] = vectors
+                    del output
+                finally:
+                    shared_memory.close()
+            finished_at = time.perf_counter()
+
+            # 処理したテキスト数とかかった時間を返す
+            result_queue.put((worker_id, len(texts), finished_at - started_at, None))
+        except Exception as exception:
+            # 例外はメインプロセスに伝えて、そちらであげる
+            result_queue.put((worker_id, len(texts), 0.0, repr(exception)))
+
+
+# 複数のワーカープロセスでベクトル化するためのクラス。プロセスは使い回す
+class EncodingPool:
+
+    # インスタンスを作成する特殊メソッド。ワーカープロセスを起動する
+    def __init__(
+        self,
+        model,
+        workers,
+        args=DEFAULT_ARGS,
+        max_tokens_per_batch=None,
+        threads_per_worker=None,
+    ):
+        # プロセスあたりのスレッド数。指定がなければCPU数をプロセス数で等分する
+        if threads_per_worker is None:
+            threads_per_worker = max(1, os.cpu_count() // workers)
+
+        # 出力行列の次元数。ベクトルはFP32で返す
+        self.dimension = model.get_sentence_embedding_dimension()
+
+        # モデルの重み（PyTorchのテンソル）をコピーせずにプロセス間で共有できるよう、
+        # PyTorchのmultiprocessingを使う
+        context = torch.multiprocessing.get_context("spawn")
+        self.task_queues = [context.Queue() for _ in range(workers)]
+        self.result_queue = context.Queue()
+        self.processes = [
+            context.Process(
+                target=run_encoding_worker,
+                args=(
+                    worker_id,
+                    model,
+                    args,
+                    max_tokens_per_batch,
+                    threads_per_worker,
+                    task_queue,
+                    self.result_queue,
+                ),
+                daemon=True,
+            )
+            for worker_id, task_queue in enumerate(self.task_queues)
+        ]
+        for process in self.processes:
+            process.start()
+
+    # テキストのリストをワーカープロセスに分担させてベクトル化し、行列として返すメソッド
+    def encode(self, texts):
+        shape = (len(texts), self.dimension)
+
+        # 出力行列を共有メモリ上に確保する
+        shared_memory = SharedMemory(create=True, size=max(1, shape[0] * shape[1] * 4))
+        try:
+            # テキストを1件ずつ順に各プロセスに割り当てる。長さの偏りを避けるため
+            worker_count = len(self.task_queues)
+            for worker_id, task_queue in enumerate(self.task_queues):
+                indices = np.arange(worker_id, len(texts), worker_count)
+                task_queue.put(
+                    (
+                        shared_memory.name,
+                        shape,
+                        indices,
+                        [texts[index] for index in indices],
+                    )
+                )
+
+            # 全プロセスの完了を待ち、プロセスごとのスループットを表示する
+            results = sorted(self.wait_for_result() for _ in range(worker_count))
+            for worker_id, text_count, seconds, error in results:
+                if error is not None:
+                    raise RuntimeError(f"Worker {worker_id} failed: {error}")
+                print(
+                    f"Worker {worker_id}: {text_count} texts in {seconds:.03f} s"
+                    f" ({text_count / max(seconds, 1e-9):.01f} texts/s)"
+                )
+
+            # 共有メモリは解放するので、出力行列をコピーして返す
+            return np.ndarray(shape, dtype=np.float32, buffer=shared_memory.buf).copy()
+        finally:
+            shared_memory.close()
+            shared_memory.unlink()
+
+    # ワーカープロセスの結果をひとつ受け取るメソッド。待つ間も定期的にプロセスの生存を
+    # 確かめ、メモリ不足などで終了したプロセスがあれば、待ち続けずに例外をあげる
+    def wait_for_result(self, poll_interval=1.0):
+        while True:
+            try:
+                return self.result_queue.get(timeout=poll_interval)
+            except Empty:
+                for worker_id, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        raise RuntimeError(
+                            f"Worker {worker_id} exited with code {process.exitcode}"
+                        )
+
+    # ワーカープロセスを終了させるメソッド
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for process in self.processes:
+            process.join()
+
+
 # 与えられたモデルと引数で、「別に与えられたテキストのリストをベクトル化する関数」を返す関数
-def vectorize_with(model, args=DEFAULT_ARGS):
+# use_cache=Trueなら、一度ベクトル化したテキストはファイルに保存しておき、次回から再利用する
+# max_tokens_per_batchを指定すると、トークン数の上限でバッチを組む（encode_textsを参照）
+# workersを指定すると、その数のワーカープロセスでベクトル化する（EncodingPoolを参照）
+def vectorize_with(
+    model,
+    args=DEFAULT_ARGS,
+    use_cache=False,
+    max_tokens_per_batch=None,
+    workers=None,
+    threads_per_worker=None,
+):
+    # 必要に応じて、ベクトル化したテキストのキャッシュを開く
+    # トークン数の上限でバッチを組む場合は、推論の経路が異なるので別のキャッシュとする
+    cache = None
+    if use_cache:
+        cache = open_embedding_cache(
+            model,
+            args if max_tokens_per_batch is None else {**args, **FEATURE_CACHE_ARGS},
+        )
+
+    # テキストのリストを行列にベクトル化する関数。必要に応じてワーカープロセスを起動し、
+    # 以降の呼び出しでも使い回す。プログラムの終了時にはワーカープロセスも終了させる
+    if workers is None:
+
+        def encode(texts):
+            return encode_texts(model, texts, args, max_tokens_per_batch)
+
+    else:
+        encoding_pool = EncodingPool(
+            model, workers, args, max_tokens_per_batch, threads_per_worker
+        )
+        atexit.register(encoding_pool.close)
+        encode = encoding_pool.encode
 
     # 与えられたテキストのリストをベクトル化する関数
     def vectorize(texts):
         # 高速化のため、対象のテキストを重複排除する
         unique_texts = sorted(set(texts))
 
-        # モデルを推論する。このとき引数も与える
-        vectors = model.encode(unique_texts, **args)
+        if cache is None:
+            # モデルを推論する。このとき引数も与える
+            vectors = encode(unique_texts)
+        else:
+            # キャッシュにないテキストだけモデルを推論し、結果をキャッシュに追記する
+            rows = cache.lookup(unique_texts)
+            missing_texts = [text for text, row in zip(unique_texts, rows) if row < 0]
+            if missing_texts:
+                cache.append(missing_texts, encode(missing_texts))
+                rows = cache.lookup(unique_texts)
+
+            # すべてのテキストのベクトルを、キャッシュから取り出す
+            vectors = cache.get(rows)
 
         # もとのテキスト列に対応するベクトル列に戻す
         text_to_vector = {text: vector for text, vector in zip(unique_texts, vectors)}
@@ -33,8 +638,177 @@ def vectorize_with(model, args=DEFAULT_ARGS):
     return vectorize
 
 
+# ベクトルの列から、ベクトルを行とする行列を返すヘルパー関数
+def get_vector_matrix(vectors):
+    return np.vstack(vectors)
+
+
+# データの外に持つベクトルの行列を、列名ごとにまとめる辞書のクラス
+# データフレームの attrs に入れて、行の絞り込みやコピーでも引き継がれるようにする
+# pandas は attrs をディープコピーするので、大きな行列をコピーしないよう自身を返す
+# なお、pandas は merge や join の結果には attrs を引き継がない。concat の結果には、
+# すべてのデータの attrs が等しい場合だけ引き継ぐので、同じ辞書（同じデータから絞り
+# 込んだデータなど）の場合だけ等しいとする。引き継がれなかった場合、行番号の列は残るが
+# ベクトルは取り出せない（KeyError）。異なる行列のデータを結合する場合は、先に
+# with_vector_columns で各行のベクトルの列に戻すか、結合後に set_vector_matrix で
+# 行列を持たせ直す
+class VectorMatrices(dict):
+
+    # ディープコピーの際に呼ばれる特殊メソッド
+    def __deepcopy__(self, memo):
+        return self
+
+    # 等しいかを判定する特殊メソッド。行列の中身は比べず、同じ辞書の場合だけ等しいとする
+    def __eq__(self, other):
+        return self is other
+
+    # 等しくないかを判定する特殊メソッド
+    def __ne__(self, other):
+        return self is not other
+
+
+# ベクトルの列に対応する、行列の行番号の列名を返す関数
+def get_vector_row_column(column):
+    return f"{column}_row"
+
+
+# ベクトルの列を、各行のベクトルを要素とする列ではなく、行列と行番号の列で持たせる関数
+# 行列は attrs に入れ、データの各行には行列の何行目のベクトルかを行番号の列で持たせる
+# 行番号を与えなければ、データの各行が行列の各行に順に対応するものとする
+def set_vector_matrix(data, column, matrix, rows=None):
+    if column in data.columns:
+        del data[column]
+
+    # attrs の辞書は、元のデータから絞り込んだデータなどと共有しているので、
+    # 書き換えずに新しい辞書に置き換える
+    data.attrs["vector_matrices"] = VectorMatrices(
+        {**data.attrs.get("vector_matrices", {}), column: matrix}
+    )
+    data[get_vector_row_column(column)] = (
+        np.arange(len(data), dtype=np.int64) if rows is None else rows
+    )
+
+
+# ベクトルの列を持つ行列と、データの各行に対応する行列の行番号を返す関数
+def get_vector_source(data, column):
+    matrices = data.attrs.get("vector_matrices", {})
+    row_column = get_vector_row_column(column)
+    if column not in matrices or row_column not in data.columns:
+        raise KeyError(column)
+    return matrices[column], data[row_column].to_numpy()
+
+
+# データのベクトルの列から、ベクトルを行とする行列を返すヘルパー関数
+# 各行のベクトルを要素とする列があればそれを積み重ね、なければ attrs の行列から取り出す
+def get_vector_matrix_of(data, column):
+    if column in data.columns:
+        return get_vector_matrix(data[column])
+
+    # データの各行が行列の各行に順に対応するなら、コピーせずに行列をそのまま返す
+    matrix, rows = get_vector_source(data, column)
+    if len(rows) == len(matrix) and (rows == np.arange(len(matrix))).all():
+        return matrix
+    return matrix[rows]
+
+
+# データのベクトルの列名（列名が _vector で終わる列と、attrs の行列の列）を返す関数
+def get_vector_columns(data):
+    vector_columns = [column for column in data.columns if column.endswith("_vector")]
+    for column in data.attrs.get("vector_matrices", {}):
+        if (
+            column not in vector_columns
+            and get_vector_row_column(column) in data.columns
+        ):
+            vector_columns.append(column)
+    return vector_columns
+
+
+# attrs の行列で持つベクトルの列を、各行のベクトルを要素とする列に戻したデータを返す関数
+# OpenSearchへの入力など、行ごとにベクトルを扱う場合に使う
+def with_vector_columns(data):
+    data = data.copy()
+    for column in get_vector_columns(data):
+        if column not in data.columns:
+            data[column] = list(get_vector_matrix_of(data, column))
+            del data[get_vector_row_column(column)]
+    return data
+
+
+# ベクトルの列を保存する行列のファイル（.npy）のパスを組み立てる関数
+def get_vector_matrix_path(parquet_path, column):
+    return f"{os.path.splitext(parquet_path)[0]}.{column}.npy"
+
+
+# ベクトル化したデータを保存する関数。ベクトルの列（列名が _vector で終わる列）は、
+# それぞれ行列として別のファイル（.npy）に保存し、残りの列を .parquet ファイルに保存する
+# attrs にベクトル化したモデルのフィンガープリントがあれば、メタデータに書いておく
+def write_vectorized_data(data, parquet_path):
+    vector_columns = get_vector_columns(data)
+
+    # ベクトルの列を行列として保存する。書き込み途中のファイルを読まないよう、
+    # 一時ファイルに書いてから置き換える
+    for column in vector_columns:
+        matrix_path = get_vector_matrix_path(parquet_path, column)
+        temporary_path = f"{matrix_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as matrix_file:
+            np.save(matrix_file, get_vector_matrix_of(data, column))
+        os.replace(temporary_path, matrix_path)
+
+    # 残りの列を保存する。どの列を別のファイルに保存したかは、メタデータに書いておく
+    # attrs の行列は保存済みなので、attrs を空にしてから変換する
+    # ベクトルの列と同様に、一時ファイルに書いてから置き換える
+    remaining_data = data.drop(
+        columns=[
+            column
+            for vector_column in vector_columns
+            for column in [vector_column, get_vector_row_column(vector_column)]
+            if column in data.columns
+        ]
+    )
+    remaining_data.attrs = {}
+    table = pa.Table.from_pandas(remaining_data, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {
+            **table.schema.metadata,
+            b"vector_columns": json.dumps(vector_columns).encode(),
+            **(
+                {b"model_fingerprint": data.attrs["model_fingerprint"].encode()}
+                if "model_fingerprint" in data.attrs
+                else {}
+            ),
+        }
+    )
+    temporary_path = f"{parquet_path}.{os.getpid()}.tmp"
+    pq.write_table(table, temporary_path)
+    os.replace(temporary_path, parquet_path)
+
+
+# ベクトル化したデータを読み込む関数。ベクトルの列の行列はメモリマップして attrs に入れ、
+# 各行には行番号の列だけを持たせるので、ベクトルそのものはコピーしない
+def read_vectorized_data(parquet_path):
+    data = pd.read_parquet(
+        parquet_path,
+        engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
+    )
+
+    # 別のファイルに保存したベクトルの列を読み込む。古い形式のファイルなら何もしない
+    metadata = pq.read_schema(parquet_path).metadata or {}
+    for column in json.loads(metadata.get(b"vector_columns", b"[]")):
+        matrix = np.load(
+            get_vector_matrix_path(parquet_path, column), mmap_mode="r"
+        ).view(np.ndarray)
+        set_vector_matrix(data, column, matrix)
+
+    # ベクトル化したモデルのフィンガープリントがあれば、attrs に入れておく
+    if b"model_fingerprint" in metadata:
+        data.attrs["model_fingerprint"] = metadata[b"model_fingerprint"].decode()
+
+    return data
+
+
 # 基本的なベクトル化モデルでベクトル化したデータの保存先。このまま実行した場合は、
 # 本書のサンプルコードのディレクトリ code 以下、tmp/basic-vectorized.parquet に保存する
+# ベクトルの列は、tmp/basic-vectorized.query_vector.npy などに保存する
 BASIC_VECTORIZED_PARQUET_PATH = os.path.join(
     os.path.dirname(__file__), "tmp", "basic-vectorized.parquet"
 )
@@ -42,21 +816,14 @@ BASIC_VECTORIZED_PARQUET_PATH = os.path.join(
 
 # ベクトル化したデータを保存する関数
 def write_basic_vectorized_data(data):
-    data.to_parquet(
-        BASIC_VECTORIZED_PARQUET_PATH,
-        index=False,
-        engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
-    )
+    write_vectorized_data(data, BASIC_VECTORIZED_PARQUET_PATH)
 
 
 # ベクトル化したデータを読み込む関数
 def read_basic_vectorized_data():
     # ファイルが存在すれば読み込む
     if os.path.isfile(BASIC_VECTORIZED_PARQUET_PATH):
-        return pd.read_parquet(
-            BASIC_VECTORIZED_PARQUET_PATH,
-            engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
-        )
+        return read_vectorized_data(BASIC_VECTORIZED_PARQUET_PATH)
 
     # 存在しなければ例外をあげる
     raise ValueError("事前にベクトル化したデータがありません（第2章を参照）")
@@ -65,7 +832,10 @@ def read_basic_vectorized_data():
 # データからベクトルの次元数を取得するヘルパー関数
 def get_dimension_number_of(data):
     # 単に最初 (iloc[0]) のクエリベクトルの次元数を取得する
-    return len(data["query_vector"].iloc[0])
+    # attrs の行列で持つ場合は、行列の列数とする
+    if "query_vector" in data.columns:
+        return len(data["query_vector"].iloc[0])
+    return get_vector_source(data, "query_vector")[0].shape[1]
 
 
 # データをクエリとドキュメントに分割するヘルパー関数
@@ -82,8 +852,9 @@ if __name__ == "__main__":
 
     # 基本的なベクトル化モデルと本書デフォルトの引数で、
     # 「別に与えられたテキストのリストをベクトル化する関数」vectorize を準備する
+    # 一度ベクトル化したテキストは、キャッシュしておき次回から再利用する
     basic_vectorization_model = get_basic_vectorization_model()
-    vectorize = vectorize_with(basic_vectorization_model)
+    vectorize = vectorize_with(basic_vectorization_model, use_cache=True)
 
     # 適当なテキストをベクトル化する
     texts = [
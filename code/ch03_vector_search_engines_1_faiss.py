@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 
+from ch01_data_preparation import get_product_catalog
 from ch02_basic_vectorization import (
     get_dimension_number_of,
+    get_vector_matrix_of,
     read_basic_vectorized_data,
     split_into_query_and_document,
 )
 
 import faiss
-import numpy as np
+import pandas as pd
 
 
 # ベクトル化したデータセットをメモリに読み込み、クエリとドキュメントに分割する
@@ -15,11 +17,14 @@ query_data, document_data = split_into_query_and_document(
     read_basic_vectorized_data()
 )
 
+# ドキュメントの製品カタログを読み込む（なければ保存する）。行IDはFaissのインデックスと一致する
+product_catalog = get_product_catalog(document_data)
+
 # データからベクトルの次元数を取得し、Faissインデックスを作成する
 faiss_index = faiss.IndexFlatIP(get_dimension_number_of(query_data))
 
 # ドキュメント（ここでは製品タイトル）ベクトルを整形し入力する
-faiss_index.add(np.vstack(document_data["title_vector"]))
+faiss_index.add(get_vector_matrix_of(document_data, "title_vector"))
 
 # 例として、単一のクエリを取り出し、整形し、表示する
 query_data = query_data[query_data.query_id == 119300]
@@ -27,19 +32,20 @@ print(query_data.to_string(columns=["query_id", "query"], index=False))
 
 # クエリベクトルを整形し入力（つまり検索）する
 ip_matrix, index_matrix = faiss_index.search(
-    np.vstack(query_data["query_vector"]), 10
+    get_vector_matrix_of(query_data, "query_vector"), 10
 )
 
 # Faissの検索の返り値を、そのまま表示する
 print(ip_matrix)
 print(index_matrix)
 
+# ドキュメントのインデックスの行列を、製品タイトルの行列に一括で変換する
+title_matrix = product_catalog.hydrate(index_matrix, column="product_title")
+
 # ランキング結果を整形し表示する
-for indices, ips in zip(index_matrix, ip_matrix):
-    # ドキュメントのインデックスのリストをランキング結果のDataFrameに変換する
-    ranking = document_data.iloc[indices].copy()
-    # ランキング結果にスコア列を追加する
-    ranking["score"] = ips
+for titles, ips in zip(title_matrix, ip_matrix):
+    # 製品タイトルとスコアをランキング結果のDataFrameにまとめる
+    ranking = pd.DataFrame({"score": ips, "product_title": titles})
     print(
         ranking.to_string(
             columns=["score", "product_title"], index=False, max_colwidth=35
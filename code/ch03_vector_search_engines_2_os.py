@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+from ch02_basic_vectorization import with_vector_columns
 from opensearchpy import OpenSearch
 from tqdm.asyncio import tqdm_asyncio
 
@@ -98,6 +99,9 @@ class OpenSearchTester:
 
     # 多数のドキュメントを整形し、入力するメソッド
     def input_documents(self, data, formatter=format_document):
+        # ベクトルは行ごとに整形するので、各行のベクトルを要素とする列に戻しておく
+        data = with_vector_columns(data)
+
         # 並列度を制限するためのセマフォをインスタンス化する
         semaphore = asyncio.Semaphore(self.concurrency)
 
@@ -136,7 +140,13 @@ class OpenSearchTester:
         self.open_search.indices.refresh(index=self.index_name)
 
     # 多数のクエリを整形し、入力し、結果を表示したり保存したりするメソッド
-    def input_queries(self, data, size, formatter=format_query):
+    # vectorize を与えれば、ベクトル化済みの列ではなく、検索ごとにクエリのテキストを
+    # ベクトル化する（オンラインの経路）。QueryVectorCache の wrap でキャッシュを前に
+    # 置いた関数を与えれば、繰り返し現れるクエリはモデルを推論せずに検索できる
+    def input_queries(self, data, size, formatter=format_query, vectorize=None):
+        # ベクトルは行ごとに整形するので、各行のベクトルを要素とする列に戻しておく
+        data = with_vector_columns(data)
+
         # 並列度を制限するためのセマフォをインスタンス化する
         semaphore = asyncio.Semaphore(self.concurrency)
 
@@ -144,6 +154,12 @@ class OpenSearchTester:
         async def input_query(row):
             # セマフォを獲得してから処理を進めることで、実際に並列度を制限する
             async with semaphore:
+                # 必要に応じて、クエリのテキストをベクトル化する。推論はスレッドで行う
+                if vectorize is not None:
+                    [query_vector] = await asyncio.to_thread(vectorize, [row.query])
+                    row = row.copy()
+                    row["query_vector"] = query_vector
+
                 # クエリを入力、つまり検索する（search)。高速化のためスレッドで非同期に行う
                 search_result = await asyncio.to_thread(
                     self.open_search.search,
@@ -193,12 +209,24 @@ class OpenSearchTester:
 
 # このコードを直に実行した場合のみ、以下のコードを実行する
 if __name__ == "__main__":
+    from argparse import ArgumentParser
     from ch02_basic_vectorization import (
+        QueryVectorCache,
+        get_basic_vectorization_model,
         get_dimension_number_of,
         read_basic_vectorized_data,
         split_into_query_and_document,
+        vectorize_with,
     )
 
+    # コマンドライン引数を読み込む
+    argument_parser = ArgumentParser()
+    # 検索ごとにクエリのテキストをベクトル化する（オンラインの経路）かどうか
+    argument_parser.add_argument("--online-vectorization", action="store_true")
+    # その際の、クエリのベクトルのキャッシュの容量（MiB）。0ならキャッシュしない
+    argument_parser.add_argument("--query-cache-mb", default=64, type=int)
+    args = argument_parser.parse_args()
+
     # ベクトル化したデータセットをメモリに読み込み、クエリとドキュメントに分割する
     query_data, document_data = split_into_query_and_document(
         read_basic_vectorized_data()
@@ -215,5 +243,21 @@ if __name__ == "__main__":
     # ドキュメントを整形し入力する
     tester.input_documents(document_data)
 
+    # 必要に応じて、クエリのテキストをベクトル化する関数を準備する
+    # ドキュメントと同じ、基本的なベクトル化モデルと本書デフォルトの引数とする
+    vectorize, query_vector_cache = None, None
+    if args.online_vectorization:
+        vectorize = vectorize_with(get_basic_vectorization_model())
+        if args.query_cache_mb > 0:
+            query_vector_cache = QueryVectorCache(
+                max_bytes=args.query_cache_mb * 1024 * 1024
+            )
+            vectorize = query_vector_cache.wrap(vectorize)
+
     # クエリを整形し入力（つまり検索）する
-    tester.input_queries(query_data, 10)
+    tester.input_queries(query_data, 10, vectorize=vectorize)
+
+    # キャッシュの統計情報を表示する
+    if query_vector_cache is not None:
+        for name, value in query_vector_cache.get_stats().items():
+            print(f"{name}: {value}")
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# 検索結果が k 件に満たない場合のスコア。Faissと同じく、FP32の最小値（-FLT_MAX）とする
+MISSING_SCORE = np.finfo(np.float32).min
+
+
+# スコアとドキュメントの通し番号の行列から、クエリ（行）ごとに上位 k 件を残す関数
+# 上位 k 件の中の順序は問わないので、ソートではなく選択（argpartition）で済ませる
+def select_top_k(score_matrix, index_matrix, k):
+    if score_matrix.shape[1] <= k:
+        return score_matrix, index_matrix
+    top_k = np.argpartition(-score_matrix, k - 1, axis=1)[:, :k]
+    return (
+        np.take_along_axis(score_matrix, top_k, axis=1),
+        np.take_along_axis(index_matrix, top_k, axis=1),
+    )
+
+
+# 内積の大きいドキュメントを総当たりで検索する、NumPyによるインデックスのクラス
+# Faissのインデックスと同じく add と search のメソッドを持つので、置き換えて使える
+# ドキュメントベクトルの行列はコピーせず、ブロックごとに読み出して計算するので、
+# メモリマップした行列を入力すれば、必要なメモリはドキュメント数によらず一定となる
+# スレッドあたりのメモリは、おおよそ 16 × クエリのブロック × ドキュメントのブロック バイト
+class BlockedExactIndex:
+
+    # インスタンスを作成する特殊メソッド。行列の積はBLASが既に並列に計算するので、
+    # デフォルトではスレッドプールを使わない（スレッド数を1とする）
+    def __init__(
+        self,
+        dimension,
+        document_block_size=16384,
+        query_block_size=256,
+        threads=1,
+    ):
+        self.d, self.ntotal = dimension, 0
+        self.document_block_size = document_block_size
+        self.query_block_size = query_block_size
+        self.threads = threads
+
+        # 入力されたドキュメントベクトルの行列と、その先頭の通し番号の組のリスト
+        self.matrices = []
+
+    # ドキュメントベクトルの行列を入力するメソッド
+    def add(self, matrix):
+        self.matrices.append((matrix, self.ntotal))
+        self.ntotal += len(matrix)
+
+    # ドキュメントベクトルの行列を、ブロックとその先頭の通し番号の組に分けて返すジェネレータ
+    def iter_document_blocks(self):
+        for matrix, offset in self.matrices:
+            for start in range(0, len(matrix), self.document_block_size):
+                yield matrix[start : start + self.document_block_size], offset + start
+
+    # クエリのブロックとドキュメントのブロックの、内積の上位 k 件を返すメソッド
+    def search_block(self, queries, documents, offset, k):
+        # 量子化したベクトルなども扱えるよう、FP32に変換してから計算する
+        score_matrix = queries @ np.asarray(documents, dtype=np.float32).T
+        index_matrix = np.broadcast_to(
+            np.arange(offset, offset + len(documents)), score_matrix.shape
+        )
+        return select_top_k(score_matrix, index_matrix, k)
+
+    # それまでの上位 k 件と、ドキュメントのブロックの上位 k 件を合わせて選び直すメソッド
+    @staticmethod
+    def merge_block(block_scores, block_indices, block_result, k):
+        scores, indices = block_result
+        return select_top_k(
+            np.hstack([block_scores, scores]),
+            np.hstack([block_indices, indices]),
+            k,
+        )
+
+    # クエリベクトルの行列から、内積の上位 k 件のスコアと通し番号の行列を返すメソッド
+    # k 件に満たない場合、通し番号はFaissと同じく-1とする
+    def search(self, queries, k):
+        queries = np.asarray(queries, dtype=np.float32)
+        score_matrix = np.full((len(queries), k), MISSING_SCORE, dtype=np.float32)
+        index_matrix = np.full((len(queries), k), -1, dtype=np.int64)
+
+        # ドキュメントのブロックを、スレッドプールで並列に計算する
+        # メモリを抑えるため、計算中のブロックはスレッド数までとする
+        with ThreadPoolExecutor(self.threads) as executor:
+            for start in range(0, len(queries), self.query_block_size):
+                end = start + self.query_block_size
+                query_block = queries[start:end]
+                block_scores = score_matrix[start:end]
+                block_indices = index_matrix[start:end]
+
+                # 各ブロックの上位 k 件を、それまでの上位 k 件と合わせて選び直す
+                futures = deque()
+                for documents, offset in self.iter_document_blocks():
+                    if len(futures) == self.threads:
+                        block_scores, block_indices = self.merge_block(
+                            block_scores, block_indices, futures.popleft().result(), k
+                        )
+                    futures.append(
+                        executor.submit(
+                            self.search_block, query_block, documents, offset, k
+                        )
+                    )
+                while futures:
+                    block_scores, block_indices = self.merge_block(
+                        block_scores, block_indices, futures.popleft().result(), k
+                    )
+
+                # 最後に、上位 k 件をスコアの降順にソートする
+                order = np.argsort(-block_scores, axis=1, kind="stable")
+                score_matrix[start:end] = np.take_along_axis(
+                    block_scores, order, axis=1
+                )
+                index_matrix[start:end] = np.take_along_axis(
+                    block_indices, order, axis=1
+                )
+
+        return score_matrix, index_matrix
+
+
+# このコードを直に実行した場合のみ、以下のコードを実行する
+if __name__ == "__main__":
+    from ch01_data_preparation import get_product_catalog
+    from ch02_basic_vectorization import (
+        get_dimension_number_of,
+        get_vector_matrix_of,
+        read_basic_vectorized_data,
+        split_into_query_and_document,
+    )
+
+    import pandas as pd
+
+    # ベクトル化したデータセットをメモリに読み込み、クエリとドキュメントに分割する
+    query_data, document_data = split_into_query_and_document(
+        read_basic_vectorized_data()
+    )
+
+    # ドキュメントの製品カタログを読み込む（なければ保存する）。行IDはインデックスの通し番号と一致する
+    product_catalog = get_product_catalog(document_data)
+
+    # データからベクトルの次元数を取得し、インデックスを作成する
+    index = BlockedExactIndex(get_dimension_number_of(query_data))
+
+    # ドキュメント（ここでは製品タイトル）ベクトルを入力する
+    index.add(get_vector_matrix_of(document_data, "title_vector"))
+
+    # 例として、単一のクエリを取り出し、表示する
+    query_data = query_data[query_data.query_id == 119300]
+    print(query_data.to_string(columns=["query_id", "query"], index=False))
+
+    # クエリベクトルを入力（つまり検索）する
+    ip_matrix, index_matrix = index.search(
+        get_vector_matrix_of(query_data, "query_vector"), 10
+    )
+
+    # ドキュメントの通し番号の行列を、製品タイトルの行列に一括で変換する
+    title_matrix = product_catalog.hydrate(index_matrix, column="product_title")
+
+    # ランキング結果を整形し表示する
+    for titles, ips in zip(title_matrix, ip_matrix):
+        ranking = pd.DataFrame({"score": ips, "product_title": titles})
+        print(
+            ranking.to_string(
+                columns=["score", "product_title"], index=False, max_colwidth=35
+            )
+        )
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
-from sklearn.metrics import ndcg_score
+import numpy as np
+import pandas as pd
 
 
 # ESCIラベルとnDCGの利得の対応
@@ -12,34 +13,99 @@ def esci_label_to_ndcg_gain(esci_label):
     return ESCI_LABEL_TO_NDCG_GAIN[esci_label]
 
 
-# 平均nDCGを計算し表示する関数
-def print_ndcg(data, k=None):
-    total, query_count = 0.0, 0
-
-    # クエリごとに計算する
-    for _, group_by_query in data.groupby("query_id"):
-        # 内部的には、scikit-learnの定義を使う
-        total += ndcg_score(
-            [group_by_query["esci_label"].apply(esci_label_to_ndcg_gain)],
-            [group_by_query["score"]],
-            k=k,
+# 再現率と平均逆順位（MRR）で、適合するとみなすESCIラベル
+RELEVANT_ESCI_LABELS = ["E"]
+
+
+# クエリごとの評価指標（nDCG、再現率、逆順位）を計算し、クエリIDを行とするDataFrameを返す関数
+# クエリごとのループはせず、全体を一度だけソートし、クエリごとの区間で集計する
+def calc_metrics(data, k=None):
+    # クエリID、スコアの降順に並べる。スコアが等しいものはデータの順序のままにする（安定ソート）
+    query_ids = data["query_id"].to_numpy()
+    scores = data["score"].to_numpy(dtype=np.float64)
+    order = np.lexsort((-scores, query_ids))
+    query_ids, scores = query_ids[order], scores[order]
+
+    # ESCIラベルを、ラベルの種類ごとに一度だけ esci_label_to_ndcg_gain で利得に変換する
+    # 未知のラベルは、行ごとに変換していた場合と同じく例外（KeyError）となる
+    # ラベルのない行（コードが-1）は、利得をNaN、適合しないものとする
+    esci_labels = pd.Categorical(data["esci_label"].to_numpy()[order])
+    gains = np.array(
+        [esci_label_to_ndcg_gain(label) for label in esci_labels.categories] + [np.nan]
+    )[esci_labels.codes]
+    relevants = np.r_[esci_labels.categories.isin(RELEVANT_ESCI_LABELS), False][
+        esci_labels.codes
+    ]
+
+    # 各行が属するクエリの番号と、クエリの中での順位（0はじまり）
+    query_starts = np.flatnonzero(np.r_[True, query_ids[1:] != query_ids[:-1]])
+    query_numbers = np.repeat(
+        np.arange(len(query_starts)), np.diff(np.r_[query_starts, len(query_ids)])
+    )
+    positions = np.arange(len(query_ids)) - query_starts[query_numbers]
+
+    # 順位ごとの割引。上位k件より下の順位は0とする
+    discounts = 1.0 / np.log2(positions + 2.0)
+    if k is not None:
+        discounts[positions >= k] = 0.0
+
+    # DCG。scikit-learnと同じく、スコアが等しいドキュメントの間では利得を平均する
+    tie_starts = np.r_[
+        True, (query_ids[1:] != query_ids[:-1]) | (scores[1:] != scores[:-1])
+    ]
+    tie_numbers = np.cumsum(tie_starts) - 1
+    tie_gains = np.bincount(tie_numbers, gains) / np.bincount(tie_numbers)
+    dcgs = np.bincount(query_numbers, tie_gains[tie_numbers] * discounts)
+
+    # 理想的なDCG（IDCG）。クエリごとに利得の降順に並べ直して計算する
+    ideal_gains = gains[np.lexsort((-gains, query_numbers))]
+    idcgs = np.bincount(query_numbers, ideal_gains * discounts)
+
+    # 上位k件の再現率と、最初に適合するドキュメントの逆順位
+    relevants_in_top_k = relevants & (positions < (k or len(positions)))
+    relevant_counts = np.bincount(query_numbers, relevants)
+    top_k_relevant_counts = np.bincount(query_numbers, relevants_in_top_k)
+    first_ranks = np.full(len(query_starts), np.inf)
+    np.minimum.at(
+        first_ranks,
+        query_numbers[relevants_in_top_k],
+        positions[relevants_in_top_k] + 1.0,
+    )
+
+    # IDCGが0のクエリのnDCG、適合するドキュメントのないクエリの再現率は0とする
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return pd.DataFrame(
+            {
+                "ndcg": np.where(idcgs > 0, dcgs / idcgs, 0.0),
+                "recall": np.where(
+                    relevant_counts > 0, top_k_relevant_counts / relevant_counts, 0.0
+                ),
+                "reciprocal_rank": 1.0 / first_ranks,
+            },
+            index=pd.Index(query_ids[query_starts], name="query_id"),
         )
-        query_count += 1
+
+
+# 平均nDCGを計算し表示する関数。クエリごとの評価指標も返す
+def print_ndcg(data, k=None):
+    metrics = calc_metrics(data, k)
 
     # クエリ間の平均をとり、小数点以下3桁まで表示する
-    print(f"Mean nDCG: {total / query_count:.03f}")
+    print(f"Mean nDCG: {metrics['ndcg'].mean():.03f}")
+
+    return metrics
 
 
 # このコードを直に実行した場合のみ、以下のコードを実行する
 if __name__ == "__main__":
     from ch02_basic_vectorization import read_basic_vectorized_data
-    from ch03_vector_search_engines_0_numpy import cos
+    from ch03_vector_search_engines_0_numpy import calc_cos
 
     # ベクトル化したデータセットをメモリに読み込む
     jp_data = read_basic_vectorized_data()
 
     # スコア（ここではコサイン類似度）を計算する
-    jp_data["score"] = jp_data[["query_vector", "title_vector"]].apply(cos, axis=1)
+    jp_data["score"] = calc_cos(jp_data)
 
     # 平均nDCGを計算し表示する
     print_ndcg(jp_data)
@@ -1,80 +1,258 @@
 #!/usr/bin/env python
 
-from ch02_basic_vectorization import split_into_query_and_document
-from ch04_evaluate_search_results_0_ndcg import print_ndcg
+from ch02_basic_vectorization import (
+    get_vector_matrix_of,
+    get_vectors_fingerprint,
+    split_into_query_and_document,
+)
+from ch04_evaluate_search_results_0_ndcg import (
+    RELEVANT_ESCI_LABELS,
+    esci_label_to_ndcg_gain,
+)
+from scipy import sparse
 
+import faiss
 import numpy as np
+import os
 import pandas as pd
 import time
 
 
-# Faissが返したスコアをpandas（pd）DataFrameにまとめる関数
-def format_score_data(k, query_ids, product_ids, score_matrix, index_matrix):
-    # Faissはプレースホルダとして-1を返す。これはPythonでは最後の要素を指すので、
-    # ユニークな製品ID列の最後の要素としてもプレースホルダ（None）を結合する
-    product_ids = pd.concat([product_ids, pd.Series([None])])
-
-    # スコアと、製品IDの通し番号それぞれ「リストのリスト」を単一のリストに結合する
-    scores, indices = score_matrix.ravel(), index_matrix.ravel()
-
-    return pd.DataFrame(
-        {
-            # Faissがクエリあたりk件のドキュメントを返すなら、クエリIDをk回ずつ繰り返す
-            "query_id": np.repeat(list(query_ids), k),
-            # 製品IDの通し番号のリスト（indices）を対応する製品ID列に変換する
-            "product_id": product_ids.iloc[indices],
-            # のちのソートを考慮して、プレースホルダに対するスコアを低い値に置換する
-            "score": [
-                -1e10 if index < 0 else score for score, index in zip(scores, indices)
-            ],
-        }
-    )
+# ラベルを、クエリと製品の通し番号の組から利得を引ける疎行列（qrels）にまとめたクラス
+# Faissが返した製品の通し番号の行列から、DataFrameの結合をせずに評価指標を計算する
+# 同じラベルで多数のインデックスを評価する場合は、インスタンスを使い回す
+class Qrels:
 
+    # インスタンスを作成する特殊メソッド。クエリと製品の通し番号は、与えたIDの列の順序とする
+    def __init__(self, label_data, query_ids, product_ids):
+        self.query_ids = np.asarray(query_ids)
+        query_rows = pd.Index(self.query_ids).get_indexer(label_data["query_id"])
+        product_columns = pd.Index(product_ids).get_indexer(label_data["product_id"])
 
-# ラベルとFaissが返したスコアを単一のDataFrameにまとめる関数
-def merge_label_and_score_data(label_data, score_data):
-    return pd.merge(
-        label_data,
-        score_data,
-        # いずれかのDataFrameにしか存在しない（クエリID、製品ID）のペアも残す（外部結合）
-        on=["query_id", "product_id"],
-        how="outer",
-        # 不明なラベルはI（無関連）、のちのソートを考慮して不明なスコアは最低の値に置換する
-    ).fillna({"esci_label": "I", "score": -2e10})
+        # ESCIラベルを、ラベルの種類ごとに一度だけ esci_label_to_ndcg_gain で利得に変換する
+        # ラベルのない行（コードが-1）は、利得をNaN、適合しないものとする
+        esci_labels = pd.Categorical(label_data["esci_label"])
+        gains = np.array(
+            [esci_label_to_ndcg_gain(label) for label in esci_labels.categories]
+            + [np.nan]
+        )[esci_labels.codes]
+        relevants = np.r_[esci_labels.categories.isin(RELEVANT_ESCI_LABELS), False][
+            esci_labels.codes
+        ]
+
+        # 評価するクエリのラベルだけ残す
+        in_queries = query_rows >= 0
+        query_rows, gains = query_rows[in_queries], gains[in_queries]
+        product_columns, relevants = product_columns[in_queries], relevants[in_queries]
+
+        # クエリ×製品の利得と適合の疎行列。Faissのプレースホルダ-1は、
+        # すべて0の最後の列を指すよう、列を1つ多くしておく
+        in_products = product_columns >= 0
+        coordinates = (query_rows[in_products], product_columns[in_products])
+        shape = (len(self.query_ids), len(product_ids) + 1)
+        self.gain_matrix, self.relevant_matrix = [
+            sparse.csr_matrix((values[in_products], coordinates), shape=shape)
+            for values in [gains, relevants.astype(np.float64)]
+        ]
+
+        # 理想的なDCG（IDCG）を計算するための、クエリごとに降順に並べた利得とその順位
+        order = np.lexsort((-gains, query_rows))
+        self.ideal_rows, self.ideal_gains = query_rows[order], gains[order]
+        row_starts = np.searchsorted(self.ideal_rows, np.arange(len(self.query_ids)))
+        self.ideal_positions = np.arange(len(order)) - row_starts[self.ideal_rows]
+
+        # 再現率を計算するための、クエリごとの適合するドキュメント数
+        self.relevant_counts = np.bincount(
+            query_rows, relevants, minlength=len(self.query_ids)
+        )
+
+    # Faissが返したスコアと製品の通し番号の行列から、クエリごとの評価指標を計算し、
+    # クエリIDを行とするDataFrameを返すメソッド。calc_metrics の結果と同じ形式とする
+    def evaluate(self, k, score_matrix, index_matrix):
+        # プレースホルダのスコアを低い値に置換し、クエリ（行）ごとにスコアの降順に並べる
+        scores = np.where(index_matrix < 0, -1e10, score_matrix)
+        order = np.argsort(-scores, axis=1, kind="stable")
+        scores = np.take_along_axis(scores, order, axis=1)
+        columns = np.take_along_axis(index_matrix, order, axis=1)
+        columns = np.where(columns < 0, self.gain_matrix.shape[1] - 1, columns)
+
+        # 疎行列から、検索結果のそれぞれの利得と適合を引く
+        rows = np.repeat(np.arange(len(columns)), columns.shape[1])
+        gains = np.asarray(self.gain_matrix[rows, columns.ravel()]).ravel()
+        relevants = np.asarray(self.relevant_matrix[rows, columns.ravel()]).ravel()
+
+        # DCG。scikit-learnと同じく、スコアが等しいドキュメントの間では利得を平均する
+        discounts = 1.0 / np.log2(np.arange(columns.shape[1]) + 2.0)
+        discounts[k:] = 0.0
+        tie_starts = np.ones(scores.shape, dtype=bool)
+        tie_starts[:, 1:] = scores[:, 1:] != scores[:, :-1]
+        tie_numbers = np.cumsum(tie_starts.ravel()) - 1
+        tie_gains = np.bincount(tie_numbers, gains) / np.bincount(tie_numbers)
+        dcgs = (tie_gains[tie_numbers].reshape(scores.shape) * discounts).sum(axis=1)
 
+        # 理想的なDCG（IDCG）
+        idcgs = np.bincount(
+            self.ideal_rows,
+            np.where(
+                self.ideal_positions < k,
+                self.ideal_gains / np.log2(self.ideal_positions + 2.0),
+                0.0,
+            ),
+            minlength=len(self.query_ids),
+        )
 
-# Faissの検索結果の平均nDCGを計算し表示する関数
+        # 上位k件の再現率と、最初に適合するドキュメントの逆順位
+        relevants = relevants.reshape(scores.shape) > 0
+        relevants[:, k:] = False
+        first_ranks = np.where(
+            relevants.any(axis=1), relevants.argmax(axis=1) + 1.0, np.inf
+        )
+
+        # IDCGが0のクエリのnDCG、適合するドキュメントのないクエリの再現率は0とする
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return pd.DataFrame(
+                {
+                    "ndcg": np.where(idcgs > 0, dcgs / idcgs, 0.0),
+                    "recall": np.where(
+                        self.relevant_counts > 0,
+                        relevants.sum(axis=1) / self.relevant_counts,
+                        0.0,
+                    ),
+                    "reciprocal_rank": 1.0 / first_ranks,
+                },
+                index=pd.Index(self.query_ids, name="query_id"),
+            )
+
+
+# Faissの検索結果の平均nDCGを計算し表示する関数。クエリごとの評価指標も返す
+# 同じラベルで繰り返し評価する場合は、作成済みのqrelsを与えれば使い回す
 def print_ndcg_for_faiss(
-    k, label_data, query_ids, product_ids, score_matrix, index_matrix
+    k, label_data, query_ids, product_ids, score_matrix, index_matrix, qrels=None
 ):
-    # Faissが返したスコアをDataFrameにまとめる
-    score_data = format_score_data(
-        k, query_ids, product_ids, score_matrix, index_matrix
+    if qrels is None:
+        qrels = Qrels(label_data, query_ids, product_ids)
+    metrics = qrels.evaluate(k, score_matrix, index_matrix)
+
+    # クエリ間の平均をとり、小数点以下3桁まで表示する
+    print(f"Mean nDCG: {metrics['ndcg'].mean():.03f}")
+
+    return metrics
+
+
+# 総当たりの検索結果（正解の上位k件）の保存先。このまま実行した場合は、本書のサンプル
+# コードのディレクトリ code 以下、tmp/exact-top-k にベクトルの行列とkごとに保存する
+EXACT_TOP_K_DIR = os.path.join(os.path.dirname(__file__), "tmp", "exact-top-k")
+
+
+# クエリとドキュメントのベクトルの行列から、総当たりの検索結果を返す関数
+# 同じ行列とkの組なら、前回保存した結果を読み込んで使い回す
+def get_exact_top_k(query_matrix, document_matrix, k):
+    fingerprint = get_vectors_fingerprint(query_matrix, document_matrix)
+    path = os.path.join(EXACT_TOP_K_DIR, f"{fingerprint}-{k}.npz")
+
+    # 保存した結果があれば読み込む
+    if os.path.isfile(path):
+        with np.load(path) as exact_top_k:
+            return exact_top_k["score_matrix"], exact_top_k["index_matrix"]
+
+    # なければ総当たりのFaissインデックスで検索し、保存する
+    faiss_index = faiss.IndexFlatIP(document_matrix.shape[1])
+    faiss_index.add(document_matrix)
+    score_matrix, index_matrix = faiss_index.search(query_matrix, k)
+    os.makedirs(EXACT_TOP_K_DIR, exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(temporary_path, score_matrix=score_matrix, index_matrix=index_matrix)
+    os.replace(temporary_path, path)
+    return score_matrix, index_matrix
+
+
+# ドキュメントを入力済みのFaissインデックスの保存先。このまま実行した場合は、本書のサンプル
+# コードのディレクトリ code 以下、tmp/faiss-indexes にベクトルの行列とパラメータごとに保存する
+FAISS_INDEX_DIR = os.path.join(os.path.dirname(__file__), "tmp", "faiss-indexes")
+
+
+# 保存したFaissインデックスを読み込む関数。対応するインデックスはメモリマップして読み、
+# 対応しないインデックスは通常どおりメモリに読み込む。どちらで読み込んだかを表示する
+# IO_FLAG_MMAP は転置リストだけをマップするので、総当たりやHNSWのベクトルも含めて
+# マップする IO_FLAG_MMAP_IFC を使う
+def read_faiss_index(path):
+    try:
+        faiss_index = faiss.read_index(
+            path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+        )
+        print(f"Loaded (mmap): {path}")
+    except RuntimeError:
+        faiss_index = faiss.read_index(path)
+        print(f"Loaded (read into memory; mmap not supported): {path}")
+    return faiss_index
+
+
+# 作成しただけの（空の）Faissインデックスを訓練し、ドキュメントを入力して返す関数
+# 同じ種類とパラメータのインデックス、同じ行列の組なら、前回保存したものを読み込んで使い回す
+def build_or_read_faiss_index(faiss_index, document_matrix, train_matrix=None):
+    # 空のインデックスをシリアライズしたバイト列は、種類と作成時のパラメータを表す
+    # 検索時のパラメータ（プローブ数など）は、読み込んだあとに設定する
+    fingerprint = get_vectors_fingerprint(
+        faiss.serialize_index(faiss_index),
+        document_matrix,
+        *([] if train_matrix is None else [train_matrix]),
     )
+    path = os.path.join(FAISS_INDEX_DIR, f"{fingerprint}.index")
 
-    # nDCGの利得とFaissが返したスコアを単一のDataFrameにまとめる
-    merged_data = merge_label_and_score_data(label_data, score_data)
+    # 保存したインデックスがあれば読み込む
+    if os.path.isfile(path):
+        return read_faiss_index(path)
 
-    # 平均nDCGを計算し表示する
-    print_ndcg(merged_data, k)
+    # なければ訓練し、ドキュメントを入力して保存する
+    if not faiss_index.is_trained:
+        faiss_index.train(train_matrix)
+    faiss_index.add(document_matrix)
+    os.makedirs(FAISS_INDEX_DIR, exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    faiss.write_index(faiss_index, temporary_path)
+    os.replace(temporary_path, path)
+    return faiss_index
+
+
+# 近似の検索結果が、総当たりの検索結果の上位k件をどれだけ含むか（再現率）をクエリごとに返す関数
+def calc_recall_against_exact(index_matrix, exact_index_matrix):
+    # クエリ（行）ごとに異なる値になるよう通し番号をずらし、まとめて突き合わせる
+    offsets = np.arange(len(index_matrix))[:, np.newaxis] * (
+        max(index_matrix.max(), exact_index_matrix.max()) + 1
+    )
+    found = np.isin(
+        np.where(exact_index_matrix >= 0, exact_index_matrix + offsets, -1),
+        np.where(index_matrix >= 0, index_matrix + offsets, -2),
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return found.sum(axis=1) / (exact_index_matrix >= 0).sum(axis=1)
 
 
 # Faissのインデックスをテストする関数。今後よく使うので関数にまとめた
-def test_faiss(faiss_index, label_data, k, returns_distance=False):
+# クエリごとの評価指標を返す。総当たりの検索結果との比較を指定すれば、その再現率も返す
+def test_faiss(
+    faiss_index,
+    label_data,
+    k,
+    returns_distance=False,
+    qrels=None,
+    compare_with_exact=False,
+):
     # わかりやすいようにFaissインデックスのクラス名を表示する
     print(faiss_index.__class__.__name__)
 
     # データセットをクエリとドキュメントに分割する
     query_data, document_data = split_into_query_and_document(label_data)
 
-    # ドキュメントベクトルを整形し入力する
-    faiss_index.add(np.vstack(document_data["title_vector"]))
+    # ドキュメントベクトルを整形し入力する。入力済みのインデックスなら入力しない
+    document_matrix = get_vector_matrix_of(document_data, "title_vector")
+    if faiss_index.ntotal == 0:
+        faiss_index.add(document_matrix)
 
     # クエリベクトルを整形し入力（つまり検索）する。また処理にかかった時間も測定する
+    query_matrix = get_vector_matrix_of(query_data, "query_vector")
     search_started_at = time.perf_counter()
-    score_matrix, index_matrix = faiss_index.search(
-        np.vstack(query_data["query_vector"]), k
-    )
+    score_matrix, index_matrix = faiss_index.search(query_matrix, k)
     search_finished_at = time.perf_counter()
 
     # 処理にかかった時間を計算し、マイクロ秒（小数点以下6桁）まで表示する
@@ -85,15 +263,26 @@ def test_faiss(faiss_index, label_data, k, returns_distance=False):
         score_matrix *= -1
 
     # 平均nDCGを計算し表示する
-    print_ndcg_for_faiss(
+    metrics = print_ndcg_for_faiss(
         k,
         label_data,
         query_data["query_id"],
         document_data["product_id"],
         score_matrix,
         index_matrix,
+        qrels,
     )
 
+    # 指定があれば、総当たりの検索結果に対する再現率を計算し、クエリ間の平均を表示する
+    if compare_with_exact:
+        _, exact_index_matrix = get_exact_top_k(query_matrix, document_matrix, k)
+        metrics["exact_recall"] = calc_recall_against_exact(
+            index_matrix, exact_index_matrix
+        )
+        print(f"Mean Recall@{k} (vs exact): {metrics['exact_recall'].mean():.03f}")
+
+    return metrics
+
 
 # このコードを直に実行した場合のみ、以下のコードを実行する
 if __name__ == "__main__":
@@ -102,8 +291,6 @@ if __name__ == "__main__":
         read_basic_vectorized_data,
     )
 
-    import faiss
-
     # ベクトル化したデータセットをメモリに読み込む
     jp_data = read_basic_vectorized_data()
 
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+from ch02_basic_vectorization import (
+    get_vector_matrix_of,
+    split_into_query_and_document,
+)
+from ch04_evaluate_search_results_1_faiss import (
+    Qrels,
+    calc_recall_against_exact,
+    get_exact_top_k,
+)
+from datetime import datetime
+
+import faiss
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import time
+
+
+# ベンチマークの結果の保存先。このまま実行した場合は、本書のサンプルコードの
+# ディレクトリ code 以下、tmp/benchmark-report.parquet に、実行のたびに追記する
+BENCHMARK_REPORT_PATH = os.path.join(
+    os.path.dirname(__file__), "tmp", "benchmark-report.parquet"
+)
+
+
+# 総当たりのインデックスを作成する関数（第3章）
+def make_flat_index(dimension):
+    return faiss.IndexFlatIP(dimension)
+
+
+# スカラ量子化したインデックスを作成する関数（第7章）
+def make_scalar_quantizer_index(dimension):
+    return faiss.IndexScalarQuantizer(
+        dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+    )
+
+
+# LSHのインデックスを作成する関数（第8章）
+def make_lsh_index(dimension, dimensions_of_output=96):
+    return faiss.IndexLSH(dimension, dimensions_of_output)
+
+
+# IVFのインデックスを作成する関数（第9章）
+def make_ivf_index(dimension, number_of_centroids=4, number_of_probes=1):
+    faiss_index = faiss.IndexIVFFlat(
+        faiss.IndexFlatIP(dimension),
+        dimension,
+        number_of_centroids,
+        faiss.METRIC_INNER_PRODUCT,
+    )
+    faiss_index.nprobe = number_of_probes
+    return faiss_index
+
+
+# HNSWのインデックスを作成する関数（第10章）
+def make_hnsw_index(dimension, number_of_neighbors=8):
+    return faiss.IndexHNSWFlat(
+        dimension, number_of_neighbors, faiss.METRIC_INNER_PRODUCT
+    )
+
+
+# ベンチマークする構成。構成名から、インデックスを作成する関数と、
+# そのインデックスが距離を返すかどうかの組への連想配列
+BENCHMARK_CONFIGURATIONS = {
+    "Flat": (make_flat_index, False),
+    "SQ8": (make_scalar_quantizer_index, False),
+    "LSH96": (make_lsh_index, True),
+    "IVF4,nprobe=1": (make_ivf_index, False),
+    "HNSW8": (make_hnsw_index, False),
+}
+
+
+# クエリを1件ずつ検索し、レイテンシ（ミリ秒）の分位点を連想配列で返す関数
+def measure_latencies(faiss_index, query_matrix, k, latency_query_count=1000):
+    latencies = []
+    for query_vector in query_matrix[:latency_query_count]:
+        search_started_at = time.perf_counter()
+        faiss_index.search(query_vector[np.newaxis], k)
+        latencies.append(time.perf_counter() - search_started_at)
+    return {
+        f"p{percentile}_latency_ms": latency
+        for percentile, latency in zip(
+            [50, 95, 99], np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+        )
+    }
+
+
+# 単一の構成をベンチマークし、結果を連想配列で返す関数
+def benchmark_index(
+    faiss_index,
+    returns_distance,
+    train_matrix,
+    document_matrix,
+    query_matrix,
+    qrels,
+    k=10,
+    thread_counts=sorted({1, multiprocessing.cpu_count()}),
+    latency_query_count=1000,
+):
+    result = {"index_class": faiss_index.__class__.__name__}
+
+    # 測定ごとにスレッド数を明示して設定し、終わったら元のスレッド数に戻す
+    original_thread_count = faiss.omp_get_max_threads()
+    try:
+        # 訓練（キャリブレーションやクラスタリング）と、ドキュメントの入力にかかる時間
+        # 元のスレッド数で測定する
+        faiss.omp_set_num_threads(original_thread_count)
+        train_started_at = time.perf_counter()
+        if not faiss_index.is_trained:
+            faiss_index.train(train_matrix)
+        add_started_at = time.perf_counter()
+        faiss_index.add(document_matrix)
+        add_finished_at = time.perf_counter()
+        result["train_seconds"] = add_started_at - train_started_at
+        result["add_seconds"] = add_finished_at - add_started_at
+
+        # インデックスのバイト数。シリアライズした大きさとする
+        result["index_bytes"] = len(faiss.serialize_index(faiss_index))
+
+        # すべてのクエリをまとめて検索した場合のスループット（1秒あたりのクエリ数）
+        # スレッド数ごとに測定し、最後に測定した検索結果を評価に使う
+        for thread_count in thread_counts:
+            faiss.omp_set_num_threads(thread_count)
+            search_started_at = time.perf_counter()
+            score_matrix, index_matrix = faiss_index.search(query_matrix, k)
+            search_seconds = time.perf_counter() - search_started_at
+            result[f"qps_{thread_count}_threads"] = len(query_matrix) / search_seconds
+
+        # クエリを1件ずつ検索した場合のレイテンシ（ミリ秒）の分位点
+        # スループットを最後に測定したのと同じ、最大のスレッド数で測定する
+        faiss.omp_set_num_threads(max(thread_counts))
+        result.update(
+            measure_latencies(faiss_index, query_matrix, k, latency_query_count)
+        )
+    finally:
+        faiss.omp_set_num_threads(original_thread_count)
+
+    # 距離を返すインデックスの場合は、距離の符号を反転させてスコアとする
+    if returns_distance:
+        score_matrix = -score_matrix
+
+    # 平均nDCG、ラベルにもとづく再現率、総当たりの検索結果に対する再現率
+    metrics = qrels.evaluate(k, score_matrix, index_matrix)
+    _, exact_index_matrix = get_exact_top_k(query_matrix, document_matrix, k)
+    result["ndcg"] = metrics["ndcg"].mean()
+    result["recall"] = metrics["recall"].mean()
+    result["exact_recall"] = calc_recall_against_exact(
+        index_matrix, exact_index_matrix
+    ).mean()
+
+    return result
+
+
+# すべての構成をベンチマークし、結果をDataFrameで返す関数
+def run_benchmark(jp_data, configuration_names=list(BENCHMARK_CONFIGURATIONS), k=10):
+    # データセットをクエリとドキュメントに分割し、それぞれ行列にする
+    query_data, document_data = split_into_query_and_document(jp_data)
+    query_matrix = get_vector_matrix_of(query_data, "query_vector")
+    document_matrix = get_vector_matrix_of(document_data, "title_vector")
+
+    # 訓練データは、訓練データ上のドキュメント（製品タイトル）ベクトル列とする
+    train_matrix = get_vector_matrix_of(
+        jp_data[jp_data.split == "train"], "title_vector"
+    )
+
+    # ラベルは、すべての構成で共通のものを使い回す
+    qrels = Qrels(jp_data, query_data["query_id"], document_data["product_id"])
+
+    results = []
+    for configuration_name in configuration_names:
+        print(configuration_name)
+        make_index, returns_distance = BENCHMARK_CONFIGURATIONS[configuration_name]
+        result = benchmark_index(
+            make_index(document_matrix.shape[1]),
+            returns_distance,
+            train_matrix,
+            document_matrix,
+            query_matrix,
+            qrels,
+            k=k,
+        )
+        results.append({"configuration": configuration_name, **result})
+
+    return pd.DataFrame(results)
+
+
+# ベンチマークの結果を、実行日時とともに保存済みの結果に追記する関数
+def write_benchmark_report(report, path=BENCHMARK_REPORT_PATH):
+    report.insert(0, "run_at", pd.Timestamp(datetime.now()))
+    if os.path.isfile(path):
+        report = pd.concat(
+            [
+                pd.read_parquet(
+                    path,
+                    engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
+                ),
+                report,
+            ],
+            ignore_index=True,
+        )
+
+    # 書き込みの途中で中断しても以前の結果が壊れないよう、一時ファイルに書いてから置き換える
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    report.to_parquet(
+        temporary_path,
+        index=False,
+        engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
+    )
+    os.replace(temporary_path, path)
+
+
+# このコードを直に実行した場合のみ、以下のコードを実行する
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from ch07_vector_compression_0_data import read_tuned_vectorized_data
+
+    # コマンドライン引数から、ベンチマークする構成を読み込む。指定がなければすべて
+    argument_parser = ArgumentParser()
+    argument_parser.add_argument(
+        "--configurations",
+        nargs="+",
+        default=list(BENCHMARK_CONFIGURATIONS),
+        choices=list(BENCHMARK_CONFIGURATIONS),
+    )
+    args = argument_parser.parse_args()
+
+    # ベクトル化したデータセットをメモリに読み込み、ベンチマークする
+    report = run_benchmark(read_tuned_vectorized_data(), args.configurations)
+
+    # 結果を表示し、保存する
+    print(report.to_string(index=False))
+    write_benchmark_report(report)
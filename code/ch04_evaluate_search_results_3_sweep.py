@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+from ch02_basic_vectorization import (
+    get_vector_matrix_of,
+    split_into_query_and_document,
+)
+from ch04_evaluate_search_results_1_faiss import (
+    Qrels,
+    calc_recall_against_exact,
+    get_exact_top_k,
+)
+from ch04_evaluate_search_results_2_benchmark import (
+    make_hnsw_index,
+    make_ivf_index,
+    make_lsh_index,
+    measure_latencies,
+)
+from itertools import product
+
+import faiss
+import numpy as np
+import os
+import pandas as pd
+import time
+
+
+# スイープの結果の保存先。このまま実行した場合は、本書のサンプルコードの
+# ディレクトリ code 以下、tmp/sweep-report.parquet に保存する
+SWEEP_REPORT_PATH = os.path.join(
+    os.path.dirname(__file__), "tmp", "sweep-report.parquet"
+)
+
+
+# インデックスの種類ごとの探索空間。インデックスを作成する関数、距離を返すかどうか、
+# 作成時（訓練が必要）のパラメータの候補、検索時のパラメータの候補の組とする
+# 検索時のパラメータは、訓練したインデックスを使い回して変える
+SWEEP_SPACES = {
+    "IVF": (
+        make_ivf_index,
+        False,
+        {"number_of_centroids": [4, 16, 64, 256]},
+        {"nprobe": [1, 2, 4, 8, 16, 32]},
+    ),
+    "HNSW": (
+        make_hnsw_index,
+        False,
+        {"number_of_neighbors": [4, 8, 16, 32]},
+        {"efSearch": [16, 32, 64, 128, 256]},
+    ),
+    "LSH": (
+        make_lsh_index,
+        True,
+        {"dimensions_of_output": [32, 64, 96, 128, 256]},
+        {},
+    ),
+}
+
+
+# パラメータの候補の連想配列から、すべての組み合わせ（グリッド）のリストを返す関数
+def make_grid(candidates):
+    return [dict(zip(candidates, values)) for values in product(*candidates.values())]
+
+
+# 作成時と検索時のパラメータの組み合わせのリストを返す関数。サンプル数の指定があれば、
+# グリッドから無作為に選ぶ（ランダムサーチ）。作成時のパラメータが同じものはまとめる
+def make_sweep_points(build_candidates, search_candidates, sample_count=None, seed=0):
+    points = list(product(make_grid(build_candidates), make_grid(search_candidates)))
+    if sample_count is not None and sample_count < len(points):
+        rows = np.random.default_rng(seed).choice(
+            len(points), sample_count, replace=False
+        )
+        points = [points[row] for row in sorted(rows)]
+
+    grouped_points = {}
+    for build_parameters, search_parameters in points:
+        key = tuple(build_parameters.items())
+        grouped_points.setdefault(key, []).append(search_parameters)
+    return [(dict(key), values) for key, values in grouped_points.items()]
+
+
+# インデックスの種類ごとにパラメータをスイープし、結果をDataFrameで返す関数
+def run_sweep(
+    jp_data, family_names=list(SWEEP_SPACES), k=10, sample_count=None, seed=0
+):
+    # データセットをクエリとドキュメントに分割し、それぞれ行列にする
+    query_data, document_data = split_into_query_and_document(jp_data)
+    query_matrix = get_vector_matrix_of(query_data, "query_vector")
+    document_matrix = get_vector_matrix_of(document_data, "title_vector")
+    train_matrix = get_vector_matrix_of(
+        jp_data[jp_data.split == "train"], "title_vector"
+    )
+
+    # ラベルと総当たりの検索結果は、すべての組み合わせで共通のものを使い回す
+    qrels = Qrels(jp_data, query_data["query_id"], document_data["product_id"])
+    _, exact_index_matrix = get_exact_top_k(query_matrix, document_matrix, k)
+
+    results = []
+    for family_name in family_names:
+        make_index, returns_distance, build_candidates, search_candidates = (
+            SWEEP_SPACES[family_name]
+        )
+        for build_parameters, search_parameter_list in make_sweep_points(
+            build_candidates, search_candidates, sample_count, seed
+        ):
+            print(family_name, build_parameters)
+
+            # インデックスを作成し、訓練し、ドキュメントを入力する
+            build_started_at = time.perf_counter()
+            faiss_index = make_index(document_matrix.shape[1], **build_parameters)
+            if not faiss_index.is_trained:
+                faiss_index.train(train_matrix)
+            faiss_index.add(document_matrix)
+            build_seconds = time.perf_counter() - build_started_at
+
+            # 検索時のパラメータだけを変えながら、同じインデックスで検索する
+            parameter_space = faiss.ParameterSpace()
+            for search_parameters in search_parameter_list:
+                for name, value in search_parameters.items():
+                    parameter_space.set_index_parameter(faiss_index, name, value)
+
+                search_started_at = time.perf_counter()
+                score_matrix, index_matrix = faiss_index.search(query_matrix, k)
+                search_seconds = time.perf_counter() - search_started_at
+
+                # 距離を返すインデックスの場合は、距離の符号を反転させてスコアとする
+                if returns_distance:
+                    score_matrix = -score_matrix
+                metrics = qrels.evaluate(k, score_matrix, index_matrix)
+
+                results.append(
+                    {
+                        "family": family_name,
+                        "parameters": str({**build_parameters, **search_parameters}),
+                        "build_seconds": build_seconds,
+                        "qps": len(query_matrix) / search_seconds,
+                        **measure_latencies(faiss_index, query_matrix, k),
+                        "ndcg": metrics["ndcg"].mean(),
+                        "recall": metrics["recall"].mean(),
+                        "exact_recall": calc_recall_against_exact(
+                            index_matrix, exact_index_matrix
+                        ).mean(),
+                    }
+                )
+
+    return pd.DataFrame(results)
+
+
+# スイープの結果から、再現率とレイテンシのパレート最適な組み合わせを返す関数
+# レイテンシの昇順に並べ、それまでのどの組み合わせよりも再現率の高いものだけを残す
+def get_pareto_frontier(
+    results, recall_column="exact_recall", latency_column="p50_latency_ms"
+):
+    results = results.sort_values(
+        [latency_column, recall_column], ascending=[True, False]
+    )
+    recalls = results[recall_column].to_numpy()
+    best_recalls = np.maximum.accumulate(np.r_[-np.inf, recalls[:-1]])
+    return results[recalls > best_recalls]
+
+
+# このコードを直に実行した場合のみ、以下のコードを実行する
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from ch07_vector_compression_0_data import read_tuned_vectorized_data
+
+    # コマンドライン引数を読み込む
+    argument_parser = ArgumentParser()
+    # スイープするインデックスの種類。指定がなければすべて
+    argument_parser.add_argument(
+        "--families",
+        nargs="+",
+        default=list(SWEEP_SPACES),
+        choices=list(SWEEP_SPACES),
+    )
+    # 種類ごとに無作為に選ぶ組み合わせの数。指定がなければすべての組み合わせ
+    argument_parser.add_argument("--sample-count", default=None, type=int)
+    # 目標とする、総当たりの検索結果に対する再現率
+    argument_parser.add_argument("--target-recall", default=0.9, type=float)
+    args = argument_parser.parse_args()
+
+    # ベクトル化したデータセットをメモリに読み込み、スイープする
+    results = run_sweep(
+        read_tuned_vectorized_data(), args.families, sample_count=args.sample_count
+    )
+    results.to_parquet(
+        SWEEP_REPORT_PATH,
+        index=False,
+        engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
+    )
+
+    # パレート最適な組み合わせのうち、目標の再現率を満たすものを表示する
+    frontier = get_pareto_frontier(results)
+    print(
+        frontier[frontier.exact_recall >= args.target_recall].to_string(
+            columns=["family", "parameters", "p50_latency_ms", "exact_recall", "ndcg"],
+            index=False,
+        )
+    )
@@ -1,19 +1,20 @@
 #!/usr/bin/env python
 
 from ch02_basic_vectorization import vectorize_with
-from ch03_vector_search_engines_0_numpy import cos
+from ch03_vector_search_engines_0_numpy import calc_cos
 from ch04_evaluate_search_results_0_ndcg import print_ndcg
 
 
 # ベクトル化、スコアの計算、平均nDCGの計算と表示を一気に行う関数
 def evaluate(model, data):
     # クエリとドキュメント（ここでは製品タイトル）をベクトル化する
-    vectorize = vectorize_with(model=model)
+    # 同じモデルで一度ベクトル化したテキストは、キャッシュから再利用する
+    vectorize = vectorize_with(model=model, use_cache=True)
     data["query_vector"] = vectorize(data["query"])
     data["title_vector"] = vectorize(data["product_title"])
 
     # スコア（ここではコサイン類似度）を計算する
-    data["score"] = data[["query_vector", "title_vector"]].apply(cos, axis=1)
+    data["score"] = calc_cos(data)
 
     # 平均nDCGを計算し表示する
     print_ndcg(data)
@@ -1,23 +1,95 @@
 #!/usr/bin/env python
 
 from ch02_basic_vectorization import vectorize_with
-from ch03_vector_search_engines_0_numpy import cos
+from ch03_vector_search_engines_0_numpy import calc_cos
 from ch04_evaluate_search_results_0_ndcg import print_ndcg
+from ch05_advanced_vectorization_0_tune import TUNED_VECTORIZATION_MODEL_PATH
+from sentence_transformers import (
+    export_dynamic_quantized_onnx_model,
+    SentenceTransformer,
+)
+
+import os
+import time
+
+
+# ファインチューニング後のベクトル化モデルをONNX形式に変換したものの保存先
+# このまま実行した場合は、本書のサンプルコードのディレクトリ code 以下、
+# tmp/tuned-vectorization-model-onnx に保存する
+TUNED_ONNX_MODEL_PATH = os.path.join(
+    os.path.dirname(__file__), "tmp", "tuned-vectorization-model-onnx"
+)
+
+
+# 動的INT8量子化したONNXモデルのファイル名。量子化の設定（CPUの命令セット）ごとに異なる
+def get_quantized_onnx_file_name(quantization_config):
+    return os.path.join("onnx", f"model_qint8_{quantization_config}.onnx")
+
+
+# ファインチューニング後のベクトル化モデルをONNX形式に変換し、さらに重みを動的にINT8に
+# 量子化したものも保存する関数
+def export_tuned_onnx_model(quantization_config="avx512_vnni"):
+    # ファインチューニング後のベクトル化モデルがなければ、例外をあげる
+    if not os.path.isdir(TUNED_VECTORIZATION_MODEL_PATH):
+        raise ValueError(
+            "ファインチューニング後のベクトル化モデルがありません（第5章を参照）"
+        )
+
+    # ONNX Runtimeをバックエンドとして読み込む。このときONNX形式に変換される
+    model = SentenceTransformer(
+        TUNED_VECTORIZATION_MODEL_PATH, backend="onnx", trust_remote_code=True
+    )
+    model.save_pretrained(TUNED_ONNX_MODEL_PATH)
+
+    # 重みを動的にINT8に量子化したものも保存する
+    export_dynamic_quantized_onnx_model(
+        model, quantization_config, TUNED_ONNX_MODEL_PATH
+    )
+
+
+# ONNX形式のファインチューニング後のベクトル化モデルを読み込む関数
+# quantization_configを指定すると、その設定で動的INT8量子化したものを読み込む
+# いずれもSentenceTransformerのインスタンスなので、vectorize_withにそのまま渡せる
+def get_tuned_onnx_model(quantization_config=None):
+    file_name = os.path.join("onnx", "model.onnx")
+    if quantization_config is not None:
+        file_name = get_quantized_onnx_file_name(quantization_config)
+
+    # まだ変換していなければ、変換する
+    if not os.path.isfile(os.path.join(TUNED_ONNX_MODEL_PATH, file_name)):
+        export_tuned_onnx_model(quantization_config or "avx512_vnni")
+
+    return SentenceTransformer(
+        TUNED_ONNX_MODEL_PATH,
+        backend="onnx",
+        trust_remote_code=True,
+        model_kwargs={"file_name": file_name},
+    )
 
 
 # ベクトル化、スコアの計算、平均nDCGの計算と表示を一気に行う関数
-def evaluate(model, data):
+def evaluate(model, data, max_tokens_per_batch=None):
     # クエリとドキュメント（ここでは製品タイトル）をベクトル化する
     vectorize = vectorize_with(
         model=model,
         # とくに、大きめのバッチサイズを指定する
         args={"batch_size": 64, "show_progress_bar": True},
+        # 指定があれば、行数ではなくトークン数の上限でバッチを組む
+        max_tokens_per_batch=max_tokens_per_batch,
     )
+    vectorize_started_at = time.perf_counter()
     data["query_vector"] = vectorize(data["query"])
     data["title_vector"] = vectorize(data["product_title"])
+    vectorize_finished_at = time.perf_counter()
+
+    # スループット（1秒あたりにベクトル化したテキスト数）を計算し表示する
+    # 重複排除してからベクトル化するので、ユニークなテキスト数で割る
+    text_count = data["query"].nunique() + data["product_title"].nunique()
+    throughput = text_count / (vectorize_finished_at - vectorize_started_at)
+    print(f"Throughput: {throughput:.01f} texts/s")
 
     # スコア（ここではコサイン類似度）を計算する
-    data["score"] = data[["query_vector", "title_vector"]].apply(cos, axis=1)
+    data["score"] = calc_cos(data)
 
     # 平均nDCGを計算し表示する
     print_ndcg(data)
@@ -34,15 +106,45 @@ if __name__ == "__main__":
     argument_parser.add_argument(
         "--sample-rate", default=0.01, type=float, choices=[0.01, 1.0]
     )
+    # バッチあたりのトークン数（パディングを含む）の上限。指定がなければバッチサイズで組む
+    argument_parser.add_argument("--max-tokens-per-batch", default=None, type=int)
+    # ONNXモデルの動的INT8量子化の設定。実行するCPUが対応する命令セットを選ぶ
+    argument_parser.add_argument(
+        "--onnx-quantization-config",
+        default="avx512_vnni",
+        choices=["arm64", "avx2", "avx512", "avx512_vnni"],
+    )
     args = argument_parser.parse_args()
 
     # テストデータを読み込む
     jp_test_data = read_jp_data(split="test", sample_rate=args.sample_rate)
 
+    # ファインチューニング後のモデルを量子化せずに、平均nDCGを表示する
+    print("After fine-tuning (FP32)")
+    evaluate(get_tuned_vectorization_model(), jp_test_data, args.max_tokens_per_batch)
+
     # ファインチューニング後のモデルをBF16に量子化し、平均nDCGを表示する
     print("After fine-tuning (BF16)")
-    evaluate(get_tuned_vectorization_model().bfloat16(), jp_test_data)
+    evaluate(
+        get_tuned_vectorization_model().bfloat16(),
+        jp_test_data,
+        args.max_tokens_per_batch,
+    )
 
     # ファインチューニング後のモデルをFP16に量子化し、平均nDCGを表示する
     print("After fine-tuning (FP16)")
-    evaluate(get_tuned_vectorization_model().half(), jp_test_data)
+    evaluate(
+        get_tuned_vectorization_model().half(), jp_test_data, args.max_tokens_per_batch
+    )
+
+    # ファインチューニング後のモデルをONNX形式に変換し、平均nDCGを表示する
+    print("After fine-tuning (ONNX FP32)")
+    evaluate(get_tuned_onnx_model(), jp_test_data, args.max_tokens_per_batch)
+
+    # さらに重みを動的にINT8に量子化し、平均nDCGを表示する
+    print("After fine-tuning (ONNX INT8)")
+    evaluate(
+        get_tuned_onnx_model(args.onnx_quantization_config),
+        jp_test_data,
+        args.max_tokens_per_batch,
+    )
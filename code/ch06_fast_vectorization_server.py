@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+from collections import Counter, deque
+
+import asyncio
+import numpy as np
+import time
+
+
+# 埋め込みサーバーのデフォルトのベクトル化の引数。1件ずつ届くので進捗は表示しない
+DEFAULT_SERVER_ARGS = {"show_progress_bar": False}
+
+
+# 1件ずつ届くテキストのベクトル化の要求を、少しだけ待ってまとめて（マイクロバッチにして）
+# モデルに推論させるクラス。asyncioのイベントループの中で使う
+class EmbeddingServer:
+
+    # インスタンスを作成する特殊メソッド
+    # クエリのベクトルのキャッシュ（QueryVectorCache）を与えれば、推論の前に参照する
+    def __init__(
+        self,
+        model,
+        args=DEFAULT_SERVER_ARGS,
+        max_wait=0.002,
+        max_batch_size=64,
+        cache=None,
+    ):
+        self.model, self.args, self.cache = model, args, cache
+
+        # 最初の要求からバッチを締め切るまでの最大の待ち時間（秒）と、最大のバッチサイズ
+        self.max_wait, self.max_batch_size = max_wait, max_batch_size
+
+        # 推論待ちのテキストのキューと、テキストから推論結果を待つFutureへの連想配列
+        # 同じテキストの要求が重なった場合は、同じFutureを共有して推論を1回で済ませる
+        self.queue, self.pending = None, {}
+
+        # 統計情報。バッチサイズごとのバッチ数と、直近の要求のレイテンシ（秒）
+        self.batch_size_counts = Counter()
+        self.latencies = deque(maxlen=100000)
+
+    # サーバーを開始するメソッド（非同期）
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.batching_task = asyncio.create_task(self.run_batching())
+
+    # サーバーを停止するメソッド（非同期）
+    # 推論待ちのテキストはキューから捨て、その結果を待つ要求には例外を返す
+    async def stop(self):
+        self.batching_task.cancel()
+        await asyncio.gather(self.batching_task, return_exceptions=True)
+
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(RuntimeError("埋め込みサーバーが停止しました"))
+        self.pending.clear()
+
+    # 単一のテキストをベクトル化するメソッド（非同期）
+    async def vectorize(self, text):
+        started_at = time.perf_counter()
+
+        # キャッシュにあれば、推論せずに返す。キャッシュとはベクトルがそろうよう、
+        # 正規化したテキストを推論する
+        if self.cache is not None:
+            text = self.cache.normalize(text)
+            vector = self.cache.get(text)
+            if vector is not None:
+                self.latencies.append(time.perf_counter() - started_at)
+                return vector
+
+        # 同じテキストが推論待ちでなければ、キューに入れる
+        future = self.pending.get(text)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[text] = future
+            self.queue.put_nowait(text)
+
+        # 推論結果を待つ。ほかの要求と共有するFutureなので、キャンセルが伝わらないようにする
+        vector = await asyncio.shield(future)
+        self.latencies.append(time.perf_counter() - started_at)
+        return vector
+
+    # キューからテキストを取り出してバッチにまとめ、推論し続けるメソッド（非同期）
+    async def run_batching(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # 最初のテキストが届くまで待つ
+            texts = [await self.queue.get()]
+
+            # 最大の待ち時間が過ぎるか、最大のバッチサイズに達するまで、テキストを集める
+            deadline = loop.time() + self.max_wait
+            while len(texts) < self.max_batch_size:
+                if not self.queue.empty():
+                    texts.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    texts.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_size_counts[len(texts)] += 1
+
+            # 推論する。イベントループを止めないよう、別のスレッドで行う
+            try:
+                vectors = await asyncio.to_thread(self.model.encode, texts, **self.args)
+            except Exception as exception:
+                for text in texts:
+                    self.pending.pop(text).set_exception(exception)
+                continue
+
+            # それぞれの要求に推論結果を返す
+            for text, vector in zip(texts, vectors):
+                if self.cache is not None:
+                    self.cache.put(text, vector)
+                self.pending.pop(text).set_result(vector)
+
+    # 統計情報を返すメソッド。キューの長さ、バッチサイズの分布、レイテンシの分位点
+    def get_stats(self):
+        latencies = np.array(self.latencies) * 1000
+        p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (None,) * 2
+        cache_stats = {} if self.cache is None else self.cache.get_stats()
+        return {
+            **{f"cache_{name}": value for name, value in cache_stats.items()},
+            "queue_depth": self.queue.qsize(),
+            "batch_size_histogram": dict(sorted(self.batch_size_counts.items())),
+            "p50_latency_ms": p50,
+            "p99_latency_ms": p99,
+        }
+
+
+# このコードを直に実行した場合のみ、以下のコードを実行する
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from ch01_data_preparation import read_jp_data
+    from ch02_basic_vectorization import (
+        QueryVectorCache,
+        get_basic_vectorization_model,
+    )
+
+    # コマンドライン引数を読み込む
+    argument_parser = ArgumentParser()
+    # 模擬的に送る要求の頻度（1秒あたりの要求数）
+    argument_parser.add_argument("--qps", default=500.0, type=float)
+    # バッチを締め切るまでの最大の待ち時間（ミリ秒）と、最大のバッチサイズ
+    argument_parser.add_argument("--max-wait-ms", default=2.0, type=float)
+    argument_parser.add_argument("--max-batch-size", default=64, type=int)
+    # クエリのベクトルのキャッシュの容量（MiB）。0ならキャッシュしない
+    argument_parser.add_argument("--query-cache-mb", default=64, type=int)
+    args = argument_parser.parse_args()
+
+    # 題材のデータセットのクエリを、検索される順序とみなす
+    queries = list(read_jp_data(sample_rate=0.01)["query"])
+
+    # 埋め込みサーバーを動かし、クエリを1件ずつ、一定の頻度で送る（非同期）
+    async def main():
+        server = EmbeddingServer(
+            get_basic_vectorization_model(),
+            max_wait=args.max_wait_ms / 1000,
+            max_batch_size=args.max_batch_size,
+            cache=(
+                QueryVectorCache(max_bytes=args.query_cache_mb * 1024 * 1024)
+                if args.query_cache_mb > 0
+                else None
+            ),
+        )
+        await server.start()
+
+        # i番目のクエリは、i / qps 秒後に送る
+        async def send(i, query):
+            await asyncio.sleep(i / args.qps)
+            return await server.vectorize(query)
+
+        await asyncio.gather(*[send(i, query) for i, query in enumerate(queries)])
+        await server.stop()
+
+        # 統計情報を表示する
+        for name, value in server.get_stats().items():
+            print(f"{name}: {value}")
+
+    asyncio.run(main())
@@ -1,11 +1,37 @@
 #!/usr/bin/env python
 
+from ch01_data_preparation import get_jp_data_snapshot_path, iter_jp_data, read_jp_data
+from ch02_basic_vectorization import (
+    DEFAULT_ARGS,
+    FEATURE_CACHE_ARGS,
+    count_tokens,
+    encode_features,
+    get_model_fingerprint,
+    get_vector_matrix_of,
+    get_vector_matrix_path,
+    make_token_budget_batches,
+    open_embedding_cache,
+    pad_features,
+    read_vectorized_data,
+    set_vector_matrix,
+    tokenize_texts,
+    vectorize_with,
+    write_vectorized_data,
+)
+from queue import Empty, Queue
+from tqdm import tqdm
+
+import json
+import numpy as np
 import os
 import pandas as pd
-
+import pyarrow.parquet as pq
+import shutil
+import threading
 
 # ファインチューニング後のモデルでベクトル化したデータの保存先。このまま実行した場合は、
 # 本書のサンプルコードのディレクトリ code 以下、tmp/tuned-vectorized.parquet に保存する
+# ベクトルの列は、tmp/tuned-vectorized.query_vector.npy などに保存する
 TUNED_VECTORIZED_PARQUET_PATH = os.path.join(
     os.path.dirname(__file__), "tmp", "tuned-vectorized.parquet"
 )
@@ -13,31 +39,339 @@ TUNED_VECTORIZED_PARQUET_PATH = os.path.join(
 
 # ベクトル化したデータを保存する関数
 def write_tuned_vectorized_data(data):
-    data.to_parquet(
-        TUNED_VECTORIZED_PARQUET_PATH,
-        index=False,
-        engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
-    )
+    write_vectorized_data(data, TUNED_VECTORIZED_PARQUET_PATH)
 
 
 # ベクトル化したデータを読み込む関数
 def read_tuned_vectorized_data():
     # ファイルが存在すれば読み込む
     if os.path.isfile(TUNED_VECTORIZED_PARQUET_PATH):
-        return pd.read_parquet(
-            TUNED_VECTORIZED_PARQUET_PATH,
-            engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
-        )
+        return read_vectorized_data(TUNED_VECTORIZED_PARQUET_PATH)
 
     # 存在しなければ例外をあげる
     raise ValueError("事前にベクトル化したデータがありません（第7章を参照）")
 
 
+# 以前にベクトル化したデータで、IDとテキストの組が一致する行の行番号を返す関数
+# 一致する行がなければ-1とする。テキストはハッシュ値にしてから比べる
+def find_previous_rows(data, previous_data, id_column, text_column):
+    # IDとテキストのハッシュ値の組を返す関数
+    def get_keys(frame):
+        return pd.DataFrame(
+            {
+                "id": frame[id_column].to_numpy(),
+                "text_hash": pd.util.hash_array(frame[text_column].to_numpy(object)),
+            }
+        )
+
+    previous_keys = get_keys(previous_data)
+    previous_keys["row"] = np.arange(len(previous_keys))
+    previous_keys = previous_keys.drop_duplicates(["id", "text_hash"])
+    rows = get_keys(data).merge(previous_keys, how="left", on=["id", "text_hash"])
+    return rows["row"].fillna(-1).to_numpy(np.int64)
+
+
+# 題材のデータセットのうち、以前にベクトル化したデータから変わった部分だけをベクトル化し、
+# 保存する関数。変わっていないクエリと製品タイトルは、以前のベクトルを再利用する
+# 以前のデータがなければ（初回）、すべてをベクトル化する。以前のデータを別のモデル
+# （または記録のない古い形式）でベクトル化していれば、ベクトルを混ぜないよう、
+# すべてをベクトル化し直す
+def write_tuned_vectorized_data_incremental(
+    model,
+    sample_rate,
+    max_tokens_per_batch=None,
+    workers=None,
+    threads_per_worker=None,
+):
+    jp_data = read_jp_data(sample_rate=sample_rate)
+    jp_data.attrs["model_fingerprint"] = get_model_fingerprint(model)
+
+    # 再利用できる以前のデータを読み込む。なければNoneとする
+    previous_data = None
+    if os.path.isfile(TUNED_VECTORIZED_PARQUET_PATH):
+        previous_data = read_tuned_vectorized_data()
+        if (
+            previous_data.attrs.get("model_fingerprint")
+            != jp_data.attrs["model_fingerprint"]
+        ):
+            print(
+                "The previous data was vectorized by another model; "
+                "re-encoding all rows"
+            )
+            previous_data = None
+    else:
+        print("No previous data; encoding all rows")
+
+    vectorize = vectorize_with(
+        model,
+        use_cache=True,
+        max_tokens_per_batch=max_tokens_per_batch,
+        workers=workers,
+        threads_per_worker=threads_per_worker,
+    )
+
+    for vector_column, id_column, text_column in [
+        ("query_vector", "query_id", "query"),
+        ("title_vector", "product_id", "product_title"),
+    ]:
+        # 再利用できる以前のデータがなければ、すべてベクトル化する
+        # 別のモデルなら次元数も異なりうるので、以前の行列の形も使わない
+        if previous_data is None:
+            set_vector_matrix(
+                jp_data, vector_column, np.vstack(vectorize(jp_data[text_column]))
+            )
+            continue
+
+        # 以前のベクトルの行列（メモリマップ）から、一致する行を集める
+        previous_matrix = get_vector_matrix_of(previous_data, vector_column)
+        rows = find_previous_rows(jp_data, previous_data, id_column, text_column)
+        reused = rows >= 0
+        matrix = np.empty(
+            (len(jp_data), previous_matrix.shape[1]), dtype=previous_matrix.dtype
+        )
+        matrix[reused] = previous_matrix[rows[reused]]
+
+        # 新しい行や、テキストの変わった行だけをベクトル化する
+        if not reused.all():
+            matrix[~reused] = np.vstack(vectorize(jp_data[text_column][~reused]))
+        print(f"{vector_column}: reused {reused.sum()} / {len(jp_data)} rows")
+
+        set_vector_matrix(jp_data, vector_column, matrix)
+
+    # ベクトル化したデータを保存する
+    write_tuned_vectorized_data(jp_data)
+
+
+# 逐次ベクトル化の途中経過の保存先。このまま実行した場合は、本書のサンプルコードの
+# ディレクトリ code 以下、tmp/tuned-vectorized-parts に行グループごとのファイルを保存する
+TUNED_VECTORIZED_PARTS_DIR = os.path.join(
+    os.path.dirname(__file__), "tmp", "tuned-vectorized-parts"
+)
+
+
+# 行グループの番号から、その途中経過のファイルのパスを組み立てる関数
+def get_part_path(part_number):
+    return os.path.join(TUNED_VECTORIZED_PARTS_DIR, f"part-{part_number:05d}.parquet")
+
+
+# ジェネレータを別のスレッドで先読みするジェネレータ。先読みは高々size件までとする
+def prefetch(generator, size=2):
+    queue, finished, stopped = Queue(maxsize=size), object(), threading.Event()
+
+    # 別のスレッドで実行する関数。例外もそのまま受け渡す
+    def run():
+        try:
+            for item in generator:
+                if stopped.is_set():
+                    return
+                queue.put((item, None))
+        except BaseException as exception:
+            queue.put((None, exception))
+        finally:
+            queue.put((finished, None))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, exception = queue.get()
+            if exception is not None:
+                raise exception
+            if item is finished:
+                return
+            yield item
+    finally:
+        # 途中で打ち切られた場合も、先読みのスレッドが止まるまでキューを空にし続ける
+        stopped.set()
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+
+# 逐次ベクトル化の前段。行グループを読み込み、キャッシュにないテキストをバッチに分けて
+# トークナイズする。後段のモデルの推論と重なるよう、別のスレッドで実行する
+# 前回までに保存済みの行グループ（先頭から first_part_number 個）は、読み込まずに飛ばす
+def prepare_parts(
+    model, cache, sample_rate, batch_rows, batch_size, max_tokens, first_part_number=0
+):
+    # 先読みしている間、前の行グループのベクトルはまだキャッシュに追記されていない
+    # 前の行グループで推論することにしたテキストは、ここで覚えておいて除く
+    scheduled_texts = set()
+
+    for part_number, part_data in enumerate(
+        iter_jp_data(
+            sample_rate=sample_rate,
+            batch_rows=batch_rows,
+            skip_batches=first_part_number,
+        ),
+        start=first_part_number,
+    ):
+        # 既にベクトル化したテキストと、前の行グループで推論するテキストを除く
+        texts = sorted(set(part_data["query"]) | set(part_data["product_title"]))
+        missing_texts = [
+            text
+            for text, row in zip(texts, cache.lookup(texts))
+            if row < 0 and text not in scheduled_texts
+        ]
+        scheduled_texts.update(missing_texts)
+
+        # 一度だけトークン化し、バッチに分ける。指定があれば、トークン数の上限でバッチを組む
+        features = tokenize_texts(model, missing_texts)
+        if max_tokens is None:
+            batches = [
+                np.arange(start, min(start + batch_size, len(missing_texts)))
+                for start in range(0, len(missing_texts), batch_size)
+            ]
+        else:
+            batches = make_token_budget_batches(count_tokens(features), max_tokens)
+
+        # バッチごとにパディングしたテンソルにする
+        tokenized_batches = []
+        for batch in batches:
+            batch_texts = [missing_texts[index] for index in batch]
+            tokenized_batches.append(
+                (batch_texts, pad_features(model, features, batch))
+            )
+
+        yield part_number, part_data, tokenized_batches
+
+
+# 行グループのデータとベクトルの行列を、途中経過のファイルとして保存する関数
+# ベクトルの行列を先に保存し、最後に .parquet ファイルを置くことで保存を確定させる
+def write_part(part_data, vector_matrices, part_path):
+    for column, matrix in vector_matrices.items():
+        np.save(get_vector_matrix_path(part_path, column), matrix)
+    temporary_path = f"{part_path}.tmp"
+    part_data.to_parquet(
+        temporary_path,
+        index=False,
+        engine="pyarrow",  # 1.0.1: .parquet ファイルを扱う際、engine を明示しました。
+    )
+    os.replace(temporary_path, part_path)
+
+
+# 行グループごとのファイルを、read_tuned_vectorized_dataで読める単一のデータにまとめる関数
+# ベクトルの行列はメモリマップしたファイルに書き込むので、全体をメモリに載せない
+def merge_parts(part_paths, vector_columns, model_fingerprint=None):
+    # 行グループがなければ、行列の次元数や型もわからないので例外をあげる
+    if not part_paths:
+        raise ValueError("まとめる行グループがありません")
+
+    row_counts = [pq.read_metadata(path).num_rows for path in part_paths]
+
+    # ベクトルの列ごとに、行グループの行列を順に書き込む
+    for column in vector_columns:
+        part_matrices = [
+            np.load(get_vector_matrix_path(path, column), mmap_mode="r")
+            for path in part_paths
+        ]
+        matrix_path = get_vector_matrix_path(TUNED_VECTORIZED_PARQUET_PATH, column)
+        temporary_path = f"{matrix_path}.{os.getpid()}.tmp"
+        matrix = np.lib.format.open_memmap(
+            temporary_path,
+            mode="w+",
+            dtype=part_matrices[0].dtype,
+            shape=(sum(row_counts), part_matrices[0].shape[1]),
+        )
+        for start, part_matrix in zip(np.cumsum([0] + row_counts), part_matrices):
+            matrix[start : start + len(part_matrix)] = part_matrix
+        matrix.flush()
+        del matrix
+        os.replace(temporary_path, matrix_path)
+
+    # 残りの列は、行グループごとに追記する
+    schema = pq.read_schema(part_paths[0])
+    metadata = {b"vector_columns": json.dumps(vector_columns).encode()}
+    if model_fingerprint is not None:
+        metadata[b"model_fingerprint"] = model_fingerprint.encode()
+    schema = schema.with_metadata({**schema.metadata, **metadata})
+    temporary_path = f"{TUNED_VECTORIZED_PARQUET_PATH}.{os.getpid()}.tmp"
+    with pq.ParquetWriter(temporary_path, schema) as parquet_writer:
+        for path in part_paths:
+            parquet_writer.write_table(pq.read_table(path).cast(schema))
+    os.replace(temporary_path, TUNED_VECTORIZED_PARQUET_PATH)
+
+
+# 題材のデータセットを行グループごとに読み込み、ベクトル化し、保存する関数
+# 読み込みとトークナイズ、モデルの推論、保存を段階に分けて流すので、メモリ使用量は
+# 行グループの大きさで抑えられる。中断した場合は、最後に保存した行グループの次から再開する
+def write_tuned_vectorized_data_streaming(
+    model, sample_rate, batch_rows=65536, batch_size=32, max_tokens_per_batch=None
+):
+    # 既にベクトル化したテキストは、キャッシュから再利用する。モデルの推論は
+    # トークン化したテンソルから行う（encode_features）ので、その経路のキャッシュを使う
+    cache = open_embedding_cache(model, {**DEFAULT_ARGS, **FEATURE_CACHE_ARGS})
+
+    # 途中経過がデータセットやモデルの異なるものなら、破棄してやり直す
+    manifest = {
+        "data": os.path.basename(get_jp_data_snapshot_path(sample_rate, None, False)),
+        "model": os.path.basename(cache.directory),
+        "batch_rows": batch_rows,
+    }
+    manifest_path = os.path.join(TUNED_VECTORIZED_PARTS_DIR, "manifest.json")
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as manifest_file:
+            if json.load(manifest_file) != manifest:
+                shutil.rmtree(TUNED_VECTORIZED_PARTS_DIR)
+    os.makedirs(TUNED_VECTORIZED_PARTS_DIR, exist_ok=True)
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    # 前回までに保存済みの行グループの数。行グループは先頭から順に保存している
+    first_part_number = 0
+    while os.path.isfile(get_part_path(first_part_number)):
+        first_part_number += 1
+
+    # 前段を別のスレッドで先読みしつつ、後段でモデルを推論する。推論なので評価モードにする
+    model.eval()
+    for part_number, part_data, tokenized_batches in prefetch(
+        prepare_parts(
+            model,
+            cache,
+            sample_rate,
+            batch_rows,
+            batch_size,
+            max_tokens_per_batch,
+            first_part_number,
+        )
+    ):
+        for batch_texts, features in tqdm(
+            tokenized_batches, desc=f"Part {part_number}"
+        ):
+            cache.append(batch_texts, encode_features(model, features))
+
+        # 行グループのクエリと製品タイトルのベクトルをキャッシュから取り出し、保存する
+        write_part(
+            part_data,
+            {
+                "query_vector": cache.get(cache.lookup(part_data["query"])),
+                "title_vector": cache.get(cache.lookup(part_data["product_title"])),
+            },
+            get_part_path(part_number),
+        )
+
+    # すべての行グループを単一のデータにまとめ、途中経過を削除する
+    part_number_count = len(
+        [
+            name
+            for name in os.listdir(TUNED_VECTORIZED_PARTS_DIR)
+            if name.endswith(".parquet")
+        ]
+    )
+    merge_parts(
+        [get_part_path(part_number) for part_number in range(part_number_count)],
+        ["query_vector", "title_vector"],
+        get_model_fingerprint(model),
+    )
+    shutil.rmtree(TUNED_VECTORIZED_PARTS_DIR)
+
+
 # このコードをじかに実行した場合のみ、以下のコードを実行する
 if __name__ == "__main__":
     from argparse import ArgumentParser
-    from ch01_data_preparation import read_jp_data
-    from ch02_basic_vectorization import vectorize_with
     from ch05_advanced_vectorization_0_tune import get_tuned_vectorization_model
 
     # コマンドライン引数から、データのサンプル率を読み込む
@@ -45,18 +379,55 @@ if __name__ == "__main__":
     argument_parser.add_argument(
         "--sample-rate", default=0.01, type=float, choices=[0.01, 1.0]
     )
+    # ベクトル化のワーカープロセス数と、プロセスあたりのスレッド数。指定がなければ単一プロセス
+    argument_parser.add_argument("--workers", default=None, type=int)
+    argument_parser.add_argument("--threads-per-worker", default=None, type=int)
+    # 行グループごとに逐次ベクトル化し保存する指定と、行グループあたりの行数
+    # 逐次ベクトル化では、ワーカープロセスは使わない
+    argument_parser.add_argument("--streaming", action="store_true")
+    argument_parser.add_argument("--batch-rows", default=65536, type=int)
+    # バッチあたりのトークン数（パディングを含む）の上限。指定がなければ件数でバッチを組む
+    argument_parser.add_argument("--max-tokens-per-batch", default=None, type=int)
+    # 以前にベクトル化したデータから、変わった部分だけをベクトル化する指定
+    argument_parser.add_argument("--incremental", action="store_true")
     args = argument_parser.parse_args()
 
-    # 題材のデータセットを読み込む
-    jp_data = read_jp_data(sample_rate=args.sample_rate)
-
     # ファインチューニング後のモデルを読み込む
     model = get_tuned_vectorization_model()
 
-    # クエリとドキュメント（製品タイトル）をベクトル化し、新たな列として保存する
-    vectorize = vectorize_with(model)
-    jp_data["query_vector"] = vectorize(jp_data["query"])
-    jp_data["title_vector"] = vectorize(jp_data["product_title"])
+    if args.streaming:
+        # 逐次ベクトル化の指定があれば、行グループごとにベクトル化し保存する
+        write_tuned_vectorized_data_streaming(
+            model,
+            args.sample_rate,
+            batch_rows=args.batch_rows,
+            max_tokens_per_batch=args.max_tokens_per_batch,
+        )
+    elif args.incremental:
+        # 差分のベクトル化の指定があれば、変わったクエリと製品タイトルだけをベクトル化する
+        write_tuned_vectorized_data_incremental(
+            model,
+            args.sample_rate,
+            max_tokens_per_batch=args.max_tokens_per_batch,
+            workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+        )
+    else:
+        # 題材のデータセットを読み込む
+        jp_data = read_jp_data(sample_rate=args.sample_rate)
+
+        # クエリとドキュメント（製品タイトル）をベクトル化し、新たな列として保存する
+        # 同じモデルで一度ベクトル化したテキストは、キャッシュから再利用する
+        vectorize = vectorize_with(
+            model,
+            use_cache=True,
+            max_tokens_per_batch=args.max_tokens_per_batch,
+            workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+        )
+        jp_data["query_vector"] = vectorize(jp_data["query"])
+        jp_data["title_vector"] = vectorize(jp_data["product_title"])
 
-    # ベクトル化したデータを保存する
-    write_tuned_vectorized_data(jp_data)
+        # ベクトル化したデータを、モデルのフィンガープリントとともに保存する
+        jp_data.attrs["model_fingerprint"] = get_model_fingerprint(model)
+        write_tuned_vectorized_data(jp_data)
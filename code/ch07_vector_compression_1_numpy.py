@@ -1,32 +1,179 @@
 #!/usr/bin/env python
 
+from ch02_basic_vectorization import (
+    get_vector_matrix_of,
+    get_vectors_fingerprint,
+    set_vector_matrix,
+)
 from sentence_transformers.quantization import quantize_embeddings
 
 import numpy as np
+import os
 
+# スカラ量子化のキャリブレーション結果（各次元の範囲）の保存先。このまま実行した場合は、
+# 本書のサンプルコードのディレクトリ code 以下、tmp/scalar-quantizer.npz に保存する
+SCALAR_QUANTIZER_PATH = os.path.join(
+    os.path.dirname(__file__), "tmp", "scalar-quantizer.npz"
+)
 
-# ベクトルをスカラ量子化する関数
-def quantize(data):
-    # キャリブレーションデータは訓練データ上のドキュメント（製品タイトル）ベクトル列とする
-    calibration_vectors = np.vstack(data[data.split == "train"]["title_vector"])
 
-    # クエリ・ドキュメントベクトル列それぞれスカラ量子化する
+# ベクトルをINT8にスカラ量子化するクラス。キャリブレーションで決めた各次元の範囲を保存し、
+# 検索時のクエリなど、後から届くベクトルも同じ範囲で量子化できるようにする
+class ScalarQuantizer:
+
+    # インスタンスを作成する特殊メソッド。範囲は、最小値と最大値の2行からなる行列
+    # フィンガープリントは、キャリブレーションに使ったデータを表す文字列
+    def __init__(self, ranges=None, fingerprint=None):
+        self.ranges = ranges
+        self.fingerprint = fingerprint
+
+    # キャリブレーションデータから、各次元の範囲を決めるメソッド
+    # 指定があれば行をサンプリングし、外れ値は指定した百分位数で切り捨てる
+    # デフォルトではすべての行の最小値と最大値とし、quantize_embeddings に
+    # キャリブレーションデータを渡す場合と同じ範囲になる
+    def fit(
+        self, vectors, sample_size=None, clip_percentile=0.0, seed=0, batch_size=65536
+    ):
+        if sample_size is not None and len(vectors) > sample_size:
+            rows = np.sort(
+                np.random.default_rng(seed).choice(
+                    len(vectors), sample_size, replace=False
+                )
+            )
+            vectors = vectors[rows]
+
+        # 切り捨てなければ、メモリマップした大きな行列もコピーせず、バッチごとに集計する
+        if clip_percentile == 0.0:
+            batches = [
+                vectors[start : start + batch_size]
+                for start in range(0, len(vectors), batch_size)
+            ]
+            self.ranges = np.array(
+                [
+                    np.min([np.min(batch, axis=0) for batch in batches], axis=0),
+                    np.max([np.max(batch, axis=0) for batch in batches], axis=0),
+                ],
+                dtype=np.float32,
+            )
+            return self
+
+        self.ranges = np.percentile(
+            np.asarray(vectors, dtype=np.float32),
+            [clip_percentile, 100.0 - clip_percentile],
+            axis=0,
+        ).astype(np.float32)
+        return self
+
+    # ベクトルの行列をスカラ量子化するメソッド。範囲の外の値は、範囲の端に切り詰める
+    # メモリマップした大きな行列も扱えるよう、バッチごとに量子化する
+    def quantize(self, vectors, batch_size=65536):
+        quantized = np.empty(np.shape(vectors), dtype=np.int8)
+        for start in range(0, len(quantized), batch_size):
+            quantized[start : start + batch_size] = quantize_embeddings(
+                np.asarray(vectors[start : start + batch_size], dtype=np.float32),
+                # 表現はINT8とする
+                precision="int8",
+                ranges=self.ranges,
+            )
+        return quantized
+
+    # 各次元の範囲を、キャリブレーションに使ったデータのフィンガープリントとともに保存する
+    # メソッド
+    def save(self, path=SCALAR_QUANTIZER_PATH):
+        temporary_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            temporary_path,
+            ranges=self.ranges,
+            fingerprint=np.array(self.fingerprint or ""),
+        )
+        os.replace(temporary_path, path)
+
+
+# 保存したスカラ量子化のキャリブレーション結果を読み込む関数
+def read_scalar_quantizer(path=SCALAR_QUANTIZER_PATH):
+    # ファイルが存在すれば読み込む
+    if os.path.isfile(path):
+        with np.load(path) as parameters:
+            return ScalarQuantizer(
+                parameters["ranges"],
+                str(parameters["fingerprint"]) if "fingerprint" in parameters else None,
+            )
+
+    # 存在しなければ例外をあげる
+    raise ValueError(
+        "事前にスカラ量子化のキャリブレーションがありません（第7章を参照）"
+    )
+
+
+# キャリブレーションに使うデータのフィンガープリントを返す関数。ベクトル化したモデルの
+# フィンガープリントと、訓練データ上のドキュメント（製品タイトル）ベクトル列の内容から作る
+def get_calibration_fingerprint(data):
+    return ":".join(
+        [
+            data.attrs.get("model_fingerprint", ""),
+            get_vectors_fingerprint(
+                get_vector_matrix_of(data[data.split == "train"], "title_vector")
+            ),
+        ]
+    )
+
+
+# 訓練データ上のドキュメント（製品タイトル）ベクトル列で、スカラ量子化をキャリブレーションする関数
+def fit_scalar_quantizer(data, sample_size=None, clip_percentile=0.0):
+    scalar_quantizer = ScalarQuantizer(fingerprint=get_calibration_fingerprint(data))
+    return scalar_quantizer.fit(
+        get_vector_matrix_of(data[data.split == "train"], "title_vector"),
+        sample_size=sample_size,
+        clip_percentile=clip_percentile,
+    )
+
+
+# 保存したスカラ量子化のキャリブレーション結果を返す関数。保存していないか、保存した
+# ものが別のデータ（別のモデルでベクトル化し直した場合など）でキャリブレーションした
+# ものなら、与えられたデータでキャリブレーションし、保存してから返す
+def get_scalar_quantizer(data, path=SCALAR_QUANTIZER_PATH):
+    if os.path.isfile(path):
+        scalar_quantizer = read_scalar_quantizer(path)
+        if scalar_quantizer.fingerprint == get_calibration_fingerprint(data):
+            return scalar_quantizer
+        print("The saved calibration was fitted on other data; recalibrating")
+    scalar_quantizer = fit_scalar_quantizer(data)
+    scalar_quantizer.save(path)
+    return scalar_quantizer
+
+
+# ベクトルをスカラ量子化する関数。指定がなければ、与えられたデータでキャリブレーションする
+def quantize(data, scalar_quantizer=None):
+    if scalar_quantizer is None:
+        scalar_quantizer = fit_scalar_quantizer(data)
+
+    # クエリ・ドキュメントベクトル列それぞれ、共通のキャリブレーション結果でスカラ量子化する
+    # 量子化したINT8の行列は、各行に分けず attrs の行列として持たせる
     for vector_column in ["query_vector", "title_vector"]:
-        data[vector_column] = quantize_embeddings(
-            np.vstack(data[vector_column]),
-            # 表現はINT8とする
-            precision="int8",
-            # キャリブレーションデータは共通で訓練データ上のドキュメントベクトル列とする
-            calibration_embeddings=calibration_vectors,
-        ).tolist()
+        set_vector_matrix(
+            data,
+            vector_column,
+            scalar_quantizer.quantize(get_vector_matrix_of(data, vector_column)),
+        )
 
 
 # このコードを直に実行した場合のみ、以下のコードを実行する
 if __name__ == "__main__":
-    from ch03_vector_search_engines_0_numpy import cos
+    from argparse import ArgumentParser
+    from ch03_vector_search_engines_0_numpy import calc_cos
     from ch04_evaluate_search_results_0_ndcg import print_ndcg
     from ch07_vector_compression_0_data import read_tuned_vectorized_data
 
+    import time
+
+    # コマンドライン引数から、キャリブレーションのサンプル数と、外れ値として切り捨てる
+    # 百分位数を読み込む。デフォルトではすべての行を使い、切り捨てず、
+    # 各次元の最小値と最大値を範囲とする
+    argument_parser = ArgumentParser()
+    argument_parser.add_argument("--sample-size", default=None, type=int)
+    argument_parser.add_argument("--clip-percentile", default=0.0, type=float)
+    args = argument_parser.parse_args()
+
     # スカラ量子化なし・あり、それぞれ実行して平均nDCGを比較する
     for with_quantize in [False, True]:
         print(f"with_quantize: {with_quantize}")
@@ -34,14 +181,29 @@ if __name__ == "__main__":
         # ベクトル化したデータセットをメモリに読み込む
         jp_data = read_tuned_vectorized_data()
 
-        # 必要に応じてベクトルをスカラ量子化する
+        # 必要に応じてベクトルをスカラ量子化する。キャリブレーション結果は保存し、
+        # OpenSearchに入力する際（第7章）にも同じ範囲で量子化する
         if with_quantize:
-            quantize(jp_data)
+            scalar_quantizer = fit_scalar_quantizer(
+                jp_data,
+                sample_size=args.sample_size,
+                clip_percentile=args.clip_percentile,
+            )
+            scalar_quantizer.save()
+            quantize(jp_data, scalar_quantizer)
 
-        # スコア（ここではコサイン類似度）を計算する
-        jp_data["score"] = jp_data[["query_vector", "title_vector"]].apply(
-            cos, axis=1
+        # ベクトルの行列が占めるメモリを表示する
+        matrix_bytes = sum(
+            get_vector_matrix_of(jp_data, vector_column).nbytes
+            for vector_column in ["query_vector", "title_vector"]
         )
+        print(f"Memory: {matrix_bytes / 1024 / 1024:.01f} MiB")
+
+        # スコア（ここではコサイン類似度）を計算し、かかった時間を表示する
+        # INT8のベクトルは、整数のまま計算する
+        scoring_started_at = time.perf_counter()
+        jp_data["score"] = calc_cos(jp_data)
+        print(f"Scoring: {time.perf_counter() - scoring_started_at:.03f} s")
 
         # テストデータ上の平均nDCGを計算し表示する
         print_ndcg(jp_data[jp_data.split == "test"])
@@ -1,11 +1,10 @@
 #!/usr/bin/env python
 
-from ch02_basic_vectorization import get_dimension_number_of
+from ch02_basic_vectorization import get_dimension_number_of, get_vector_matrix_of
 from ch04_evaluate_search_results_1_faiss import test_faiss
 from ch07_vector_compression_0_data import read_tuned_vectorized_data
 
 import faiss
-import numpy as np
 
 
 # ベクトル化したデータセットをメモリに読み込む
@@ -29,8 +28,8 @@ for with_quantize in [False, True]:
 
         # キャリブレーションデータは訓練データ上の
         # ドキュメント（ここでは製品タイトル）ベクトル列とする
-        calibration_vectors = np.vstack(
-            jp_data[jp_data.split == "train"]["title_vector"]
+        calibration_vectors = get_vector_matrix_of(
+            jp_data[jp_data.split == "train"], "title_vector"
         )
 
         # キャリブレーションする
@@ -39,5 +38,5 @@ for with_quantize in [False, True]:
         # スカラ量子化なし
         faiss_index = faiss.IndexFlatIP(dimension_number)
 
-    # テストする
-    test_faiss(faiss_index, jp_data, k=10)
+    # テストする。総当たりの検索結果に対する再現率も計算する
+    test_faiss(faiss_index, jp_data, k=10, compare_with_exact=True)
@@ -7,7 +7,7 @@ from ch02_basic_vectorization import (
 )
 from ch03_vector_search_engines_2_os import OpenSearchTester
 from ch07_vector_compression_0_data import read_tuned_vectorized_data
-from ch07_vector_compression_1_numpy import quantize
+from ch07_vector_compression_1_numpy import get_scalar_quantizer, quantize
 
 
 # コマンドライン引数で、スカラ量子化なしを指定できる
@@ -18,9 +18,11 @@ args = argument_parser.parse_args()
 # ベクトル化したデータセットをメモリに読み込む
 jp_data = read_tuned_vectorized_data()
 
-# 必要に応じてベクトルをスカラ量子化する
+# 必要に応じてベクトルをスカラ量子化する。キャリブレーション結果は、第7章で保存したもの
+# を使うので、ローカルでのスコアの計算と同じ範囲で量子化する。保存していなければ、
+# ここでキャリブレーションして保存する
 if not args.skip_quantize:
-    quantize(jp_data)
+    quantize(jp_data, get_scalar_quantizer(jp_data))
 
 # データセットをクエリとドキュメントに分割する
 query_data, document_data = split_into_query_and_document(jp_data)
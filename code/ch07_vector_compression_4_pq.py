@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+from ch03_vector_search_engines_3_numpy import MISSING_SCORE
+
+import faiss
+import numpy as np
+
+
+# IVF-PQのFaissインデックスを作成する関数。直積量子化（PQ）では、ベクトルを
+# サブベクトルに分割し、それぞれを 2 の number_of_bits 乗個の代表ベクトルの番号で表す
+# OPQを指定すれば、分割の前にベクトルを回転させ、量子化による誤差を小さくする
+def make_ivf_pq_index(
+    dimension,
+    number_of_centroids=4,
+    number_of_subquantizers=32,
+    number_of_bits=8,
+    with_opq=False,
+):
+    faiss_index = faiss.IndexIVFPQ(
+        faiss.IndexFlatIP(dimension),
+        dimension,
+        number_of_centroids,
+        number_of_subquantizers,
+        number_of_bits,
+        faiss.METRIC_INNER_PRODUCT,
+    )
+    if with_opq:
+        faiss_index = faiss.IndexPreTransform(
+            faiss.OPQMatrix(dimension, number_of_subquantizers), faiss_index
+        )
+    return faiss_index
+
+
+# IVFのFaissインデックスの、ベクトルあたりのバイト数を返す関数。転置リストに格納する
+# 符号とID（INT64）の大きさとする。セントロイドや代表ベクトルはドキュメント数によらない
+def get_ivf_bytes_per_vector(faiss_index):
+    return faiss.extract_index_ivf(faiss_index).code_size + np.dtype(np.int64).itemsize
+
+
+# 圧縮したインデックスの検索結果の上位の候補を、元のベクトルで並べ直すインデックスのクラス
+# Faissのインデックスと同じく add と search のメソッドを持つので、test_faiss で使える
+# 元のベクトルの行列はメモリマップしたものを与えれば、候補の行だけがディスクから読まれる
+class RefinedIndex:
+
+    # インスタンスを作成する特殊メソッド。refine_rows を与えれば、ドキュメントの通し番号を
+    # 元のベクトルの行列の行番号に変換する（データセットの行列をそのまま使う場合など）
+    def __init__(
+        self, faiss_index, refine_matrix, refine_rows=None, number_of_candidates=100
+    ):
+        self.faiss_index = faiss_index
+        self.refine_matrix = refine_matrix
+        self.refine_rows = refine_rows
+        self.number_of_candidates = number_of_candidates
+        self.d = faiss_index.d
+
+    # 入力されたドキュメント数。内側のインデックスのものとする
+    @property
+    def ntotal(self):
+        return self.faiss_index.ntotal
+
+    # ドキュメントベクトルの行列を、内側のインデックスに入力するメソッド
+    def add(self, matrix):
+        self.faiss_index.add(matrix)
+
+    # クエリベクトルの行列から、内積の上位 k 件のスコアと通し番号の行列を返すメソッド
+    def search(self, queries, k):
+        queries = np.asarray(queries, dtype=np.float32)
+
+        # 圧縮したインデックスで、上位の候補を多めに検索する
+        _, index_matrix = self.faiss_index.search(
+            queries, max(k, self.number_of_candidates)
+        )
+
+        # 候補の元のベクトルを、重複を除いて行番号の昇順に読み出す
+        # メモリマップした行列では、ディスクを先頭から順に読むことになる
+        candidates, positions = np.unique(
+            index_matrix[index_matrix >= 0], return_inverse=True
+        )
+        rows = candidates if self.refine_rows is None else self.refine_rows[candidates]
+        vectors = np.asarray(self.refine_matrix[rows], dtype=np.float32)
+
+        # クエリと候補の元のベクトルの内積を計算する。プレースホルダ-1は最低のスコアとする
+        score_matrix = np.full(index_matrix.shape, MISSING_SCORE, dtype=np.float32)
+        query_rows = np.nonzero(index_matrix >= 0)[0]
+        score_matrix[index_matrix >= 0] = np.einsum(
+            "ij,ij->i", queries[query_rows], vectors[positions]
+        )
+
+        # 元のベクトルのスコアで、クエリ（行）ごとに上位 k 件を並べ直す
+        order = np.argsort(-score_matrix, axis=1, kind="stable")[:, :k]
+        return (
+            np.take_along_axis(score_matrix, order, axis=1),
+            np.take_along_axis(index_matrix, order, axis=1),
+        )
+
+
+# このコードを直に実行した場合のみ、以下のコードを実行する
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from ch02_basic_vectorization import (
+        get_dimension_number_of,
+        get_vector_matrix_of,
+        get_vector_source,
+        split_into_query_and_document,
+    )
+    from ch04_evaluate_search_results_1_faiss import (
+        build_or_read_faiss_index,
+        test_faiss,
+    )
+    from ch07_vector_compression_0_data import read_tuned_vectorized_data
+
+    # コマンドライン引数を読み込む
+    argument_parser = ArgumentParser()
+    # ドキュメントを分別するセントロイド数と、クエリあたりのプローブ数（第9章）
+    argument_parser.add_argument("--number-of-centroids", default=4, type=int)
+    argument_parser.add_argument("--number-of-probes", default=1, type=int)
+    # サブベクトルの数と、サブベクトルあたりのビット数。次元数はサブベクトルの数で割り切れること
+    argument_parser.add_argument("--number-of-subquantizers", default=32, type=int)
+    argument_parser.add_argument("--number-of-bits", default=8, type=int)
+    # 直積量子化の前にベクトルを回転させる（OPQ）かどうか
+    argument_parser.add_argument("--with-opq", action="store_true")
+    # 元のベクトルで並べ直す、上位の候補の数
+    argument_parser.add_argument("--number-of-candidates", default=100, type=int)
+    args = argument_parser.parse_args()
+
+    # ベクトル化したデータセットをメモリに読み込み、ドキュメントを取り出す
+    jp_data = read_tuned_vectorized_data()
+    _, document_data = split_into_query_and_document(jp_data)
+
+    # IVF-PQのインデックスを作成し、訓練データ上のドキュメント（ここでは製品タイトル）
+    # ベクトル列で訓練して、ドキュメントベクトルを入力する。実行済みなら読み込む
+    faiss_index = build_or_read_faiss_index(
+        make_ivf_pq_index(
+            get_dimension_number_of(jp_data),
+            args.number_of_centroids,
+            args.number_of_subquantizers,
+            args.number_of_bits,
+            args.with_opq,
+        ),
+        get_vector_matrix_of(document_data, "title_vector"),
+        get_vector_matrix_of(jp_data[jp_data.split == "train"], "title_vector"),
+    )
+
+    # プローブ数を設定する。OPQの場合は、回転の内側のインデックスに設定する
+    faiss.extract_index_ivf(faiss_index).nprobe = args.number_of_probes
+
+    # 元のベクトルは、データセットのメモリマップした行列をそのまま使う
+    # ドキュメントの通し番号は、その行列の行番号に変換する
+    refine_matrix, refine_rows = get_vector_source(document_data, "title_vector")
+    refined_index = RefinedIndex(
+        faiss_index,
+        refine_matrix,
+        refine_rows,
+        args.number_of_candidates,
+    )
+
+    # ベクトルあたりのメモリ使用量。並べ直しに使う元のベクトルはメモリマップするので、
+    # 常駐するメモリには含めない。圧縮しない（FP32の）場合と比べる
+    bytes_per_vector = get_ivf_bytes_per_vector(faiss_index)
+    float_bytes_per_vector = refine_matrix.shape[1] * refine_matrix.itemsize
+
+    # 並べ直しなし・ありで、それぞれテストする。総当たりの検索結果に対する再現率も計算する
+    for tested_index in [faiss_index, refined_index]:
+        test_faiss(tested_index, jp_data, k=10, compare_with_exact=True)
+        print(
+            f"Memory: {bytes_per_vector:.01f} bytes/vector"
+            f" ({float_bytes_per_vector / bytes_per_vector:.01f}x smaller than FP32)"
+        )
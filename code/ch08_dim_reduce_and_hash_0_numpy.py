@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
+from ch02_basic_vectorization import get_vector_matrix
+
 import faiss
-import numpy as np
 
 
-# ランダム回転を実行する関数
-def randomly_rotate(vectors, dimensions_of_input, dimensions_of_output, seed=0):
+# ベクトルの行列をランダム回転し、結果を行列で返す関数
+def randomly_rotate_matrix(matrix, dimensions_of_input, dimensions_of_output, seed=0):
     # FaissのRandomRotationMatrixのインスタンスの作成
     random_rotation_matrix = faiss.RandomRotationMatrix(
         dimensions_of_input, dimensions_of_output
@@ -14,18 +15,31 @@ def randomly_rotate(vectors, dimensions_of_input, dimensions_of_output, seed=0):
     # 線形変換の重みを乱数によって決める
     random_rotation_matrix.init(seed)
 
+    # 行列の各行（ベクトル）をランダム回転し結果を返す
+    return random_rotation_matrix.apply_py(matrix)
+
+
+# ランダム回転を実行する関数
+def randomly_rotate(vectors, dimensions_of_input, dimensions_of_output, seed=0):
     # ベクトル列の要素の各ベクトルをランダム回転し結果を返す
     return list(
-        random_rotation_matrix.apply_py(
-            np.vstack(vectors),
+        randomly_rotate_matrix(
+            get_vector_matrix(vectors),
+            dimensions_of_input,
+            dimensions_of_output,
+            seed,
         )
     )
 
 
 # このコードを直に実行した場合のみ、以下のコードを実行する
 if __name__ == "__main__":
-    from ch02_basic_vectorization import get_dimension_number_of
-    from ch03_vector_search_engines_0_numpy import cos
+    from ch02_basic_vectorization import (
+        get_dimension_number_of,
+        get_vector_matrix_of,
+        set_vector_matrix,
+    )
+    from ch03_vector_search_engines_0_numpy import calc_cos
     from ch04_evaluate_search_results_0_ndcg import print_ndcg
     from ch07_vector_compression_0_data import read_tuned_vectorized_data
 
@@ -37,12 +51,16 @@ if __name__ == "__main__":
 
     # ランダム回転する。クエリとドキュメント（ここでは製品タイトル）の両ベクトル列それぞれ行う
     for vector_column in ["query_vector", "title_vector"]:
-        jp_data[vector_column] = randomly_rotate(
-            jp_data[vector_column], dimensions, 64
+        set_vector_matrix(
+            jp_data,
+            vector_column,
+            randomly_rotate_matrix(
+                get_vector_matrix_of(jp_data, vector_column), dimensions, 64
+            ),
         )
 
     # スコア（ここではコサイン類似度）を計算する
-    jp_data["score"] = jp_data[["query_vector", "title_vector"]].apply(cos, axis=1)
+    jp_data["score"] = calc_cos(jp_data)
 
     # テストデータ上の平均nDCGを計算し表示する
     print_ndcg(jp_data[jp_data.split == "test"])
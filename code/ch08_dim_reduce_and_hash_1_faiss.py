@@ -23,4 +23,5 @@ faiss_index = faiss.IndexLSH(
 )
 
 # テストする。とくにIndexLSHは距離を返す（returns_distance=True）ことに注意する
-test_faiss(faiss_index, jp_data, k=10, returns_distance=True)
+# 総当たりの検索結果に対する再現率も計算する
+test_faiss(faiss_index, jp_data, k=10, returns_distance=True, compare_with_exact=True)
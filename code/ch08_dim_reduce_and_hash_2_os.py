@@ -3,6 +3,7 @@
 from argparse import ArgumentParser
 from ch02_basic_vectorization import (
     get_dimension_number_of,
+    get_vector_matrix_of,
     split_into_query_and_document,
 )
 from ch03_vector_search_engines_2_os import (
@@ -10,7 +11,9 @@ from ch03_vector_search_engines_2_os import (
     OpenSearchTester,
 )
 from ch07_vector_compression_0_data import read_tuned_vectorized_data
-from ch08_dim_reduce_and_hash_0_numpy import randomly_rotate
+from ch08_dim_reduce_and_hash_0_numpy import randomly_rotate_matrix
+
+import numpy as np
 
 
 # コマンドライン引数からLSHのビット数（出力ビットベクトルの次元数）を読み込む
@@ -26,23 +29,30 @@ dimensions = get_dimension_number_of(jp_data)
 
 
 # ハッシュ関数（ベクトルの要素の符号をとり、冗長だが見やすい文字列とする）
-def hashed(vector):
-    return "".join(["0" if element < 0 else "1" for element in vector])
+# 行列の全要素をまとめて文字 0 か 1 のバイトに変換し、各行のバイト列を文字列とする
+def hashed(matrix):
+    characters = np.where(matrix < 0, ord("0"), ord("1")).astype(np.uint8)
+    return (
+        np.ascontiguousarray(characters)
+        .view(f"S{matrix.shape[1]}")
+        .ravel()
+        .astype(str)
+        .tolist()
+    )
 
 
 # LSHを実行する
-jp_data["query_hash"] = [
-    hashed(vector)
-    for vector in randomly_rotate(
-        jp_data["query_vector"], dimensions, args.dimensions_of_output
-    )
-]
-jp_data["title_hash"] = [
-    hashed(vector)
-    for vector in randomly_rotate(
-        jp_data["title_vector"], dimensions, args.dimensions_of_output
+for vector_column, hash_column in [
+    ("query_vector", "query_hash"),
+    ("title_vector", "title_hash"),
+]:
+    jp_data[hash_column] = hashed(
+        randomly_rotate_matrix(
+            get_vector_matrix_of(jp_data, vector_column),
+            dimensions,
+            args.dimensions_of_output,
+        )
     )
-]
 
 # データセットをクエリとドキュメントに分割する
 query_data, document_data = split_into_query_and_document(jp_data)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+from ch08_dim_reduce_and_hash_0_numpy import randomly_rotate_matrix
+
+import faiss
+import numpy as np
+
+
+# ベクトルの行列の各要素の符号（0以上なら1）のビットを、8ビットずつ1バイトに詰めた
+# 行列（バイナリコード）を返す関数
+def pack_signs(matrix):
+    return np.packbits(matrix >= 0, axis=1)
+
+
+# ベクトルの行列をランダム回転し、バイナリコードを返す関数
+def get_sign_codes(matrix, dimensions_of_input, dimensions_of_output, seed=0):
+    return pack_signs(
+        randomly_rotate_matrix(matrix, dimensions_of_input, dimensions_of_output, seed)
+    )
+
+
+# バイナリコードのハミング距離で検索するFaissインデックスを、元のベクトルで扱うクラス
+# 入力・検索するベクトルをバイナリコードに変換してから、内側のインデックスに渡す
+# Faissのインデックスと同じく add と search のメソッドを持つので、test_faiss で使える
+class SignHashIndex:
+
+    # インスタンスを作成する特殊メソッド。ビット数は内側のインデックスの次元数とする
+    def __init__(self, binary_index, dimension, seed=0):
+        self.binary_index = binary_index
+        self.d = dimension
+        self.seed = seed
+
+        # ランダム回転。訓練の際に一度だけ作成し、ドキュメントとクエリで共通に使う
+        self.random_rotation_matrix = None
+
+    # 入力されたドキュメント数。内側のインデックスのものとする
+    @property
+    def ntotal(self):
+        return self.binary_index.ntotal
+
+    # 訓練済みかどうか。ランダム回転を作成済みなら訓練済みとする
+    @property
+    def is_trained(self):
+        return self.random_rotation_matrix is not None
+
+    # ランダム回転を作成するメソッド。回転は乱数だけで決まるので、訓練データは使わない
+    def train(self, matrix=None):
+        self.random_rotation_matrix = faiss.RandomRotationMatrix(
+            self.d, self.binary_index.d
+        )
+        self.random_rotation_matrix.init(self.seed)
+
+    # ベクトルの行列を、バイナリコードに変換する。訓練していなければ先に訓練する
+    def encode(self, matrix):
+        if not self.is_trained:
+            self.train()
+        return pack_signs(
+            self.random_rotation_matrix.apply_py(np.asarray(matrix, dtype=np.float32))
+        )
+
+    # ドキュメントベクトルの行列を、バイナリコードに変換して入力するメソッド
+    def add(self, matrix):
+        self.binary_index.add(self.encode(matrix))
+
+    # クエリベクトルの行列から、ハミング距離の小さい k 件の距離と通し番号の行列を返すメソッド
+    def search(self, queries, k):
+        return self.binary_index.search(self.encode(queries), k)
+
+
+# このコードを直に実行した場合のみ、以下のコードを実行する
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from ch02_basic_vectorization import (
+        get_dimension_number_of,
+        get_vector_source,
+        split_into_query_and_document,
+    )
+    from ch04_evaluate_search_results_1_faiss import test_faiss
+    from ch07_vector_compression_0_data import read_tuned_vectorized_data
+    from ch07_vector_compression_4_pq import RefinedIndex
+
+    # コマンドライン引数を読み込む
+    argument_parser = ArgumentParser()
+    # バイナリコードのビット数。8の倍数とする。指定がなければベクトルの次元数
+    argument_parser.add_argument("--dimensions-of-output", default=None, type=int)
+    # HNSWのグラフで検索するかどうかと、節点あたりの枝の最大数（第10章）
+    argument_parser.add_argument("--with-hnsw", action="store_true")
+    argument_parser.add_argument("--number-of-neighbors", default=8, type=int)
+    # 元のベクトルで並べ直す、上位の候補の数
+    argument_parser.add_argument("--number-of-candidates", default=100, type=int)
+    args = argument_parser.parse_args()
+
+    # ベクトル化したデータセットをメモリに読み込み、ドキュメントを取り出す
+    jp_data = read_tuned_vectorized_data()
+    _, document_data = split_into_query_and_document(jp_data)
+
+    # データからベクトルの次元数を取得し、バイナリコードのビット数を決める
+    dimension_number = get_dimension_number_of(jp_data)
+    dimensions_of_output = args.dimensions_of_output or dimension_number
+
+    # バイナリコードのFaissインデックスを作成する。総当たりかHNSWのグラフで検索する
+    if args.with_hnsw:
+        binary_index = faiss.IndexBinaryHNSW(
+            dimensions_of_output, args.number_of_neighbors
+        )
+    else:
+        binary_index = faiss.IndexBinaryFlat(dimensions_of_output)
+    sign_hash_index = SignHashIndex(binary_index, dimension_number)
+
+    # ランダム回転を作成する。ドキュメントとクエリで、同じ回転を使い回す
+    sign_hash_index.train()
+
+    # 並べ直しに使う元のベクトルは、データセットのメモリマップした行列をそのまま使う
+    # ドキュメントの通し番号は、その行列の行番号に変換する
+    refine_matrix, refine_rows = get_vector_source(document_data, "title_vector")
+    refined_index = RefinedIndex(
+        sign_hash_index,
+        refine_matrix,
+        refine_rows,
+        args.number_of_candidates,
+    )
+
+    # ベクトルあたりのメモリ使用量。バイナリコードのバイト数とし、FP32の場合と比べる
+    # HNSWの場合は、これに加えてグラフの枝の分が必要になる
+    bytes_per_vector = binary_index.code_size
+    float_bytes_per_vector = refine_matrix.shape[1] * refine_matrix.itemsize
+
+    # 並べ直しなし・ありで、それぞれテストする。総当たりの検索結果に対する再現率も計算する
+    # 並べ直しなしの場合は、ハミング距離を返すので距離の符号を反転させてスコアとする
+    for tested_index, returns_distance in [
+        (sign_hash_index, True),
+        (refined_index, False),
+    ]:
+        test_faiss(
+            tested_index,
+            jp_data,
+            k=10,
+            returns_distance=returns_distance,
+            compare_with_exact=True,
+        )
+        print(
+            f"Memory: {bytes_per_vector:.01f} bytes/vector"
+            f" ({float_bytes_per_vector / bytes_per_vector:.01f}x smaller than FP32)"
+        )
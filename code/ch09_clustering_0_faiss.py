@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-from ch02_basic_vectorization import get_dimension_number_of
-from ch04_evaluate_search_results_1_faiss import test_faiss
+from ch02_basic_vectorization import (
+    get_dimension_number_of,
+    get_vector_matrix_of,
+    split_into_query_and_document,
+)
+from ch04_evaluate_search_results_1_faiss import build_or_read_faiss_index, test_faiss
 from ch07_vector_compression_0_data import read_tuned_vectorized_data
 
 import faiss
-import numpy as np
 
 
 # コマンドライン引数を読み込む
@@ -33,13 +36,21 @@ faiss_index = faiss.IndexIVFFlat(
 )
 
 # クラスタリング対象は訓練データ上のドキュメント（ここでは製品タイトル）ベクトル列とする
-vectors_to_cluster = np.vstack(jp_data[jp_data.split == "train"]["title_vector"])
+vectors_to_cluster = get_vector_matrix_of(
+    jp_data[jp_data.split == "train"], "title_vector"
+)
 
-# ベクトル列をクラスタリングする
-faiss_index.train(vectors_to_cluster)
+# ベクトル列をクラスタリングし、ドキュメント（製品タイトル）ベクトルを入力する
+# 同じデータとセントロイド数で実行済みなら、保存したインデックスを読み込んで使い回す
+_, document_data = split_into_query_and_document(jp_data)
+faiss_index = build_or_read_faiss_index(
+    faiss_index,
+    get_vector_matrix_of(document_data, "title_vector"),
+    vectors_to_cluster,
+)
 
 # プローブ数を設定する
 faiss_index.nprobe = args.number_of_probes
 
-# テストする
-test_faiss(faiss_index, jp_data, k=10)
+# テストする。総当たりの検索結果に対する再現率も計算する
+test_faiss(faiss_index, jp_data, k=10, compare_with_exact=True)
@@ -3,6 +3,7 @@
 from argparse import ArgumentParser
 from ch02_basic_vectorization import (
     get_dimension_number_of,
+    get_vector_matrix_of,
     split_into_query_and_document,
 )
 from ch03_vector_search_engines_2_os import (
@@ -12,7 +13,6 @@ from ch03_vector_search_engines_2_os import (
 from ch07_vector_compression_0_data import read_tuned_vectorized_data
 
 import faiss
-import numpy as np
 
 
 # コマンドライン引数を読み込む
@@ -34,7 +34,9 @@ jp_data = read_tuned_vectorized_data()
 dimension_number = get_dimension_number_of(jp_data)
 
 # クラスタリング対象は訓練データ上のドキュメント（ここでは製品タイトル）ベクトル列とする
-vectors_to_cluster = np.vstack(jp_data[jp_data.split == "train"]["title_vector"])
+vectors_to_cluster = get_vector_matrix_of(
+    jp_data[jp_data.split == "train"], "title_vector"
+)
 
 # ベクトル列をクラスタリングし、セントロイドのインデックスを作成する
 faiss_k_means = faiss.Kmeans(
@@ -44,13 +46,13 @@ faiss_k_means.train(vectors_to_cluster)
 
 # 各クエリベクトルに最寄りのセントロイドIDのリストを紐づける
 _, index_matrix = faiss_k_means.index.search(
-    np.vstack(jp_data.query_vector), args.number_of_centroids_per_query
+    get_vector_matrix_of(jp_data, "query_vector"), args.number_of_centroids_per_query
 )
 jp_data["query_centroids"] = list(index_matrix)
 
 # 各ドキュメントベクトルに最寄りのセントロイドIDのリストを紐づける
 _, index_matrix = faiss_k_means.index.search(
-    np.vstack(jp_data.title_vector), args.number_of_centroids_per_document
+    get_vector_matrix_of(jp_data, "title_vector"), args.number_of_centroids_per_document
 )
 jp_data["title_centroids"] = list(index_matrix)
 
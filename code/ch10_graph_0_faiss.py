@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-from ch02_basic_vectorization import get_dimension_number_of
-from ch04_evaluate_search_results_1_faiss import test_faiss
+from ch02_basic_vectorization import (
+    get_dimension_number_of,
+    get_vector_matrix_of,
+    split_into_query_and_document,
+)
+from ch04_evaluate_search_results_1_faiss import build_or_read_faiss_index, test_faiss
 from ch07_vector_compression_0_data import read_tuned_vectorized_data
 
 import faiss
@@ -23,5 +27,12 @@ faiss_index = faiss.IndexHNSWFlat(
     faiss.METRIC_INNER_PRODUCT,
 )
 
-# テストする
-test_faiss(faiss_index, jp_data, k=10)
+# ドキュメント（製品タイトル）ベクトルを入力し、グラフを構築する
+# 同じデータと枝の最大数で実行済みなら、保存したインデックスを読み込んで使い回す
+_, document_data = split_into_query_and_document(jp_data)
+faiss_index = build_or_read_faiss_index(
+    faiss_index, get_vector_matrix_of(document_data, "title_vector")
+)
+
+# テストする。総当たりの検索結果に対する再現率も計算する
+test_faiss(faiss_index, jp_data, k=10, compare_with_exact=True)
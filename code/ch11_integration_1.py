@@ -83,14 +83,14 @@ def rrf(row):
 
 # このコードを直に実行した場合のみ、以下のコードを実行する
 if __name__ == "__main__":
-    from ch03_vector_search_engines_0_numpy import cos
+    from ch03_vector_search_engines_0_numpy import calc_cos
     from ch07_vector_compression_0_data import read_tuned_vectorized_data
 
     # ベクトル化したデータをメモリに読み込む
     jp_data = read_tuned_vectorized_data()
 
     # コサイン類似度を計算する
-    jp_data["cos"] = jp_data[["query_vector", "title_vector"]].apply(cos, axis=1)
+    jp_data["cos"] = calc_cos(jp_data)
     # 平均nDCGを計算し表示する
     print_ndcg_by("cos", jp_data)
 
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from ch02_basic_vectorization import vectorize_with
-from ch03_vector_search_engines_0_numpy import cos
+from ch03_vector_search_engines_0_numpy import calc_cos
 from ch04_evaluate_search_results_0_ndcg import print_ndcg
 
 
@@ -30,14 +30,18 @@ def format_query(row):
 
 
 # ベクトル化、スコアの計算、平均nDCGの計算と表示を一気に行う関数
-def evaluate(model, data):
+def evaluate(model, data, max_tokens_per_batch=None):
     # クエリとドキュメントをベクトル化する
-    vectorize = vectorize_with(model=model)
+    # 同じモデルで一度ベクトル化したテキストは、キャッシュから再利用する
+    # 長さのばらつく長いドキュメントでは、トークン数の上限でバッチを組むとパディングが減る
+    vectorize = vectorize_with(
+        model=model, use_cache=True, max_tokens_per_batch=max_tokens_per_batch
+    )
     data["query_vector"] = vectorize(data.apply(format_query, axis=1))
     data["document_vector"] = vectorize(data.apply(format_document, axis=1))
 
     # スコア（ここではコサイン類似度）を計算する
-    data["score"] = data[["query_vector", "document_vector"]].apply(cos, axis=1)
+    data["score"] = calc_cos(data, ["query_vector", "document_vector"])
 
     # nDCGを計算し表示する
     print_ndcg(data)
@@ -63,6 +67,8 @@ if __name__ == "__main__":
     argument_parser.add_argument(
         "--sample-rate", default=0.01, type=float, choices=[0.01, 1.0]
     )
+    # バッチあたりのトークン数（パディングを含む）の上限。指定がなければバッチサイズで組む
+    argument_parser.add_argument("--max-tokens-per-batch", default=None, type=int)
     args = argument_parser.parse_args()
 
     # ファインチューニング前のベクトル化モデルを組み、最大シーケンス長を設定する
@@ -76,7 +82,7 @@ if __name__ == "__main__":
 
     # ファインチューニング前のモデルの平均nDCGを計算し表示する
     print("Before fine-tuning")
-    evaluate(model, jp_test_data)
+    evaluate(model, jp_test_data, args.max_tokens_per_batch)
 
     # 訓練データを読み込む。とくに、製品の詳細も読み込む
     jp_train_data = read_jp_data(
@@ -103,4 +109,4 @@ if __name__ == "__main__":
 
     # ファインチューニング後のモデルの平均nDCGを計算し表示する
     print("After fine-tuning")
-    evaluate(model, jp_test_data)
+    evaluate(model, jp_test_data, args.max_tokens_per_batch)
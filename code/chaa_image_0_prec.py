@@ -1,12 +1,11 @@
 #!/usr/bin/env python
 
-from ch02_basic_vectorization import DEFAULT_ARGS
-from ch03_vector_search_engines_0_numpy import cos
+from ch02_basic_vectorization import DEFAULT_ARGS, get_vector_matrix_of
 from io import BytesIO
 from sentence_transformers import models, SentenceTransformer
 
 import datasets
-import pandas as pd
+import numpy as np
 import PIL
 
 
@@ -64,21 +63,46 @@ def vectorize_texts_or_images_with(model, args=DEFAULT_ARGS):
     return vectorize
 
 
-# 単一のクエリに対して、スコアおよび適合率の計算を行う関数
-def test_image(image_data, expected_label, query_vector, k=10):
-    # クエリとドキュメント（画像）の両ベクトルのスコア（コサイン類似度）を計算する
-    scores = pd.DataFrame(
-        {
-            "query_vector": len(image_data) * [query_vector],
-            "image_vector": image_data.image_vector,
-        }
-    ).apply(cos, axis=1)
+# 行列の各行を、L2ノルムで割って正規化する関数
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
 
-    # スコアの降順にソートした場合の順位を計算する
-    ranks = scores.rank(ascending=False, method="first")
 
-    # ランキング結果の上位k件の適合率を計算する
-    return sum(image_data[ranks <= k]["label"] == expected_label) / k
+# すべてのクエリに対して、スコアおよび適合率の計算をまとめて行う関数
+# i番目のクエリに適合する画像は、ラベルがiの画像とする
+def test_images(image_data, query_vectors, k=10):
+    # 正規化したクエリと画像の行列の積で、すべてのペアのコサイン類似度を一度に計算する
+    score_matrix = (
+        normalize_rows(np.vstack(query_vectors))
+        @ normalize_rows(get_vector_matrix_of(image_data, "image_vector")).T
+    )
+
+    # クエリ（行）ごとに、k番目に高いスコアをしきい値として部分ソートで求める
+    # 画像がk件に満たなければ、すべての画像を候補とする
+    candidate_count = min(k, score_matrix.shape[1])
+    thresholds = -np.partition(-score_matrix, candidate_count - 1, axis=1)[
+        :, candidate_count - 1 : candidate_count
+    ]
+
+    # しきい値より高い画像と、しきい値に等しい画像のうちデータセットの順序で先のものを
+    # 合わせてちょうどk件選ぶ。スコアが等しい画像はデータセットの順序で先のものを優先する
+    above = score_matrix > thresholds
+    ties = score_matrix == thresholds
+    remaining_counts = candidate_count - above.sum(axis=1, keepdims=True)
+    selected = above | (ties & (np.cumsum(ties, axis=1) <= remaining_counts))
+    candidates = np.nonzero(selected)[1].reshape(len(score_matrix), candidate_count)
+
+    # 選んだk件だけを、スコアの降順に並べる。スコアが等しければ順序のままにする（安定ソート）
+    order = np.argsort(
+        -np.take_along_axis(score_matrix, candidates, axis=1), axis=1, kind="stable"
+    )
+    top_k = np.take_along_axis(candidates, order, axis=1)
+
+    # ランキング結果の上位k件の適合率を、クエリごとに計算する
+    labels = image_data["label"].to_numpy()
+    expected_labels = np.arange(len(query_vectors))[:, np.newaxis]
+    return (labels[top_k] == expected_labels).sum(axis=1) / k
 
 
 # ベクトル化、スコアの計算、適合率のクエリ間平均の計算と表示を一気に行う関数
@@ -89,17 +113,21 @@ def evaluate(model, data):
     data["image_vector"] = vectorize(data["image"])
 
     # 適合率のクエリ間平均を計算し表示する
-    precisions = [
-        test_image(data, expected_label, query_vector)
-        for expected_label, query_vector in enumerate(query_vectors)
-    ]
-    print(f"Mean Precision: {sum(precisions) / len(precisions):.03f}")
+    precisions = test_images(data, query_vectors)
+    print(f"Mean Precision: {precisions.mean():.03f}")
 
 
 # このコードを直に実行した場合のみ、以下のコードを実行する
 if __name__ == "__main__":
-    # テストデータを1パーセントサンプリングと画像のデコードをしつつ読み込む
-    image_test_data = read_image_data(split="test", sample_percent=1)
+    from argparse import ArgumentParser
+
+    # コマンドライン引数から、テストデータのサンプル率（パーセント）を読み込む
+    argument_parser = ArgumentParser()
+    argument_parser.add_argument("--sample-percent", default=1, type=int)
+    args = argument_parser.parse_args()
+
+    # テストデータを指定の率でサンプリングと画像のデコードをしつつ読み込む
+    image_test_data = read_image_data(split="test", sample_percent=args.sample_percent)
 
     # 画像にも対応するベクトル化モデルを読み込み、適合率のクエリ間平均を計算し表示する
     evaluate(get_text_or_image_vectorization_model(), image_test_data)
@@ -0,0 +1,4 @@
+#!/usr/bin/env bash
+
+cd `dirname $0`/../..
+docker compose exec workspace /code/ch03_vector_search_engines_3_numpy.py
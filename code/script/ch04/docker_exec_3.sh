@@ -0,0 +1,4 @@
+#!/usr/bin/env bash
+
+cd `dirname $0`/../..
+docker compose exec workspace /code/ch04_evaluate_search_results_3_sweep.py --target-recall 0.9
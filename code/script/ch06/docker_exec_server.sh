@@ -0,0 +1,4 @@
+#!/usr/bin/env bash
+
+cd `dirname $0`/../..
+docker compose exec workspace /code/ch06_fast_vectorization_server.py --qps 500
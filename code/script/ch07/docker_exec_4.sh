@@ -0,0 +1,4 @@
+#!/usr/bin/env bash
+
+cd `dirname $0`/../..
+docker compose exec workspace /code/ch07_vector_compression_4_pq.py
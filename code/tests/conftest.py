@@ -0,0 +1,40 @@
+from sentence_transformers import SentenceTransformer, models
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+import os
+import pytest
+import sys
+import torch
+
+
+# テストから本書のサンプルコードを import できるよう、ディレクトリ code をパスに加える
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# テスト用の、ランダムな重みの小さなベクトル化モデルを作成するフィクスチャ
+# ダウンロードせずに済むよう、語彙と重みをその場で作って保存し、読み込む
+@pytest.fixture(scope="session")
+def tiny_model(tmp_path_factory):
+    model_path = str(tmp_path_factory.mktemp("tiny-model"))
+    words = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "hdmi", "ケーブル", "電話機"]
+    words += list("abcdefghijklmnopqrstuvwxyz")
+    vocab_path = os.path.join(model_path, "vocab.txt")
+    with open(vocab_path, "w") as vocab_file:
+        vocab_file.write("\n".join(words))
+    BertTokenizerFast(vocab_path).save_pretrained(model_path)
+
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=len(words),
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=64,
+    )
+    BertModel(config).save_pretrained(model_path)
+
+    return SentenceTransformer(
+        modules=[models.Transformer(model_path, max_seq_length=32), models.Pooling(16)],
+        device="cpu",
+    )
@@ -0,0 +1,148 @@
+from ch01_data_preparation import (
+    get_jp_data_snapshot_path,
+    get_product_catalog,
+    iter_jp_data,
+    read_jp_data,
+    read_product_catalog,
+)
+
+import ch01_data_preparation
+import numpy as np
+import os
+import pandas as pd
+import pytest
+
+
+# テスト用の、製品が重複する小さなデータ
+def make_data():
+    return pd.DataFrame(
+        {
+            "product_id": ["B1", "B2", "B1", "B3"],
+            "product_title": ["ケーブル", "電話機", "ケーブル", None],
+            "product_brand": ["A社", "A社", "A社", "B社"],
+        }
+    )
+
+
+# 行IDの行列を、同じ形の製品の情報の行列に変換できること。-1は欠損値になること
+def test_hydrate(tmp_path):
+    catalog = get_product_catalog(make_data(), str(tmp_path / "catalog.arrow"))
+    assert catalog.size == 3
+    np.testing.assert_array_equal(
+        catalog.hydrate(np.array([[2, 0], [1, -1]]), column="product_title"),
+        np.array([[None, "ケーブル"], ["電話機", None]], dtype=object),
+    )
+    np.testing.assert_array_equal(
+        catalog.get_row_ids(["B3", "B9", "B1"]), np.array([2, -1, 0], dtype=np.int32)
+    )
+
+
+# 製品カタログは、内容が変わった場合だけ保存し直すこと
+def test_rewrite_only_when_stale(tmp_path):
+    path = str(tmp_path / "catalog.arrow")
+    get_product_catalog(make_data(), path)
+    modified_at = os.stat(path).st_mtime_ns
+    os.utime(path, ns=(modified_at - 10**9, modified_at - 10**9))
+
+    get_product_catalog(make_data(), path)
+    assert os.stat(path).st_mtime_ns == modified_at - 10**9
+
+    data = make_data()
+    data.loc[1, "product_title"] = "液晶ディスプレイ"
+    get_product_catalog(data, path)
+    assert os.stat(path).st_mtime_ns != modified_at - 10**9
+    assert read_product_catalog(path).hydrate(np.array([1]), "product_title")[0] == (
+        "液晶ディスプレイ"
+    )
+
+
+# テスト用の小さなデータセットのファイルを作り、それを読み込むようにするフィクスチャ
+# 本書で扱わない行（small_version が0、jp 以外）を含め、行グループを小さく分ける
+@pytest.fixture
+def jp_data_paths(tmp_path, monkeypatch):
+    examples = pd.DataFrame(
+        {
+            "query": [f"query {index // 2}" for index in range(12)],
+            "query_id": [index // 2 for index in range(12)],
+            "product_id": [f"B{index % 5}" for index in range(12)],
+            "esci_label": ["E", "S", "C", "I"] * 3,
+            "split": ["train", "test"] * 6,
+            "small_version": [1, 1, 0, 1, 1, 1, 0, 0, 1, 1, 1, 1],
+            "product_locale": ["jp"] * 4 + ["us"] * 2 + ["jp"] * 6,
+        }
+    )
+    products = pd.DataFrame(
+        {
+            "product_id": ["B0", "B1", "B2", "B3", "B4", "B1"],
+            "product_title": ["ケーブル", "電話機", "充電器", "マウス", "xyz", "phone"],
+            "product_locale": ["jp"] * 5 + ["us"],
+        }
+    )
+    paths = (str(tmp_path / "examples.parquet"), str(tmp_path / "products.parquet"))
+    examples.to_parquet(paths[0], index=False, engine="pyarrow", row_group_size=3)
+    products.to_parquet(paths[1], index=False, engine="pyarrow")
+    monkeypatch.setattr(ch01_data_preparation, "get_jp_data_paths", lambda: paths)
+    monkeypatch.setattr(
+        ch01_data_preparation, "JP_DATA_SNAPSHOT_DIR", str(tmp_path / "snapshots")
+    )
+    return paths
+
+
+# 2回目以降はスナップショットを読み込むこと。元のファイルが更新されたり、引数が
+# 異なったりすれば別のスナップショットとし、同じ引数の古いスナップショットは削除すること
+def test_read_jp_data_snapshot(jp_data_paths, monkeypatch):
+    expected = read_jp_data(use_cache=False)
+    assert len(expected) == 7
+    pd.testing.assert_frame_equal(read_jp_data(), expected)
+    snapshot_path = get_jp_data_snapshot_path(1.0, None, False)
+    assert os.path.isfile(snapshot_path)
+
+    # 元のファイルから読み込もうとすれば失敗するようにしても、同じデータが返る
+    def read_jp_data_without_cache(*args):
+        raise AssertionError("read the source files again")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(
+            ch01_data_preparation,
+            "read_jp_data_without_cache",
+            read_jp_data_without_cache,
+        )
+        pd.testing.assert_frame_equal(read_jp_data(), expected)
+
+    # 引数が異なれば、別のスナップショットとする
+    split_snapshot_path = get_jp_data_snapshot_path(1.0, "test", False)
+    assert split_snapshot_path != snapshot_path
+    pd.testing.assert_frame_equal(
+        read_jp_data(split="test"), read_jp_data(split="test", use_cache=False)
+    )
+
+    # 元のファイルが更新されれば、別のスナップショットとし、同じ引数の古いものは削除する
+    modified_at = os.stat(jp_data_paths[0]).st_mtime_ns + 10**9
+    os.utime(jp_data_paths[0], ns=(modified_at, modified_at))
+    new_snapshot_path = get_jp_data_snapshot_path(1.0, None, False)
+    assert new_snapshot_path != snapshot_path
+    pd.testing.assert_frame_equal(read_jp_data(), expected)
+    assert sorted(os.listdir(os.path.dirname(snapshot_path))) == sorted(
+        os.path.basename(path) for path in [new_snapshot_path, split_snapshot_path]
+    )
+
+
+# 少しずつ読み込んで結合したデータをつなげると、read_jp_data と同じになること
+# skip_batches 個の塊を飛ばせば、それまでの塊の行数の分だけ先の行から再開すること
+def test_iter_jp_data(jp_data_paths):
+    expected = read_jp_data(use_cache=False)
+    batches = list(iter_jp_data(batch_rows=2))
+    assert len(batches) >= 3
+    assert all(len(batch) > 0 for batch in batches)
+    pd.testing.assert_frame_equal(pd.concat(batches, ignore_index=True), expected)
+
+    for skip_batches in range(len(batches) + 1):
+        offset = sum(len(batch) for batch in batches[:skip_batches])
+        pd.testing.assert_frame_equal(
+            pd.concat(
+                [expected.iloc[:0]]
+                + list(iter_jp_data(batch_rows=2, skip_batches=skip_batches)),
+                ignore_index=True,
+            ),
+            expected.iloc[offset:].reset_index(drop=True),
+        )
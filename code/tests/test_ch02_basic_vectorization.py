@@ -0,0 +1,307 @@
+from ch02_basic_vectorization import (
+    EmbeddingCache,
+    EncodingPool,
+    QueryVectorCache,
+    encode_texts,
+    get_model_fingerprint,
+    get_vector_matrix_of,
+    make_token_budget_batches,
+    open_embedding_cache,
+    read_vectorized_data,
+    set_vector_matrix,
+    split_into_query_and_document,
+    with_vector_columns,
+    write_vectorized_data,
+)
+
+import ch02_basic_vectorization
+import copy
+import numpy as np
+import os
+import pandas as pd
+import pytest
+import types
+import warnings
+
+
+# どのテキストもちょうど1回ずつバッチに含まれ、バッチ中の最長のトークン数とテキスト数の積が
+# 上限以下になること。上限より長いテキストは、単独のバッチになること
+def test_make_token_budget_batches():
+    token_counts = np.array([5, 1, 40, 3, 3, 8, 2, 12])
+    batches = make_token_budget_batches(token_counts, 16)
+
+    assert sorted(np.concatenate(batches).tolist()) == list(range(len(token_counts)))
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * token_counts[batch].max() <= 16
+    assert [2] in [batch.tolist() for batch in batches]
+    assert make_token_budget_batches(np.array([], dtype=np.int64), 16) == []
+
+
+# トークン数の上限でバッチを組んでも、model.encode と同じベクトルになること
+def test_encode_texts_with_token_budget(tiny_model):
+    texts = ["hdmi ケーブル", "a b c d e f g", "電話機", "x" * 40, " hdmi "]
+    args = {"show_progress_bar": False}
+    np.testing.assert_allclose(
+        encode_texts(tiny_model, texts, args, max_tokens_per_batch=20),
+        tiny_model.encode(texts, **args),
+        atol=1e-6,
+    )
+
+
+# テキストがなければ、次元数の合った空の行列を返すこと
+def test_encode_texts_without_texts(tiny_model):
+    vectors = encode_texts(tiny_model, [], {"show_progress_bar": False}, 20)
+    assert vectors.shape == (0, tiny_model.get_sentence_embedding_dimension())
+
+
+# ワーカープロセスでベクトル化しても、model.encode と同じベクトルになること
+# また、ワーカープロセスが異常終了した場合は、待ち続けずに例外をあげること
+def test_encoding_pool(tiny_model):
+    texts = ["hdmi ケーブル", "a b c", "電話機", "x y z"]
+    args = {"show_progress_bar": False}
+    encoding_pool = EncodingPool(tiny_model, 2, args, threads_per_worker=1)
+    try:
+        np.testing.assert_allclose(
+            encoding_pool.encode(texts), tiny_model.encode(texts, **args), atol=1e-6
+        )
+
+        encoding_pool.processes[1].kill()
+        encoding_pool.processes[1].join()
+        with pytest.raises(RuntimeError, match="Worker 1 exited"):
+            encoding_pool.encode(texts)
+    finally:
+        encoding_pool.close()
+
+
+# 保存して読み込んだベクトルの列は、メモリマップした行列と行番号の列で持つこと
+# 絞り込んだり、一部の行のベクトルを書き換えたりしても、各行のベクトルが正しいこと
+def test_vector_matrix_tracking(tmp_path):
+    matrix = np.arange(12, dtype=np.float32).reshape(6, 2)
+    data = pd.DataFrame(
+        {
+            "query_id": [1, 1, 2, 2, 3, 3],
+            "product_id": ["a", "b", "a", "c", "b", "c"],
+            "title_vector": list(matrix),
+        }
+    )
+    parquet_path = str(tmp_path / "vectorized.parquet")
+    write_vectorized_data(data, parquet_path)
+    data = read_vectorized_data(parquet_path)
+
+    # attrs に行列を持つデータも、警告なしに保存できる
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        write_vectorized_data(data, str(tmp_path / "rewritten.parquet"))
+
+    assert "title_vector" not in data.columns
+    assert isinstance(get_vector_matrix_of(data, "title_vector").base, np.memmap)
+    np.testing.assert_array_equal(get_vector_matrix_of(data, "title_vector"), matrix)
+
+    # 絞り込んだデータは、元の行列の該当する行を返す
+    _, document_data = split_into_query_and_document(data)
+    np.testing.assert_array_equal(
+        get_vector_matrix_of(document_data, "title_vector"), matrix[[0, 1, 3]]
+    )
+    np.testing.assert_array_equal(
+        get_vector_matrix_of(data[data.query_id == 2], "title_vector"), matrix[2:4]
+    )
+
+    # 書き換えたベクトルは、書き換えたデータにだけ反映される
+    updated_data = data.copy()
+    updated_matrix = matrix.copy()
+    updated_matrix[[1, 4]] = -1
+    set_vector_matrix(updated_data, "title_vector", updated_matrix)
+    np.testing.assert_array_equal(
+        get_vector_matrix_of(updated_data, "title_vector"), updated_matrix
+    )
+    np.testing.assert_array_equal(get_vector_matrix_of(data, "title_vector"), matrix)
+
+    # 各行のベクトルを要素とする列に戻せる
+    np.testing.assert_array_equal(
+        np.vstack(with_vector_columns(document_data)["title_vector"]),
+        matrix[[0, 1, 3]],
+    )
+
+
+# 書き込みの途中で中断されたキャッシュを開くと、ハッシュ値とベクトルの両方がそろった行
+# だけを残してファイルを切り詰め、残った行は正しく引けて、続けて追記できること
+@pytest.mark.parametrize(
+    "interruption", ["partial_vector", "keys_without_vectors", "partial_key"]
+)
+def test_embedding_cache_recovers_from_interruption(tmp_path, interruption):
+    directory = str(tmp_path / "cache")
+    vectors = np.arange(8, dtype=np.float32).reshape(4, 2)
+    cache = EmbeddingCache(directory)
+    cache.append(["a", "b", "c"], vectors[:3])
+
+    # ベクトルまたはハッシュ値を、途中まで書いた状態にする
+    if interruption == "partial_vector":
+        with open(cache.vectors_path, "ab") as vectors_file:
+            vectors_file.write(vectors[3, :1].tobytes())
+    elif interruption == "keys_without_vectors":
+        os.truncate(cache.vectors_path, 2 * vectors.itemsize * 2)
+    else:
+        with open(cache.vectors_path, "ab") as vectors_file:
+            vectors_file.write(vectors[3].tobytes())
+        with open(cache.keys_path, "ab") as keys_file:
+            keys_file.write(EmbeddingCache.hash("d")[:8])
+    row_count = 2 if interruption == "keys_without_vectors" else 3
+
+    cache = EmbeddingCache(directory)
+    assert len(cache.key_to_row) == row_count
+    assert os.path.getsize(cache.keys_path) == row_count * 16
+    assert os.path.getsize(cache.vectors_path) == row_count * vectors.itemsize * 2
+    rows = cache.lookup(["a", "b", "c", "d"])
+    np.testing.assert_array_equal(rows, list(range(row_count)) + [-1] * (4 - row_count))
+    np.testing.assert_array_equal(cache.get(rows[:row_count]), vectors[:row_count])
+
+    # 失われた行を追記し直せば、すべての行が引ける
+    cache.append(["a", "b", "c", "d"], vectors)
+    cache = EmbeddingCache(directory)
+    np.testing.assert_array_equal(
+        cache.get(cache.lookup(["a", "b", "c", "d"])), vectors
+    )
+
+
+# 同じデータから絞り込んだデータどうしの concat は、行列を引き継ぐこと
+# merge や、異なる行列のデータの concat は行列を引き継がず、取り出すと KeyError になること
+# 結合する前に各行のベクトルの列に戻せば、結合後もベクトルを取り出せること
+def test_vector_matrix_combining():
+    data = pd.DataFrame({"product_id": ["a", "b", "c"]})
+    matrix = np.arange(6, dtype=np.float32).reshape(3, 2)
+    set_vector_matrix(data, "title_vector", matrix)
+    other_data = pd.DataFrame({"product_id": ["d"]})
+    set_vector_matrix(other_data, "title_vector", np.ones((1, 2), np.float32))
+    prices = pd.DataFrame({"product_id": ["c", "a"], "price": [300, 100]})
+
+    concatenated_data = pd.concat([data.iloc[[2]], data.iloc[[0]]])
+    np.testing.assert_array_equal(
+        get_vector_matrix_of(concatenated_data, "title_vector"), matrix[[2, 0]]
+    )
+
+    for combined_data in [
+        data.merge(prices, on="product_id"),
+        pd.concat([data, other_data]),
+    ]:
+        with pytest.raises(KeyError):
+            get_vector_matrix_of(combined_data, "title_vector")
+
+    np.testing.assert_array_equal(
+        get_vector_matrix_of(
+            with_vector_columns(data).merge(prices, on="product_id"), "title_vector"
+        ),
+        matrix[[0, 2]],
+    )
+    np.testing.assert_array_equal(
+        get_vector_matrix_of(
+            pd.concat([with_vector_columns(data), with_vector_columns(other_data)]),
+            "title_vector",
+        ),
+        np.vstack([matrix, np.ones((1, 2), np.float32)]),
+    )
+
+
+# 長さ2のベクトルと、その合計のバイト数（正規化したクエリ1文字とFP32の2要素）
+QUERY_VECTOR = np.zeros(2, np.float32)
+QUERY_ENTRY_BYTES = 1 + QUERY_VECTOR.nbytes
+
+
+# 容量の上限を超えたら、最も長く使われていないクエリから捨てること
+def test_query_vector_cache_lru():
+    cache = QueryVectorCache(max_bytes=3 * QUERY_ENTRY_BYTES)
+    for key in ["a", "b", "c"]:
+        cache.put(key, QUERY_VECTOR)
+    assert cache.get("a") is not None
+    cache.put("d", QUERY_VECTOR)
+    assert list(cache.entries) == ["c", "a", "d"]
+    assert cache.get_stats() == {
+        "entries": 3,
+        "bytes": 3 * QUERY_ENTRY_BYTES,
+        "hits": 1,
+        "misses": 0,
+        "evictions": 1,
+        "expirations": 0,
+    }
+
+
+# 上限より大きいベクトルは保存しないこと。同じクエリを保存し直しても、二重に数えないこと
+def test_query_vector_cache_byte_budget():
+    cache = QueryVectorCache(max_bytes=2 * QUERY_ENTRY_BYTES)
+    cache.put("a", QUERY_VECTOR)
+    cache.put("a", QUERY_VECTOR)
+    cache.put("b", np.zeros(100, np.float32))
+    assert list(cache.entries) == ["a"]
+    assert cache.get_stats()["bytes"] == QUERY_ENTRY_BYTES
+    assert cache.get("b") is None
+    assert cache.get_stats()["misses"] == 1
+
+
+# 有効期限を過ぎたクエリは、ミスとして捨てること
+def test_query_vector_cache_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ch02_basic_vectorization.time, "monotonic", lambda: now[0])
+    cache = QueryVectorCache(ttl=10)
+    cache.put("a", QUERY_VECTOR)
+    now[0] = 110.0
+    assert cache.get("a") is not None
+    now[0] = 110.5
+    assert cache.get("a") is None
+    assert cache.get_stats() == {
+        "entries": 0,
+        "bytes": 0,
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+        "expirations": 1,
+    }
+
+
+# キャッシュにないクエリだけを、正規化してからベクトル化すること
+def test_query_vector_cache_wrap():
+    vectorized_texts = []
+
+    def vectorize(texts):
+        vectorized_texts.extend(texts)
+        return [np.full(2, len(text), np.float32) for text in texts]
+
+    vectorize_with_cache = QueryVectorCache().wrap(vectorize)
+    first_vectors = vectorize_with_cache(["ＨＤＭＩ  ケーブル", "abc"])
+    second_vectors = vectorize_with_cache(["abc", "HDMI ケーブル", "xy"])
+    assert vectorized_texts == ["HDMI ケーブル", "abc", "xy"]
+    np.testing.assert_array_equal(first_vectors[0], second_vectors[1])
+    np.testing.assert_array_equal(first_vectors[1], second_vectors[0])
+
+
+# ONNXのモデルを模したモデルを返す関数。PyTorchの重みを持たず、auto_model は読み込んだ
+# ONNXのファイルのパスを持つ
+def make_onnx_like_model(model, onnx_path):
+    onnx_like_model = copy.deepcopy(model)
+    device = onnx_like_model.device
+    del onnx_like_model[0].model
+    onnx_like_model[0].model = types.SimpleNamespace(
+        model_path=onnx_path, device=device
+    )
+    return onnx_like_model
+
+
+# PyTorchの重みを持たないモデルでもキャッシュを開けること。ONNXのファイルの内容が
+# 異なれば、フィンガープリントとキャッシュも異なること
+def test_model_fingerprint_of_onnx_like_models(tiny_model, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        ch02_basic_vectorization, "EMBEDDING_CACHE_DIR", str(tmp_path / "cache")
+    )
+    onnx_paths = []
+    for index, content in enumerate([b"model a", b"model a", b"model b"]):
+        onnx_path = tmp_path / f"onnx-{index}" / "model.onnx"
+        onnx_path.parent.mkdir()
+        onnx_path.write_bytes(content)
+        onnx_paths.append(onnx_path)
+    models = [make_onnx_like_model(tiny_model, path) for path in onnx_paths]
+    assert not list(models[0].parameters())
+
+    fingerprints = [get_model_fingerprint(model) for model in models]
+    assert fingerprints[0] == fingerprints[1] != fingerprints[2]
+    assert get_model_fingerprint(tiny_model) not in fingerprints
+
+    cache_directories = [open_embedding_cache(model).directory for model in models]
+    assert cache_directories[0] == cache_directories[1] != cache_directories[2]
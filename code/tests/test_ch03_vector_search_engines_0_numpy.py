@@ -0,0 +1,44 @@
+from ch02_basic_vectorization import set_vector_matrix
+from ch03_vector_search_engines_0_numpy import calc_cos, cos
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+# テスト用の、クエリと製品が重複するデータ。同じベクトルの製品B1とB3は同点になる
+def make_data(dtype):
+    rng = np.random.default_rng(0)
+    queries = (rng.standard_normal((2, 8)) * 40).astype(dtype)
+    products = (rng.standard_normal((3, 8)) * 40).astype(dtype)
+    products[2] = products[0]
+    data = pd.DataFrame(
+        {"query_id": [0, 0, 0, 1, 1], "product_id": ["B1", "B2", "B3", "B2", "B3"]}
+    )
+    data["query_vector"] = list(queries[data["query_id"]])
+    data["title_vector"] = list(products[[0, 1, 2, 1, 2]])
+    return data
+
+
+# 行ごとに計算した場合（apply(cos)）と、FP64の精度で一致すること。INT8でも桁あふれしないこと
+@pytest.mark.parametrize("dtype", [np.float32, np.float16, np.int8])
+def test_calc_cos(dtype):
+    data = make_data(dtype)
+    expected = [
+        cos([vector.astype(np.float64) for vector in row])
+        for row in data[["query_vector", "title_vector"]].itertuples(index=False)
+    ]
+    scores = calc_cos(data)
+
+    assert scores.dtype == np.float64
+    np.testing.assert_allclose(scores, expected, rtol=1e-12)
+    assert scores[0] == scores[2]
+
+
+# ベクトルを attrs の行列で持つ場合も、同じスコアになること
+def test_calc_cos_with_vector_matrices():
+    data = make_data(np.float32)
+    expected = calc_cos(data)
+    for column in ["query_vector", "title_vector"]:
+        set_vector_matrix(data, column, np.vstack(data[column]))
+    np.testing.assert_array_equal(calc_cos(data), expected)
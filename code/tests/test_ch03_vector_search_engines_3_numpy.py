@@ -0,0 +1,45 @@
+from ch03_vector_search_engines_3_numpy import MISSING_SCORE, BlockedExactIndex
+
+import faiss
+import numpy as np
+import pytest
+
+
+# テスト用の、ドキュメントとクエリのベクトルの行列
+rng = np.random.default_rng(0)
+DOCUMENTS = rng.standard_normal((1000, 16)).astype(np.float32)
+QUERIES = rng.standard_normal((50, 16)).astype(np.float32)
+
+
+# ブロックの大きさやスレッド数によらず、FaissのIndexFlatIPと同じ検索結果になること
+@pytest.mark.parametrize(
+    "document_block_size, query_block_size, threads",
+    [(16384, 256, 1), (97, 7, 1), (97, 7, 4)],
+)
+def test_blocked_exact_index(document_block_size, query_block_size, threads):
+    faiss_index = faiss.IndexFlatIP(16)
+    faiss_index.add(DOCUMENTS)
+    expected_scores, expected_indices = faiss_index.search(QUERIES, 10)
+
+    index = BlockedExactIndex(16, document_block_size, query_block_size, threads)
+    index.add(DOCUMENTS[:600])
+    index.add(DOCUMENTS[600:])
+    scores, indices = index.search(QUERIES, 10)
+
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5, atol=1e-5)
+
+
+# ドキュメントが k 件に満たない場合、Faissと同じく-1と最小のスコアで埋めること
+def test_blocked_exact_index_with_fewer_documents():
+    faiss_index = faiss.IndexFlatIP(16)
+    faiss_index.add(DOCUMENTS[:3])
+    expected_scores, expected_indices = faiss_index.search(QUERIES, 5)
+
+    index = BlockedExactIndex(16)
+    index.add(DOCUMENTS[:3])
+    scores, indices = index.search(QUERIES, 5)
+
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_array_equal(scores[:, 3:], MISSING_SCORE)
+    np.testing.assert_array_equal(expected_scores[:, 3:], MISSING_SCORE)
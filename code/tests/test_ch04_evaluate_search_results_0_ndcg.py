@@ -0,0 +1,49 @@
+from ch04_evaluate_search_results_0_ndcg import calc_metrics, esci_label_to_ndcg_gain
+from sklearn.metrics import ndcg_score
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+# テスト用の、スコアが等しいドキュメントを含む小さなデータ。クエリの行は連続させない
+def make_data():
+    return pd.DataFrame(
+        {
+            "query_id": [1, 1, 2, 1, 2, 1, 2, 3, 3],
+            "esci_label": ["I", "E", "S", "C", "E", "E", "C", "S", "I"],
+            "score": [0.9, 0.5, 0.3, 0.5, 0.3, 0.1, 0.8, 0.2, 0.2],
+        }
+    )
+
+
+# スコアが等しいドキュメントの間で利得を平均したnDCGが、scikit-learnと一致すること
+@pytest.mark.parametrize("k", [None, 1, 2, 3])
+def test_calc_metrics_matches_sklearn(k):
+    data = make_data()
+    expected = {
+        query_id: ndcg_score(
+            [group["esci_label"].apply(esci_label_to_ndcg_gain)],
+            [group["score"]],
+            k=k,
+        )
+        for query_id, group in data.groupby("query_id")
+    }
+    metrics = calc_metrics(data, k)
+    assert metrics.index.tolist() == list(expected)
+    np.testing.assert_allclose(metrics["ndcg"], list(expected.values()), rtol=1e-12)
+
+
+# 上位k件の再現率と逆順位。同点はデータの順序のままとすること
+def test_calc_metrics_recall_and_reciprocal_rank():
+    metrics = calc_metrics(make_data(), k=2)
+    np.testing.assert_allclose(metrics["recall"], [0.5, 0.0, 0.0])
+    np.testing.assert_allclose(metrics["reciprocal_rank"], [0.5, 0.0, 0.0])
+
+
+# 未知のESCIラベルは例外とすること
+def test_calc_metrics_rejects_unknown_labels():
+    data = make_data()
+    data.loc[0, "esci_label"] = "X"
+    with pytest.raises(KeyError):
+        calc_metrics(data)
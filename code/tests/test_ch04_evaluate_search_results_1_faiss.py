@@ -0,0 +1,95 @@
+from ch04_evaluate_search_results_0_ndcg import calc_metrics
+from ch04_evaluate_search_results_1_faiss import (
+    Qrels,
+    calc_recall_against_exact,
+    read_faiss_index,
+)
+
+import faiss
+import numpy as np
+import os
+import pandas as pd
+import pytest
+
+
+# テスト用のラベル。クエリ3は検索結果に現れない製品のラベルだけを持つ
+LABEL_DATA = pd.DataFrame(
+    {
+        "query_id": [1, 1, 1, 2, 2, 3],
+        "product_id": ["P0", "P1", "P2", "P1", "P3", "P5"],
+        "esci_label": ["E", "S", "I", "C", "E", "E"],
+    }
+)
+QUERY_IDS = [1, 2, 3]
+PRODUCT_IDS = ["P0", "P1", "P2", "P3", "P4", "P5"]
+
+# テスト用の検索結果。同点のスコア、ラベルのない製品（P4）、プレースホルダ-1を含む
+SCORE_MATRIX = np.array(
+    [[0.9, 0.7, 0.7], [0.8, 0.8, 0.0], [0.5, 0.0, 0.0]], dtype=np.float32
+)
+INDEX_MATRIX = np.array([[2, 0, 1], [4, 3, -1], [0, -1, -1]])
+
+
+# 以前の方法（検索結果とラベルを外部結合したDataFrameで評価する）の結果を返す関数
+def calc_metrics_by_merging(k):
+    score_matrix, index_matrix = SCORE_MATRIX[:, :k], INDEX_MATRIX[:, :k]
+    product_ids = np.append(np.asarray(PRODUCT_IDS, dtype=object), None)
+    score_data = pd.DataFrame(
+        {
+            "query_id": np.repeat(QUERY_IDS, k),
+            "product_id": product_ids[index_matrix.ravel()],
+            "score": np.where(index_matrix < 0, -1e10, score_matrix).ravel(),
+        }
+    )
+    merged_data = pd.merge(
+        LABEL_DATA, score_data, on=["query_id", "product_id"], how="outer"
+    ).fillna({"esci_label": "I", "score": -2e10})
+    return calc_metrics(merged_data, k)
+
+
+# 疎行列で評価したnDCGが、以前の方法と一致すること
+@pytest.mark.parametrize("k", [1, 2, 3])
+def test_qrels_matches_merging(k):
+    metrics = Qrels(LABEL_DATA, QUERY_IDS, PRODUCT_IDS).evaluate(
+        k, SCORE_MATRIX[:, :k], INDEX_MATRIX[:, :k]
+    )
+    expected = calc_metrics_by_merging(k)
+    assert metrics.index.tolist() == expected.index.tolist()
+    np.testing.assert_allclose(metrics["ndcg"], expected["ndcg"], rtol=1e-12)
+
+
+# 再現率と逆順位。検索結果に適合する製品がなければ0とすること
+def test_qrels_recall_and_reciprocal_rank():
+    metrics = Qrels(LABEL_DATA, QUERY_IDS, PRODUCT_IDS).evaluate(
+        3, SCORE_MATRIX, INDEX_MATRIX
+    )
+    np.testing.assert_allclose(metrics["recall"], [1.0, 1.0, 0.0])
+    np.testing.assert_allclose(metrics["reciprocal_rank"], [0.5, 0.5, 0.0])
+
+
+# 総当たりの検索結果に対する再現率。プレースホルダ-1は数えないこと
+def test_calc_recall_against_exact():
+    np.testing.assert_allclose(
+        calc_recall_against_exact(
+            np.array([[0, 1, 2], [3, -1, -1]]), np.array([[2, 5, 0], [3, 4, -1]])
+        ),
+        [2 / 3, 1 / 2],
+    )
+
+
+# 保存した総当たりのインデックスは、ベクトルごとメモリマップして読み込まれること
+def test_read_faiss_index_maps_flat_index(tmp_path, capsys):
+    matrix = np.random.default_rng(0).standard_normal((100, 8)).astype(np.float32)
+    faiss_index = faiss.IndexFlatIP(8)
+    faiss_index.add(matrix)
+    path = str(tmp_path / "flat.index")
+    faiss.write_index(faiss_index, path)
+
+    read_index = read_faiss_index(path)
+    assert capsys.readouterr().out == f"Loaded (mmap): {path}\n"
+    if os.path.isfile("/proc/self/maps"):
+        with open("/proc/self/maps") as maps_file:
+            assert path in maps_file.read()
+    np.testing.assert_array_equal(
+        read_index.search(matrix[:5], 3)[1], faiss_index.search(matrix[:5], 3)[1]
+    )
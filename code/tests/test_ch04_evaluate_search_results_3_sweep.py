@@ -0,0 +1,36 @@
+from ch04_evaluate_search_results_3_sweep import get_pareto_frontier
+
+import numpy as np
+import pandas as pd
+
+
+# パレート最適な組み合わせだけを、レイテンシの昇順に返すこと
+# レイテンシが同じなら再現率の高いもの、再現率が同じならレイテンシの低いものを残す
+def test_get_pareto_frontier():
+    results = pd.DataFrame(
+        {
+            "name": ["a", "b", "c", "d", "e", "f"],
+            "exact_recall": [0.5, 0.9, 0.7, 0.7, 0.6, 0.9],
+            "p50_latency_ms": [1.0, 3.0, 2.0, 2.5, 2.0, 4.0],
+        }
+    )
+    assert get_pareto_frontier(results)["name"].tolist() == ["a", "c", "b"]
+
+
+# 無作為な結果で、他のどの組み合わせにも支配されないものと一致すること
+def test_get_pareto_frontier_matches_brute_force():
+    random_generator = np.random.default_rng(0)
+    results = pd.DataFrame(
+        {
+            "exact_recall": random_generator.permutation(100) / 100,
+            "p50_latency_ms": random_generator.permutation(100) + 1.0,
+        }
+    )
+    recalls = results["exact_recall"].to_numpy()
+    latencies = results["p50_latency_ms"].to_numpy()
+    dominated = [
+        np.any((latencies <= latency) & (recalls >= recall) & (latencies != latency))
+        for recall, latency in zip(recalls, latencies)
+    ]
+    expected = results[~np.array(dominated)].sort_values("p50_latency_ms")
+    pd.testing.assert_frame_equal(get_pareto_frontier(results), expected)
@@ -0,0 +1,40 @@
+from ch06_fast_vectorization_server import EmbeddingServer
+
+import asyncio
+import numpy as np
+import threading
+
+
+# 推論を始めたら、解放されるまで戻らないテスト用のモデル
+class BlockingModel:
+
+    # インスタンスを作成する特殊メソッド
+    def __init__(self):
+        self.started, self.released = threading.Event(), threading.Event()
+
+    # テキストのリストを、長さを要素とするベクトルの行列にするメソッド
+    def encode(self, texts, **args):
+        self.started.set()
+        self.released.wait()
+        return np.array([[len(text)] for text in texts], dtype=np.float32)
+
+
+# 停止すると、推論中やキューで待っている要求はすべて例外で終わること
+def test_stop_fails_outstanding_requests():
+    async def main():
+        model = BlockingModel()
+        server = EmbeddingServer(model, max_wait=0, max_batch_size=1)
+        await server.start()
+
+        requests = [
+            asyncio.create_task(server.vectorize(text)) for text in ["a", "bb", "a"]
+        ]
+        await asyncio.to_thread(model.started.wait)
+        await server.stop()
+        model.released.set()
+
+        results = await asyncio.gather(*requests, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert server.queue.empty() and not server.pending
+
+    asyncio.run(asyncio.wait_for(main(), timeout=10))
@@ -0,0 +1,208 @@
+from ch02_basic_vectorization import (
+    EmbeddingCache,
+    get_model_fingerprint,
+    get_vector_matrix_of,
+    read_vectorized_data,
+    vectorize_with,
+    write_vectorized_data,
+)
+
+import ch02_basic_vectorization
+import ch07_vector_compression_0_data
+import numpy as np
+import os
+import pandas as pd
+import pytest
+
+
+# テスト用の、クエリと製品タイトルの行グループ。行グループの間でテキストが重複する
+PARTS = [
+    pd.DataFrame({"query": ["hdmi", "hdmi"], "product_title": ["ケーブル", "電話機"]}),
+    pd.DataFrame({"query": ["abc"], "product_title": ["ケーブル"]}),
+    pd.DataFrame({"query": ["hdmi"], "product_title": ["xyz"]}),
+]
+
+
+# データセットを読み込む代わりに、テスト用の行グループを返すジェネレータ
+def iter_parts(sample_rate, batch_rows, skip_batches=0):
+    yield from PARTS[skip_batches:]
+
+
+# 先読みしても、前の行グループで推論するテキストを再び推論しないこと
+# 保存済みの行グループは読み込まずに飛ばし、行グループの番号は続きから数えること
+def test_prepare_parts(tiny_model, tmp_path, monkeypatch):
+    monkeypatch.setattr(ch07_vector_compression_0_data, "iter_jp_data", iter_parts)
+    cache = EmbeddingCache(str(tmp_path / "cache"))
+
+    def prepare(first_part_number):
+        return [
+            (part_number, [text for texts, _ in batches for text in texts])
+            for part_number, _, batches in ch07_vector_compression_0_data.prepare_parts(
+                tiny_model, cache, 1.0, 2, 2, None, first_part_number
+            )
+        ]
+
+    assert prepare(0) == [
+        (0, ["hdmi", "ケーブル", "電話機"]),
+        (1, ["abc"]),
+        (2, ["xyz"]),
+    ]
+    assert prepare(2) == [(2, ["hdmi", "xyz"])]
+
+
+# 行グループごとのファイルを、単一のデータにまとめられること。行グループがなければ例外
+def test_merge_parts(tmp_path, monkeypatch):
+    parquet_path = str(tmp_path / "tuned-vectorized.parquet")
+    monkeypatch.setattr(
+        ch07_vector_compression_0_data, "TUNED_VECTORIZED_PARQUET_PATH", parquet_path
+    )
+    matrices = [
+        np.full((len(part), 2), index, np.float32) for index, part in enumerate(PARTS)
+    ]
+    part_paths = [
+        str(tmp_path / f"part-{index}.parquet") for index in range(len(PARTS))
+    ]
+    for part, matrix, part_path in zip(PARTS, matrices, part_paths):
+        ch07_vector_compression_0_data.write_part(
+            part, {"title_vector": matrix}, part_path
+        )
+
+    ch07_vector_compression_0_data.merge_parts(part_paths, ["title_vector"])
+    data = read_vectorized_data(parquet_path)
+    assert data["query"].tolist() == ["hdmi", "hdmi", "abc", "hdmi"]
+    np.testing.assert_array_equal(
+        get_vector_matrix_of(data, "title_vector"),
+        np.vstack(matrices),
+    )
+
+    with pytest.raises(ValueError):
+        ch07_vector_compression_0_data.merge_parts([], ["title_vector"])
+
+
+# 差分のベクトル化では、同じモデルでベクトル化した以前のデータのベクトルだけを再利用し、
+# 別のモデルでベクトル化したデータなら、すべてベクトル化し直すこと
+@pytest.mark.parametrize("same_model", [True, False])
+def test_incremental_checks_model(tiny_model, tmp_path, monkeypatch, same_model):
+    parquet_path = str(tmp_path / "tuned-vectorized.parquet")
+    monkeypatch.setattr(
+        ch07_vector_compression_0_data, "TUNED_VECTORIZED_PARQUET_PATH", parquet_path
+    )
+    monkeypatch.setattr(
+        ch02_basic_vectorization, "EMBEDDING_CACHE_DIR", str(tmp_path / "cache")
+    )
+    jp_data = pd.DataFrame(
+        {
+            "query_id": [1, 2],
+            "query": ["hdmi", "abc"],
+            "product_id": ["B1", "B2"],
+            "product_title": ["ケーブル", "電話機"],
+        }
+    )
+    monkeypatch.setattr(
+        ch07_vector_compression_0_data,
+        "read_jp_data",
+        lambda sample_rate: jp_data.copy(),
+    )
+
+    # 以前のデータは、目印として0のベクトルにしておく
+    previous_data = jp_data.copy()
+    previous_data["query_vector"] = list(np.zeros((2, 16), np.float32))
+    previous_data["title_vector"] = list(np.zeros((2, 16), np.float32))
+    previous_data.attrs["model_fingerprint"] = (
+        get_model_fingerprint(tiny_model) if same_model else "another model"
+    )
+    write_vectorized_data(previous_data, parquet_path)
+
+    ch07_vector_compression_0_data.write_tuned_vectorized_data_incremental(
+        tiny_model, 1.0
+    )
+    data = read_vectorized_data(parquet_path)
+    assert data.attrs["model_fingerprint"] == get_model_fingerprint(tiny_model)
+    matrix = get_vector_matrix_of(data, "query_vector")
+    if same_model:
+        np.testing.assert_array_equal(matrix, 0)
+    else:
+        np.testing.assert_allclose(
+            matrix,
+            tiny_model.encode(["hdmi", "abc"]),
+            rtol=1e-5,
+            atol=1e-6,
+        )
+
+
+# 以前のデータがなければ、すべてベクトル化すること。以前のデータがあれば、新しい行と
+# テキストの変わった行だけをベクトル化し、結果はすべてをベクトル化し直した場合と一致すること
+def test_incremental_reencodes_only_changed_rows(tiny_model, tmp_path, monkeypatch):
+    parquet_path = str(tmp_path / "tuned-vectorized.parquet")
+    monkeypatch.setattr(
+        ch07_vector_compression_0_data, "TUNED_VECTORIZED_PARQUET_PATH", parquet_path
+    )
+    monkeypatch.setattr(
+        ch02_basic_vectorization, "EMBEDDING_CACHE_DIR", str(tmp_path / "cache")
+    )
+
+    # ベクトル化する関数に渡されたテキストを記録する
+    vectorized_texts = []
+
+    def recording_vectorize_with(*args, **kwargs):
+        vectorize = vectorize_with(*args, **kwargs)
+
+        def recording_vectorize(texts):
+            vectorized_texts.extend(texts)
+            return vectorize(texts)
+
+        return recording_vectorize
+
+    monkeypatch.setattr(
+        ch07_vector_compression_0_data, "vectorize_with", recording_vectorize_with
+    )
+
+    # 以前のデータと、製品タイトルの変更、行の削除と追加をした新しいデータ
+    previous_jp_data = pd.DataFrame(
+        {
+            "query_id": [1, 1, 2],
+            "query": ["hdmi", "hdmi", "abc"],
+            "product_id": ["B1", "B2", "B3"],
+            "product_title": ["ケーブル", "電話機", "xyz"],
+        }
+    )
+    jp_data = pd.DataFrame(
+        {
+            "query_id": [1, 1, 3],
+            "query": ["hdmi", "hdmi", "usb"],
+            "product_id": ["B1", "B2", "B4"],
+            "product_title": ["ケーブル", "電話機（新型）", "充電器"],
+        }
+    )
+
+    def write_incremental(data):
+        monkeypatch.setattr(
+            ch07_vector_compression_0_data,
+            "read_jp_data",
+            lambda sample_rate: data.copy(),
+        )
+        vectorized_texts.clear()
+        ch07_vector_compression_0_data.write_tuned_vectorized_data_incremental(
+            tiny_model, 1.0
+        )
+        return read_vectorized_data(parquet_path)
+
+    # 以前のデータがなければ、すべてベクトル化する
+    write_incremental(previous_jp_data)
+    assert sorted(vectorized_texts) == sorted(
+        previous_jp_data["query"].tolist() + previous_jp_data["product_title"].tolist()
+    )
+
+    # 新しい行と、テキストの変わった行だけをベクトル化する
+    data = write_incremental(jp_data)
+    assert sorted(vectorized_texts) == ["usb", "充電器", "電話機（新型）"]
+
+    # すべてをベクトル化し直した場合と一致する
+    os.remove(parquet_path)
+    rebuilt_data = write_incremental(jp_data)
+    assert len(vectorized_texts) == 2 * len(jp_data)
+    for vector_column in ["query_vector", "title_vector"]:
+        np.testing.assert_array_equal(
+            get_vector_matrix_of(data, vector_column),
+            get_vector_matrix_of(rebuilt_data, vector_column),
+        )
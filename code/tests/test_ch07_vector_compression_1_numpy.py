@@ -0,0 +1,84 @@
+from ch07_vector_compression_1_numpy import (
+    ScalarQuantizer,
+    get_scalar_quantizer,
+    read_scalar_quantizer,
+)
+from sentence_transformers.quantization import quantize_embeddings
+
+import numpy as np
+import os
+import pandas as pd
+
+
+# テスト用の、キャリブレーションデータと量子化するベクトルの行列
+rng = np.random.default_rng(0)
+CALIBRATION_VECTORS = rng.standard_normal((1000, 8)).astype(np.float32)
+VECTORS = rng.standard_normal((100, 8)).astype(np.float32) * 1.5
+
+
+# デフォルトでは、quantize_embeddings にキャリブレーションデータを渡す場合と一致すること
+# バッチの大きさによらないこと
+def test_scalar_quantizer_matches_quantize_embeddings():
+    expected = quantize_embeddings(
+        VECTORS, precision="int8", calibration_embeddings=CALIBRATION_VECTORS
+    )
+    for batch_size in [65536, 7]:
+        scalar_quantizer = ScalarQuantizer().fit(
+            CALIBRATION_VECTORS, batch_size=batch_size
+        )
+        np.testing.assert_array_equal(
+            scalar_quantizer.quantize(VECTORS, batch_size=batch_size), expected
+        )
+
+
+# サンプリングや外れ値の切り捨てをすると、範囲はすべての行の最小値と最大値の内側になること
+def test_scalar_quantizer_sampling_and_clipping():
+    for scalar_quantizer in [
+        ScalarQuantizer().fit(CALIBRATION_VECTORS, sample_size=100),
+        ScalarQuantizer().fit(CALIBRATION_VECTORS, clip_percentile=1.0),
+    ]:
+        assert (scalar_quantizer.ranges[0] >= CALIBRATION_VECTORS.min(axis=0)).all()
+        assert (scalar_quantizer.ranges[1] <= CALIBRATION_VECTORS.max(axis=0)).all()
+        assert (scalar_quantizer.ranges[0] < scalar_quantizer.ranges[1]).all()
+
+
+# 保存していなければ訓練データでキャリブレーションして保存し、以降はそれを読み込むこと
+# 別のデータや別のモデルでベクトル化したデータなら、キャリブレーションし直すこと
+def test_get_scalar_quantizer(tmp_path):
+    path = str(tmp_path / "scalar-quantizer.npz")
+    data = pd.DataFrame(
+        {
+            "split": ["train"] * len(CALIBRATION_VECTORS) + ["test"],
+            "title_vector": list(CALIBRATION_VECTORS) + [np.full(8, 100, np.float32)],
+        }
+    )
+
+    scalar_quantizer = get_scalar_quantizer(data, path)
+    assert os.path.isfile(path)
+    np.testing.assert_array_equal(
+        scalar_quantizer.ranges, ScalarQuantizer().fit(CALIBRATION_VECTORS).ranges
+    )
+    np.testing.assert_array_equal(
+        read_scalar_quantizer(path).ranges, scalar_quantizer.ranges
+    )
+
+    # 同じデータなら、保存したもの（ここでは目印の範囲に書き換えたもの）を読み込む
+    marked_ranges = np.array([np.full(8, -1), np.full(8, 1)], dtype=np.float32)
+    ScalarQuantizer(marked_ranges, scalar_quantizer.fingerprint).save(path)
+    np.testing.assert_array_equal(
+        get_scalar_quantizer(data, path).ranges, marked_ranges
+    )
+
+    # 訓練データのベクトルや、ベクトル化したモデルが異なれば、キャリブレーションし直す
+    other_data = data.iloc[:10]
+    other_model_data = data.copy()
+    other_model_data.attrs["model_fingerprint"] = "another model"
+    for changed_data, calibration_vectors in [
+        (other_data, CALIBRATION_VECTORS[:10]),
+        (other_model_data, CALIBRATION_VECTORS),
+    ]:
+        ScalarQuantizer(marked_ranges, scalar_quantizer.fingerprint).save(path)
+        np.testing.assert_array_equal(
+            get_scalar_quantizer(changed_data, path).ranges,
+            ScalarQuantizer().fit(calibration_vectors).ranges,
+        )
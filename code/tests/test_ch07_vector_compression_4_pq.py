@@ -0,0 +1,83 @@
+from ch07_vector_compression_4_pq import (
+    RefinedIndex,
+    get_ivf_bytes_per_vector,
+    make_ivf_pq_index,
+)
+
+import faiss
+import numpy as np
+import pytest
+
+
+# テスト用の、ドキュメントとクエリのベクトルの行列
+rng = np.random.default_rng(0)
+DOCUMENT_MATRIX = rng.standard_normal((500, 16)).astype(np.float32)
+QUERY_MATRIX = rng.standard_normal((20, 16)).astype(np.float32)
+
+
+# 訓練してドキュメントを入力した、IVF-PQのインデックスを返す関数
+def make_trained_ivf_pq_index(with_opq=False):
+    faiss_index = make_ivf_pq_index(16, 4, 4, 4, with_opq)
+    faiss_index.train(DOCUMENT_MATRIX)
+    faiss_index.add(DOCUMENT_MATRIX)
+    faiss.extract_index_ivf(faiss_index).nprobe = 4
+    return faiss_index
+
+
+# 総当たりの内積の上位 k 件の、スコアと通し番号の行列を返す関数
+def search_exactly(k):
+    flat_index = faiss.IndexFlatIP(16)
+    flat_index.add(DOCUMENT_MATRIX)
+    return flat_index.search(QUERY_MATRIX, k)
+
+
+# OPQなし・ありとも、訓練して検索でき、上位の検索結果がおおむね総当たりと重なること
+@pytest.mark.parametrize("with_opq", [False, True])
+def test_make_ivf_pq_index(with_opq):
+    faiss_index = make_trained_ivf_pq_index(with_opq)
+    assert isinstance(faiss_index, faiss.IndexPreTransform) == with_opq
+    assert faiss_index.ntotal == len(DOCUMENT_MATRIX)
+
+    _, index_matrix = faiss_index.search(QUERY_MATRIX, 10)
+    _, exact_index_matrix = search_exactly(10)
+    assert ((index_matrix >= 0) & (index_matrix < len(DOCUMENT_MATRIX))).all()
+    overlap = np.mean(
+        [
+            len(set(row) & set(exact_row)) / 10
+            for row, exact_row in zip(index_matrix, exact_index_matrix)
+        ]
+    )
+    assert overlap > 0.3
+
+
+# すべてのドキュメントを候補にして並べ直せば、総当たりの検索結果と一致すること
+# 元のベクトルの行列の行番号を与えた場合も、同じ結果になること
+def test_refined_index_matches_exact_search():
+    faiss_index = make_trained_ivf_pq_index()
+    exact_score_matrix, exact_index_matrix = search_exactly(10)
+
+    permutation = rng.permutation(len(DOCUMENT_MATRIX))
+    refine_matrix = np.empty_like(DOCUMENT_MATRIX)
+    refine_matrix[permutation] = DOCUMENT_MATRIX
+    for refined_index in [
+        RefinedIndex(faiss_index, DOCUMENT_MATRIX, None, len(DOCUMENT_MATRIX)),
+        RefinedIndex(faiss_index, refine_matrix, permutation, len(DOCUMENT_MATRIX)),
+    ]:
+        score_matrix, index_matrix = refined_index.search(QUERY_MATRIX, 10)
+        np.testing.assert_array_equal(index_matrix, exact_index_matrix)
+        np.testing.assert_allclose(score_matrix, exact_score_matrix, rtol=1e-5)
+
+
+# ベクトルあたりのバイト数は、PQの符号（サブベクトル数×ビット数）とIDの大きさの和
+@pytest.mark.parametrize(
+    "number_of_subquantizers, number_of_bits, expected_bytes",
+    [(4, 8, 4 + 8), (8, 8, 8 + 8), (4, 4, 2 + 8)],
+)
+@pytest.mark.parametrize("with_opq", [False, True])
+def test_get_ivf_bytes_per_vector(
+    number_of_subquantizers, number_of_bits, expected_bytes, with_opq
+):
+    faiss_index = make_ivf_pq_index(
+        16, 4, number_of_subquantizers, number_of_bits, with_opq
+    )
+    assert get_ivf_bytes_per_vector(faiss_index) == expected_bytes
@@ -0,0 +1,52 @@
+from ch08_dim_reduce_and_hash_0_numpy import randomly_rotate_matrix
+from ch08_dim_reduce_and_hash_3_binary import (
+    SignHashIndex,
+    get_sign_codes,
+    pack_signs,
+)
+
+import faiss
+import numpy as np
+
+
+# テスト用のベクトルの行列
+MATRIX = np.random.default_rng(0).standard_normal((200, 32)).astype(np.float32)
+
+
+# 各要素の符号（0以上なら1）のビットを、先頭の要素から上位ビットの順に詰めること
+def test_pack_signs():
+    vector = np.array(
+        [0.5, -1.0, 0.0, 2.0, -0.1, 3.0, -2.0, 1.0, -1.0, -1.0, 1.0, -1.0, 0, 0, 0, 0]
+    )
+    np.testing.assert_array_equal(
+        pack_signs(vector[np.newaxis]), [[0b10110101, 0b00101111]]
+    )
+
+
+# バイナリコードは、ランダム回転したベクトルの符号を詰めたものであること
+def test_get_sign_codes():
+    codes = get_sign_codes(MATRIX, 32, 16, seed=1)
+    assert codes.shape == (len(MATRIX), 2)
+    np.testing.assert_array_equal(
+        np.unpackbits(codes, axis=1),
+        (randomly_rotate_matrix(MATRIX, 32, 16, seed=1) >= 0).astype(np.uint8),
+    )
+
+
+# ランダム回転は訓練の際に一度だけ作成し、get_sign_codes と同じバイナリコードにすること
+# ドキュメントと同じベクトルで検索すれば、自身が距離0で最上位になること
+def test_sign_hash_index():
+    sign_hash_index = SignHashIndex(faiss.IndexBinaryFlat(64), 32, seed=1)
+    assert not sign_hash_index.is_trained
+    sign_hash_index.train()
+    random_rotation_matrix = sign_hash_index.random_rotation_matrix
+    sign_hash_index.add(MATRIX)
+    assert sign_hash_index.random_rotation_matrix is random_rotation_matrix
+    np.testing.assert_array_equal(
+        sign_hash_index.encode(MATRIX), get_sign_codes(MATRIX, 32, 64, seed=1)
+    )
+
+    distance_matrix, index_matrix = sign_hash_index.search(MATRIX, 3)
+    np.testing.assert_array_equal(distance_matrix[:, 0], 0)
+    np.testing.assert_array_equal(index_matrix[:, 0], np.arange(len(MATRIX)))
+    assert (distance_matrix[:, 1] > 0).all()